@@ -0,0 +1,861 @@
+# This module contains offline benchmarks for RottenBot.
+# Run 'python benchmark.py -h' for the list of benchmarks.
+################################################################################
+import argparse
+import collections
+import json
+import os
+import pickle
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from concurrent.futures import as_completed, ThreadPoolExecutor
+
+import regex as re
+
+import patterns
+import scraper
+import standin
+import wdeditor
+
+from lazyimport import lazy_import
+
+wtp = lazy_import('wikitextparser')
+################################################################################
+# Datatypes of the properties wdeditor uses, for the stand-in Wikidata.
+PROPERTY_TYPES = {
+    wdeditor.P_ROTTEN_TOMATOES_ID: 'external-id',
+    wdeditor.P_REVIEW_SCORE: 'string',
+    wdeditor.P_REVIEW_SCORE_BY: 'wikibase-item',
+    wdeditor.P_REVIEW_COUNT: 'quantity',
+    wdeditor.P_POINT_IN_TIME: 'time',
+    wdeditor.P_DETERMINATION_METHOD: 'wikibase-item',
+    wdeditor.P_REFERENCE_URL: 'url',
+    wdeditor.P_RETRIEVED: 'time',
+    wdeditor.P_TITLE: 'monolingualtext',
+    wdeditor.P_PUBLISHER: 'wikibase-item',
+    wdeditor.P_LANGUAGE: 'wikibase-item',
+    wdeditor.P_STATED_IN: 'wikibase-item',
+    wdeditor.P_NAMED_AS: 'string',
+}
+
+def latency_summary(latencies):
+    """
+    Returns a one-line summary (mean and tail percentiles) of a list of
+    latencies in seconds.
+    """
+    if len(latencies) < 2:
+        return f"n={len(latencies)}"
+    q = statistics.quantiles(latencies, n=100, method='inclusive')
+    return (f"n={len(latencies)} mean={statistics.fmean(latencies)*1000:.1f}ms "
+        f"p50={q[49]*1000:.1f}ms p90={q[89]*1000:.1f}ms "
+        f"p99={q[98]*1000:.1f}ms max={max(latencies)*1000:.1f}ms")
+
+def bench_scrape(args):
+    """
+    Replays every movie page in a recorded archive through scraper.RTmovie.
+    """
+    scraper.use_archive('replay', args.archive, latency=args.latency,
+        error_rate=args.error_rate, seed=args.seed)
+    short_urls = [url.split('rottentomatoes.com/')[-1]
+        for url in scraper.archived_urls(args.archive)]
+    short_urls = [x for x in short_urls if x.startswith('m/')] * args.repeat
+
+    def timed_scrape(short_url):
+        t0 = time.perf_counter()
+        try:
+            scraper.RTmovie(short_url)
+            ok = True
+        except Exception:
+            ok = False
+        return ok, time.perf_counter() - t0
+
+    latencies, errors = [], 0
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for future in as_completed(executor.submit(timed_scrape, x) for x in short_urls):
+            ok, latency = future.result()
+            latencies.append(latency)
+            errors += not ok
+    elapsed = time.perf_counter() - t0
+
+    print(f"Scraped {len(short_urls)} pages in {elapsed:.2f}s "
+        f"({len(short_urls)/elapsed:.1f} pages/s, {errors} errors).")
+    print(latency_summary(latencies))
+
+def bench_startup(args):
+    """
+    Measures the wall time of starting each main.py subcommand.
+    Subcommands are run with '-h' (or on an empty data file for 'print'),
+    so this measures imports and setup rather than real work.
+    """
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    with tempfile.TemporaryDirectory() as tmp:
+        empty = os.path.join(tmp, 'empty.pickle')
+        with open(empty, 'wb') as f:
+            pickle.dump([], f)
+        commands = {
+            '--help': ['--help'],
+            'store': ['store', '-h'],
+            'upload': ['upload', '-h'],
+            'print': ['print', empty],
+            'listpages': ['listpages', '-h'],
+        }
+        for name, argv in commands.items():
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                subprocess.run([sys.executable, main_py] + argv, cwd=tmp,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                times.append(time.perf_counter() - t0)
+            print(f"{name:<10} median={statistics.median(times)*1000:.0f}ms "
+                f"min={min(times)*1000:.0f}ms")
+
+def bench_sparql(args):
+    """
+    Streams a synthetic result set from a local stand-in query service
+    through wdeditor.iter_results, with injected errors and cut-off
+    responses, and checks that every row arrives exactly once.
+    """
+    rows = []
+    for i in range(args.items):
+        for j in range(1 + i % 4):
+            rows.append({
+                'item': f'http://www.wikidata.org/entity/Q{i}',
+                'rtid': f'm/film_{i}',
+                # exercise quoting, including embedded newlines
+                'label': f'Film "{i}", part\n{j}' if i % 7 == 0 else f'Film {i}',
+                'value': f'{(i*j) % 101}%',
+            })
+    wdeditor.SPARQL_BACKOFF = 0
+
+    with standin.SparqlStandin(rows, error_rate=args.error_rate,
+            cut_rate=args.cut_rate, latency=args.latency, seed=args.seed) as server:
+        t0 = time.perf_counter()
+        received = [tuple(sorted((k, v['value']) for k, v in b.items()))
+            for b in wdeditor.iter_results('*', '', page_size=args.page_size,
+                endpoint=server.endpoint)]
+        elapsed = time.perf_counter() - t0
+
+    expected = collections.Counter(tuple(sorted(row.items())) for row in rows)
+    ok = collections.Counter(received) == expected
+    print(f"Streamed {len(received)} of {len(rows)} rows in {elapsed:.2f}s "
+        f"({len(received)/elapsed:.0f} rows/s) with {server.requests} requests.")
+    print('All rows received exactly once.' if ok else 'MISMATCH in received rows!')
+    if not ok:
+        sys.exit(1)
+
+def use_standin_wikis(directory, wikipedia, wikidata, put_throttle=0):
+    """
+    Points pywikibot's wikipedia and wikidata families at running
+    WikiStandins, keeping its files in directory.
+    Must be called before pywikibot is first used.
+    """
+    os.environ['PYWIKIBOT_DIR'] = directory
+    os.environ['PYWIKIBOT_NO_USER_CONFIG'] = '2'
+    config = wdeditor.pwb.config
+    config.family_files['wikipedia'] = standin.write_family_file(directory,
+        'wikipedia', 'en', wikipedia)
+    config.family_files['wikidata'] = standin.write_family_file(directory,
+        'wikidata', 'wikidata', wikidata)
+    config.usernames.setdefault('wikipedia', {})['en'] = 'RottenBot'
+    config.usernames.setdefault('wikidata', {})['wikidata'] = 'RottenBot'
+    config.put_throttle = put_throttle
+
+def synthetic_archive(directory, size, seed=0):
+    """
+    Records size synthetic Rotten Tomatoes movie pages, m/film_0 to
+    m/film_{size-1}, in an archive in directory, for use without a
+    recorded archive.
+    """
+    rng = random.Random(seed)
+    scraper.use_archive('record', directory)
+    for i in range(size):
+        rtid = f'm/film_{i}'
+        details = {'scoreboard': {'info': f'{2000 + i % 20}, Drama, 1h 40m',
+            'title': f'Film {i}'}, 'modal': {'tomatometerScoreAll': {
+            'score': rng.randrange(101), 'ratingCount': rng.randrange(5, 400),
+            'averageRating': f'{rng.uniform(1, 9):.2f}'}, 'audienceScoreAll': None}}
+        html = (f'<html><head><link rel="canonical" href="{scraper.rt_url(rtid)}"></head>'
+            f'<body><div id="movieSynopsis"> A film. </div>'
+            f'<script id="score-details-json" type="application/json">'
+            f'{json.dumps(details)}</script></body></html>')
+        scraper._record_response(scraper.rt_url(rtid),
+            types.SimpleNamespace(status_code=200, text=html))
+
+def _snak(pid, datavalue_type, value):
+    return {'snaktype': 'value', 'property': pid,
+        'datavalue': {'value': value, 'type': datavalue_type}}
+
+def _item_value(qid):
+    return {'entity-type': 'item', 'numeric-id': int(qid[1:]), 'id': qid}
+
+def old_score_claims(score, count, average):
+    """
+    Returns the JSON of a Tomatometer score statement and an average
+    rating statement from 1 January 2020, as wdeditor would have added them.
+    """
+    W = wdeditor
+    when = {'time': '+2020-01-01T00:00:00Z', 'timezone': 0, 'before': 0, 'after': 0,
+        'precision': 11, 'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'}
+    common = {W.P_REVIEW_SCORE_BY: [_snak(W.P_REVIEW_SCORE_BY, 'wikibase-entityid',
+            _item_value(W.Q_ROTTEN_TOMATOES))],
+        W.P_POINT_IN_TIME: [_snak(W.P_POINT_IN_TIME, 'time', when)]}
+    percent = {'mainsnak': _snak(W.P_REVIEW_SCORE, 'string', f'{score}%'),
+        'qualifiers': {**common,
+            W.P_REVIEW_COUNT: [_snak(W.P_REVIEW_COUNT, 'quantity', {'amount': f'+{count}',
+                'unit': 'http://www.wikidata.org/entity/Q80698083'})],
+            W.P_DETERMINATION_METHOD: [_snak(W.P_DETERMINATION_METHOD,
+                'wikibase-entityid', _item_value(W.Q_TOMATOMETER))]}}
+    average = {'mainsnak': _snak(W.P_REVIEW_SCORE, 'string', f'{average}/10'),
+        'qualifiers': {**common,
+            W.P_DETERMINATION_METHOD: [_snak(W.P_DETERMINATION_METHOD,
+                'wikibase-entityid', _item_value(W.Q_ROTTEN_TOMATOES_AVERAGE))]}}
+    return [percent, average]
+
+def bench_wiki(args):
+    """
+    Runs wdeditor.update_film_items and main.upload_edits against local
+    stand-in wikis, through pywikibot, and reports their throughput and
+    the number of API requests per edit. Rotten Tomatoes pages are replayed
+    from a recorded archive, or a synthetic one if none is given.
+    Request counts include pywikibot's one-off setup requests (siteinfo,
+    paraminfo, tokens).
+    """
+    import main
+    import wikieditor
+
+    archive = args.archive
+    if archive is None:
+        # removed when the function returns
+        synthetic = tempfile.TemporaryDirectory()
+        archive = synthetic.name
+        synthetic_archive(archive, args.items, args.seed)
+    scraper.use_archive('replay', archive)
+    rtids = sorted(url.split('rottentomatoes.com/')[-1]
+        for url in scraper.archived_urls(archive))
+    rtids = [x for x in rtids if x.startswith('m/')][:args.items]
+
+    # Every other item already has Rotten Tomatoes scores from 2020, so the
+    # new score statements are written next to existing P444 statements.
+    P = wdeditor.P_ROTTEN_TOMATOES_ID
+    entities = {pid: {'id': pid, 'datatype': t} for pid, t in PROPERTY_TYPES.items()}
+    pairs, scored = [], []
+    for i, rtid in enumerate(rtids, start=1):
+        claims = {P: [{'mainsnak': _snak(P, 'string', rtid)}]}
+        if i % 2 == 0:
+            claims[wdeditor.P_REVIEW_SCORE] = old_score_claims(1, 1, 1.5)
+            scored.append(f'Q{i}')
+        entities[f'Q{i}'] = {'id': f'Q{i}', 'claims': claims}
+        pairs.append((f'Q{i}', rtid))
+
+    old = 'On [[Rotten Tomatoes]], the film holds an approval rating of {}% based on {} reviews.'
+    new = 'On [[Rotten Tomatoes]], the film has an approval rating of {}% based on {} reviews.'
+    pages, edits = {}, []
+    for i in range(args.pages):
+        title = f'Film {i}'
+        pages[title] = f"'''{title}''' is a film.\n\n{old.format(i % 101, i)}\n"
+        edits.append(wikieditor.FullEdit(title, [wikieditor.Edit(
+            [(old.format(i % 101, i), new.format(i % 101, i))], set())]))
+
+    kwargs = dict(lag=args.lag, lag_rate=args.lag_rate, latency=args.latency,
+        seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp, \
+            standin.WikiStandin(entities=entities, dbname='wikidatawiki',
+                sitename='Wikidata', **kwargs) as wikidata, \
+            standin.WikiStandin(pages=pages, repo=wikidata, **kwargs) as wikipedia:
+        use_standin_wikis(tmp, wikipedia, wikidata, put_throttle=args.put_throttle)
+
+        t0 = time.perf_counter()
+        updated = wdeditor.update_film_items(pairs, scrape_workers=args.workers)
+        elapsed = time.perf_counter() - t0
+        print(f"Updated {updated} of {len(pairs)} items in {elapsed:.2f}s "
+            f"({updated/elapsed:.1f} items/s, "
+            f"{wikidata.requests/max(updated, 1):.1f} requests per item, "
+            f"{wikidata.maxlagged} maxlag errors).")
+        print('Wikidata calls:', dict(sorted(wikidata.calls.items())))
+        # An updated item with old scores gains a score and an average.
+        missing = [qid for qid in scored
+            if len(wikidata.entities[qid]['claims'].get(wdeditor.P_REVIEW_SCORE, [])) < 4]
+        print(f"New score statements saved on {len(scored) - len(missing)} of "
+            f"{len(scored)} items which already had scores.")
+        if missing:
+            print(f"MISSING new score statements on {', '.join(missing[:10])}!")
+            sys.exit(1)
+        # The items are up to date now, so a second refresh changes none.
+        outcomes = collections.Counter()
+        again = wdeditor.update_film_items(pairs, scrape_workers=args.workers,
+            on_done=lambda qid, rtid, outcome: outcomes.update([outcome]))
+        print(f"Refreshed again: {dict(outcomes)}.")
+        if again or outcomes['unchanged'] != len(pairs):
+            print(f"UPDATED {again} items which were already up to date!")
+            sys.exit(1)
+
+        file = os.path.join(tmp, 'edits.pickle')
+        with open(file, 'wb') as f:
+            pickle.dump(edits, f)
+        t0 = time.perf_counter()
+        main.upload_edits(argparse.Namespace(file=file, max_epm=args.max_epm,
+            journal=os.path.join(tmp, 'uploads.jsonl')))
+        elapsed = time.perf_counter() - t0
+        saved = sum(new.format(i % 101, i) in wikipedia.page_text(f'Film {i}')
+            for i in range(args.pages))
+        print(f"Saved {saved} of {len(edits)} pages in {elapsed:.2f}s "
+            f"({saved/elapsed:.1f} pages/s, "
+            f"{wikipedia.requests/max(saved, 1):.1f} requests per page, "
+            f"{wikipedia.maxlagged} maxlag errors).")
+        print('Wikipedia calls:', dict(sorted(wikipedia.calls.items())))
+
+def _compute_flags_reference(rtmatch, cand):
+    """
+    The straightforward implementation of wikieditor._compute_flags,
+    which parses the span three times. Kept as the oracle that the
+    single-pass version must agree with.
+    """
+    P = patterns
+    span = rtmatch.span
+    text = cand.text[span[0]:span[1]]
+    movie = rtmatch.movie
+    flags = set()
+
+    text = re.sub(r'<!--.*?-->', '', text, flags=re.S)
+    text = text.translate(str.maketrans('“”‘’','""\'\''))
+
+    if re.search(P.score_re, cand.title+movie.title):
+        flags.add('score pattern in title')
+    if re.search(P.average_re, cand.title+movie.title):
+        flags.add('average pattern in title')
+    if P.pattern_count(fr'<ref|{P.template_pattern("[rR]")}', text) - bool(rtmatch.ref):
+        flags.add(f"non-RT reference")
+    if re.search(r'{{\s*(?:shortened|sfn|harv)', text, flags=re.I):
+        flags.add('sfn or harv')
+
+    wikitext = wtp.parse(text)
+    for tag in wikitext.get_tags():
+        if tag.name not in ['ref', 'nowiki']:
+            flags.add(f'suspicious tag')
+
+    text_no_refs = re.sub(P.someref_re, '', text, flags=re.S)
+
+    rbrackets = {']':'[', '}':'{', ')':'(', '>':'<'}
+    stack, unbalanced = [], False
+    for c in text_no_refs:
+        if c == '"':
+            if stack and stack[-1] == '"':
+                stack.pop()
+            else:
+                stack.append('"')
+        elif c in rbrackets.values():
+            stack.append(c)
+        elif c in rbrackets:
+            if stack and stack[-1] == rbrackets[c]:
+                stack.pop()
+            else:
+                unbalanced = c
+                break
+    else:
+        unbalanced = stack[-1] if stack else False
+    if unbalanced:
+        flags.add(f'unbalanced {unbalanced}')
+
+    for name in ['Metacritic', 'IMDb', 'PostTrak', 'CinemaScore']:
+        if re.search(name, text_no_refs, flags=re.I):
+            flags.add(name)
+
+    if not re.match(r"['{[A-Z0-9]", text[0]):
+        flags.add("suspicious start")
+
+    wikitext_no_refs = wtp.parse(text_no_refs)
+    if wikitext_no_refs.parser_functions:
+        flags.add('parser function')
+    if wikitext_no_refs.external_links:
+        flags.add('external link')
+    for x in wikitext_no_refs.wikilinks:
+        if x.text:
+            x.target = 'a' * len(x.target)
+
+    uses_rtprose = 1 if re.search(P.t_rtprose, text_no_refs) else 0
+    k = P.pattern_count(P.score_re, str(wikitext_no_refs)) + uses_rtprose
+    if k == 0:
+        flags.add('missing score')
+    if k > 1:
+        flags.add('multiple scores')
+    if P.pattern_count(P.average_re, text_no_refs) + uses_rtprose > 1:
+        flags.add('multiple averages')
+    if P.pattern_count(P.count_re, text_no_refs) + uses_rtprose > 1:
+        flags.add('multiple counts')
+
+    text_no_quotes = re.sub(r'".+?"', '', text_no_refs, flags=re.S)
+    if P.pattern_count(r'\b(audience|user|viewer)', text_no_quotes, re.IGNORECASE):
+        flags.add('audience/user/viewer')
+
+    wikitext_no_quotes = wtp.parse(text_no_quotes)
+    for x in wikitext_no_quotes.wikilinks:
+        z = x.title.strip()
+        flags.add(f'WL:{z[:1].upper()+z[1:]}')
+    for x in wikitext_no_quotes.templates:
+        flags.add(f'T:{x.normal_name(capitalize=True)}')
+    return flags
+
+# Pieces of Rotten Tomatoes prose for the synthetic flags corpus, chosen to
+# reach every flag and the unusual cases of the single-pass flag engine.
+FLAG_OPENINGS = [
+    'On [[Rotten Tomatoes]], the film',
+    'On review aggregator [[Rotten Tomatoes|website Rotten Tomatoes]], the film',
+    'Review aggregation website [[Rotten Tomatoes]] reports that the film',
+    '{{As of|2021|5}}, the film',
+    "''The Film'' (2001)",
+    'the film',
+    '[[File:Poster.jpg|thumb|A [[film poster|poster]] for 50% off]] The film',
+    '{{RT prose|the film}}',
+    '[[Rotten Tomatoes#Ratings|RT]] says the film',
+]
+FLAG_SCORES = [
+    'holds an approval rating of {score}% based on {count} reviews, '
+        'with an average rating of {average}/10',
+    'has a score of {score} percent based on {count} critics',
+    'has a "Certified Fresh" rating of {score}% from {count} reviews',
+    'has an approval rating of {score}% based on [[List of reviews|{count} reviews]]',
+    'has a rating of {score}%, and an average of {average} out of 10',
+    'is rated “{score}%” by {count} critics',
+    'has a {{{{Nowrap|{score}%}}}} rating<ref>{{{{Cite web|url=https://www.imdb.com/|title=IMDb}}}}</ref>',
+    'has an approval rating of {score}%<ref name="rt" />',
+    'has an approval rating of [[{score}%]] and [[50% (film)|{score}%]]',
+]
+FLAG_EXTRAS = [
+    '',
+    ' The site\'s critical consensus reads, "A [[charming]] film that {{sic|delivers}}."',
+    ' The critical consensus reads: "Funny,\nand [[sad|touching]]."',
+    ' The consensus says "A \'\'[[Tour de force]]\'\' with 99% charm"',
+    ' [[Metacritic]] gives the film a score of 61 out of 100.',
+    ' Audiences polled by [[CinemaScore]] gave the film a grade of "A-".',
+    ' Audience score was 88%.<br />',
+    ' It is <small>fresh</small>.',
+    ' {{#if:yes|It is fresh.}}',
+    ' See [https://example.org the site].',
+    ' {{sfn|Smith|2001|p=5}}',
+    ' <!-- a comment with [[Link]] and 50% --> Done.',
+    ' It has (an unbalanced bracket.',
+    ' This was "a [[quoted link]]" and "another"',
+    ' "[[A]]"[[B]] and "x"{{C}}',
+    ' "open [[quote|link" text]]',
+    ' {{{param}}} and "quoted {{T|"nested"}} text"',
+    ' "[" [[joined]] "]"',
+    ' The user reviews differ.',
+    ' PostTrak reported 80% positive.',
+]
+FLAG_REFS = [
+    '',
+    '<ref>{{Cite Rotten Tomatoes|id=m/film|title=Film}}</ref>',
+    '<ref name="rt">{{Cite web|url=https://www.rottentomatoes.com/m/film|title=Film}}</ref>',
+    '{{r|rt}}',
+    '<ref>{{Cite web|url=https://www.rottentomatoes.com/m/film}}</ref><ref>Other.</ref>',
+]
+
+def flags_corpus(size, seed=0, extras=FLAG_EXTRAS):
+    """
+    Returns a list of (rtmatch, cand) pairs with synthetic Rotten Tomatoes
+    prose covering every flag of wikieditor._compute_flags.
+    """
+    import candidates
+
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        prose = ' '.join([rng.choice(FLAG_OPENINGS), rng.choice(FLAG_SCORES).format(
+            score=rng.randrange(101), count=rng.randrange(5, 400),
+            average=round(rng.uniform(1, 9), 1))]) + '.'
+        ref = rng.choice(FLAG_REFS)
+        prose += ref + ''.join(rng.sample(extras, rng.randrange(4)))
+        title = rng.choice(['Film', 'Film (2001 film)', '9½ Weeks', '50 First Dates'])
+        intro = f"'''{title}''' is a film.\n\n== Reception ==\n"
+        cand = candidates.Candidate(title, intro + prose + '\n')
+        rtmatch = candidates.RTMatch((len(intro), len(intro) + len(prose)),
+            candidates.Reference(ref) if ref else None,
+            types.SimpleNamespace(title=title.split(' (')[0]))
+        cand.matches.append(rtmatch)
+        corpus.append((rtmatch, cand))
+    return corpus
+
+def bench_flags(args):
+    """
+    Computes the flags of every match in a corpus with
+    wikieditor._compute_flags and with the reference implementation,
+    checks that they agree, and reports the time per match of each.
+    The corpus is synthetic unless a file of stored candidates is given.
+    """
+    import main
+    import wikieditor
+
+    if args.candidates:
+        corpus = [(rtm, cand) for cand in main.loaddata(args.candidates)
+            for rtm in cand.matches if rtm.movie]
+    else:
+        corpus = flags_corpus(args.size, args.seed)
+
+    flags, per_match = {}, {}
+    for name, func in [('reference', _compute_flags_reference),
+            ('single-pass', wikieditor._compute_flags)]:
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            flags[name] = [func(rtm, cand) for rtm, cand in corpus]
+            times.append(time.perf_counter() - t0)
+        per_match[name] = min(times) / len(corpus)
+        print(f"{name:<12} {per_match[name]*1e6:.0f}us per match")
+    print(f"Speedup: {per_match['reference']/per_match['single-pass']:.2f}x "
+        f"over {len(corpus)} matches.")
+
+    mismatches = [(cand.title, a, b) for (_, cand), a, b
+        in zip(corpus, flags['reference'], flags['single-pass']) if a != b]
+    for title, a, b in mismatches[:10]:
+        print(f"MISMATCH in {title}: missing {a - b}, extra {b - a}")
+    print('Flags identical.' if not mismatches else f'{len(mismatches)} MISMATCHES!')
+    if mismatches:
+        sys.exit(1)
+
+def _rewrite_prose_reference(new_prose, rtmatch, flags):
+    """
+    The pass-by-pass implementation of wikieditor._rewrite_prose, kept
+    as the oracle for the version which rewrites the text outside
+    references in one pass.
+    """
+    P = patterns
+    score, count, average = rtmatch.movie.tomatometer_score
+    new_prose = re.sub(r'<!--.*?-->', '', new_prose, flags=re.S)
+    new_prose = new_prose.translate(str.maketrans('“”‘’','""\'\''))
+
+    if m := re.search(P.t_rtprose, new_prose):
+        new_prose = new_prose.replace(m[0], P.rtdata_template('prose', qid=rtmatch.qid))
+
+    on_list = re.search(r'\[\[\s*(?:List of )?films with a (100|0)% rating on Rotten Tomatoes\s*\|([^]]+)\]\]', new_prose, flags=re.I)
+    if on_list:
+        if on_list[1] != score:
+            new_prose = new_prose.replace(on_list[0], on_list[2].strip())
+            flags.add('no longer 0% or 100%')
+    elif m := re.search(r'\[\[\s*(?:List of )?films with a (100|0)% rating on Rotten Tomatoes', new_prose, flags=re.I):
+        if m[1] != score:
+            flags.add('no longer 0% or 100%')
+
+    new_prose = re.sub(P.score_re + P.notinref,
+        P.rtdata_template('score', qid=rtmatch.qid), new_prose, flags=re.S)
+    if not {'Metacritic'} & flags:
+        new_prose = re.sub(P.count_re + P.notinref,
+            P.rtdata_template('count', qid=rtmatch.qid)+r' \g<count_term>', new_prose, flags=re.S)
+        if int(count) <= 9:
+            new_prose = new_prose.replace('{{RT data|count', '{{RT data|count|spell=y')
+    if not {'IMDb'} & flags:
+        new_prose = re.sub(P.average_re + P.notinref,
+            P.rtdata_template('average', qid=rtmatch.qid), new_prose, flags=re.S)
+
+    new_prose = re.sub(r'ilms with a \{\{RT data\|score.*?\}\} rating on Rotten', fr'ilms with a {score}% rating on Rotten', new_prose)
+
+    if m:=re.search(P.t_asof, new_prose, flags=re.S):
+        d = P.parse_template(m[0])[1]
+        if '3' in d:
+            d['4'] = 'd'
+        if '2' in d:
+            d['3'] = 'm'
+        if '1' in d:
+            d['2'] = 'y'
+            if re.search(r'[a-z]', d['1']):
+                d['3'] = 'm'
+        new_prose = new_prose.replace(m[0], P.rtdata_template('as of', **d, qid=rtmatch.qid))
+    elif m:=re.search(r"[Aa]s of (?=Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|[1-9]|early|mid|late).{,14}(?<![0-9])[0-9]{4}(?![0-9])" + P.notinref, new_prose, flags=re.S):
+        d = {'1':'as of', '2':'y', '3':'m'}
+        if P.pattern_count('[0-9]', m[0]) > 4:
+            d['4'] = 'd'
+            if not m[0][6].isdecimal():
+                d['df'] = 'US'
+        if m[0][0] == 'a':
+            d['lc'] = 'y'
+        d['qid'] = rtmatch.qid
+        new_prose = new_prose.replace(m[0], P.rtdata_template(**d))
+    elif re.search(r"\b[Aa]s of\b|(January|February|March|April|May|June|July|August|September|October|November|December) 20\d\d\b" + P.notinref, new_prose, flags=re.S):
+        flags.add('As of')
+
+    if not {'Metacritic','IMDb'} & flags:
+        for wl in wtp.parse(new_prose).wikilinks:
+            z = wl.title.strip().lower()
+            if re.match(r'weighted (average|(arithmetic )?mean)|average (rating|score)|rating average', z):
+                repl = wl.text.strip() if wl.text else wl.title.strip()
+                new_prose = new_prose.replace(str(wl), repl)
+        new_prose = re.sub(' weighted ' + P.notinref, ' ', new_prose, flags=re.S)
+        new_prose = re.sub(' a average' + P.notinref, ' an average', new_prose, flags=re.S)
+
+    new_prose = re.sub(r'rare (0%|100%|\[\[List|approval rating)', r'\1', new_prose)
+    new_prose = re.sub(fr' an? ({P.template_pattern("RT data")})', r' {{a or an|\1}}', new_prose)
+    new_prose = new_prose.replace('"..', '".')
+    new_prose = new_prose.replace('.".', '."')
+    new_prose = new_prose.replace('".', '."')
+    new_prose = re.sub(P.someref_re, lambda h: h[0].lstrip(), new_prose, flags=re.S)
+    new_prose = re.sub(P.cn_re, '', new_prose, flags=re.S)
+    return new_prose
+
+# More pieces of prose for the golden rewrite corpus, for the rules which
+# only _rewrite_prose has.
+REWRITE_EXTRAS = [
+    ' As of June 2021, it holds 7 reviews.',
+    ' as of 5 June 2021, it has 85%.',
+    ' {{As of|2021|6|5}}',
+    ' As of its release it is fresh.',
+    ' In March 2020 it dropped.',
+    ' It is on the [[List of films with a 100% rating on Rotten Tomatoes|list of perfect films]].',
+    ' It is on the [[films with a 0% rating on Rotten Tomatoes]].',
+    ' It has a [[Weighted arithmetic mean|weighted average]] of 6/10 and a average of seven out of ten.',
+    ' It has a rare 100% rating.{{cn|date=May 2020}}',
+    ' It holds a 8.5/10 weighted average.',
+    ' It says "fun"..',
+    ' It holds an 85% score <ref>{{Cite web|title=Poll of 60 reviews at 90%}}</ref>.',
+    '<ref>Unclosed 75% reference.',
+    ' Stray 40% </ref> and 12 critics.',
+    '\n\nA new paragraph with 55% and six reviews.</ref>',
+    ' <ref name="a" /> It has 9 reviews, 70 percent and 3 out of 10.',
+    ' It has 5 critical reviews from 20 professional critics and 30 votes.',
+    ' Its rating was sixty-five percent.',
+]
+
+def bench_rewrite(args):
+    """
+    Rewrites the prose of every match in a golden corpus with
+    wikieditor._rewrite_prose and with the reference implementation,
+    checks that they give the same prose and flags, and reports the time
+    per match of each. The corpus is synthetic unless a file of stored
+    candidates is given.
+    """
+    import main
+    import wikieditor
+
+    if args.candidates:
+        corpus = [(rtm, cand) for cand in main.loaddata(args.candidates)
+            for rtm in cand.matches if rtm.movie and rtm.movie.tomatometer_score]
+    else:
+        corpus = flags_corpus(args.size, args.seed, FLAG_EXTRAS + REWRITE_EXTRAS)
+        rng = random.Random(args.seed)
+        for rtm, cand in corpus:
+            rtm.qid = 'Q42'
+            rtm.movie.tomatometer_score = (str(rng.choice([0, 9, 55, 100])),
+                str(rng.choice([5, 9, 120])), '7.2')
+    inputs = []
+    for rtm, cand in corpus:
+        flags = wikieditor._compute_flags(rtm, cand)
+        inputs.append((cand.text[rtm.span[0]:rtm.span[1]], rtm, flags))
+
+    results, per_match = {}, {}
+    for name, func in [('reference', _rewrite_prose_reference),
+            ('fused', wikieditor._rewrite_prose)]:
+        times = []
+        for _ in range(args.repeat):
+            outputs = []
+            t0 = time.perf_counter()
+            for prose, rtm, flags in inputs:
+                flags = set(flags)
+                outputs.append((func(prose, rtm, flags), flags))
+            times.append(time.perf_counter() - t0)
+        results[name] = outputs
+        per_match[name] = min(times) / len(inputs)
+        print(f"{name:<10} {per_match[name]*1e6:.0f}us per match")
+    print(f"Speedup: {per_match['reference']/per_match['fused']:.2f}x "
+        f"over {len(inputs)} matches.")
+
+    mismatches = [(prose, a, b) for (prose, _, _), a, b
+        in zip(inputs, results['reference'], results['fused']) if a != b]
+    for prose, a, b in mismatches[:5]:
+        print(f"MISMATCH for {prose!r}:\n  {a!r}\n  {b!r}")
+    print('Output identical.' if not mismatches else f'{len(mismatches)} MISMATCHES!')
+    if mismatches:
+        sys.exit(1)
+
+CONSENSUSES = [
+    "A charming film that delivers on its promise.",
+    "''The Film'' is a [[tour de force]], with sharp writing and a great cast.",
+    "Funny, sad and touching, this is a crowd-pleaser of the first order.",
+    "Despite a strong performance from its lead, the film never quite comes together.",
+    "Overlong and underwritten, it squanders a talented cast.",
+    "Gorgeously shot but emotionally hollow.",
+]
+
+def _safe_to_add_consensus2_reference(rtmatch, cand, new_text=''):
+    """
+    The previous wikieditor.safe_to_add_consensus2, which strips every
+    text, and the consensus, on every call.
+    """
+    from rapidfuzz.fuzz import partial_ratio
+    consensus, span, text = rtmatch.movie.consensus, rtmatch.span, cand.text
+    if rtmatch.qid != cand.qid:
+        return False
+    if not consensus:
+        return False
+    if len(cand.matches) > 1 and rtmatch.span[0] < text.index('\n=='):
+        return False
+    p_start, p_end = patterns.paragraph_span(rtmatch.span, text)
+    pattern = patterns.someref_re + r"|''.*?''|\{.*?\}|\[[^]]*\||<!--.*?-->|\W"
+    after     = re.sub(pattern, '', text[span[1]: p_end], flags=re.S)
+    new_text  = re.sub(pattern, '', new_text, flags=re.S)
+    before    = re.sub(pattern, '', text[p_start:span[0]], flags=re.S)
+    consensus = re.sub(pattern, '', consensus, flags=re.S)
+    if not consensus:
+        return False
+    return not any(partial_ratio(consensus, t, score_cutoff=60)
+        for t in [after, new_text, before])
+
+def bench_consensus(args):
+    """
+    Decides whether to add the critics consensus for every match in a
+    corpus with wikieditor.safe_to_add_consensus2 and with the reference
+    implementation, checks that the decisions agree, and reports the
+    time per match of each.
+    """
+    import main
+    import wikieditor
+
+    if args.candidates:
+        corpus = [(rtm, cand) for cand in main.loaddata(args.candidates)
+            for rtm in cand.matches if rtm.movie]
+    else:
+        rng = random.Random(args.seed)
+        corpus = flags_corpus(args.size, args.seed)
+        for rtm, cand in corpus:
+            rtm.qid = cand.qid = 'Q42'
+            rtm.movie.consensus = rng.choice(CONSENSUSES)
+            if rng.random() < 0.2:
+                # the consensus is already quoted, perhaps loosely
+                cand.text = cand.text[:-1] + f' Critics agree: "{rng.choice(CONSENSUSES)[:-1]}!"'
+            cand.text += '\n\n== References ==\n'
+    inputs = [(rtm, cand, cand.text[rtm.span[0]:rtm.span[1]]) for rtm, cand in corpus]
+
+    decisions, per_match = {}, {}
+    for name, func in [('reference', _safe_to_add_consensus2_reference),
+            ('cached', wikieditor.safe_to_add_consensus2)]:
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            decisions[name] = [bool(func(rtm, cand, new_text))
+                for rtm, cand, new_text in inputs]
+            times.append(time.perf_counter() - t0)
+        per_match[name] = min(times) / len(inputs)
+        print(f"{name:<10} {per_match[name]*1e6:.0f}us per match")
+    print(f"Speedup: {per_match['reference']/per_match['cached']:.2f}x "
+        f"over {len(inputs)} matches, {sum(decisions['cached'])} safe to add.")
+
+    ok = decisions['reference'] == decisions['cached']
+    print('Decisions identical.' if ok else 'MISMATCH in decisions!')
+    if not ok:
+        sys.exit(1)
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for RottenBot.')
+    subparsers = parser.add_subparsers(title='benchmarks',
+        required=True,
+        metavar='benchmark',)
+
+    parser_scrape = subparsers.add_parser('scrape',
+        help='Scrape every movie in a recorded Rotten Tomatoes archive.')
+    parser_scrape.set_defaults(func=bench_scrape)
+    parser_scrape.add_argument('archive', help="Archive recorded with 'main.py --record-rt'.")
+    parser_scrape.add_argument('-w', '--workers', type=int, default=16,
+        help='Number of concurrent scraping threads.')
+    parser_scrape.add_argument('--latency', type=float, default=0.0,
+        help='Mean latency in seconds to inject into each response.')
+    parser_scrape.add_argument('--error-rate', type=float, default=0.0,
+        help='Probability that a response is an error.')
+    parser_scrape.add_argument('--repeat', type=int, default=1,
+        help='Number of times to scrape each movie.')
+    parser_scrape.add_argument('--seed', type=int, default=0,
+        help='Seed for injected latency and errors.')
+
+    parser_startup = subparsers.add_parser('startup',
+        help='Time the startup of each main.py subcommand.')
+    parser_startup.set_defaults(func=bench_startup)
+    parser_startup.add_argument('--repeat', type=int, default=10,
+        help='Number of runs per subcommand.')
+
+    parser_sparql = subparsers.add_parser('sparql',
+        help='Stream paged query results from a local stand-in query service.')
+    parser_sparql.set_defaults(func=bench_sparql)
+    parser_sparql.add_argument('--items', type=int, default=20000,
+        help='Number of items in the synthetic result set.')
+    parser_sparql.add_argument('--page-size', type=int, default=5000,
+        help='Rows per page.')
+    parser_sparql.add_argument('--error-rate', type=float, default=0.1,
+        help='Probability that a page request fails.')
+    parser_sparql.add_argument('--cut-rate', type=float, default=0.1,
+        help='Probability that a response is cut off.')
+    parser_sparql.add_argument('--latency', type=float, default=0.0,
+        help='Mean latency in seconds to inject into each response.')
+    parser_sparql.add_argument('--seed', type=int, default=0,
+        help='Seed for injected latency and failures.')
+
+    parser_wiki = subparsers.add_parser('wiki',
+        help='Run the Wikidata and Wikipedia edit paths against local stand-in wikis.')
+    parser_wiki.set_defaults(func=bench_wiki)
+    parser_wiki.add_argument('archive', nargs='?',
+        help="Archive recorded with 'main.py --record-rt'; default is a synthetic one.")
+    parser_wiki.add_argument('--items', type=int, default=200,
+        help='Maximum number of Wikidata items to update.')
+    parser_wiki.add_argument('--pages', type=int, default=200,
+        help='Number of Wikipedia pages to edit.')
+    parser_wiki.add_argument('-w', '--workers', type=int, default=wdeditor.SCRAPE_WORKERS,
+        help='Number of concurrent scraping threads.')
+    parser_wiki.add_argument('--put-throttle', type=float, default=0,
+        help="Value for pywikibot's put_throttle, in seconds.")
+    parser_wiki.add_argument('--max-epm', type=float, default=float('inf'),
+        help='Maximum number of edits per minute for uploads; unlimited by default.')
+    parser_wiki.add_argument('--latency', type=float, default=0.0,
+        help='Mean latency in seconds to inject into each API response.')
+    parser_wiki.add_argument('--lag', type=float, default=5.0,
+        help='Replication lag in seconds which the wikis report when lagged.')
+    parser_wiki.add_argument('--lag-rate', type=float, default=0.0,
+        help='Probability that a request sees the wiki lagged.')
+    parser_wiki.add_argument('--seed', type=int, default=0,
+        help='Seed for injected latency and lag.')
+
+    parser_flags = subparsers.add_parser('flags',
+        help='Check and time the flags computed for Rotten Tomatoes matches.')
+    parser_flags.set_defaults(func=bench_flags)
+    parser_flags.add_argument('--candidates',
+        help="Candidates stored with 'main.py store'; default is a synthetic corpus.")
+    parser_flags.add_argument('--size', type=int, default=2000,
+        help='Number of matches in the synthetic corpus.')
+    parser_flags.add_argument('--repeat', type=int, default=3,
+        help='Number of timed runs; the fastest is reported.')
+    parser_flags.add_argument('--seed', type=int, default=0,
+        help='Seed for the synthetic corpus.')
+
+    parser_rewrite = subparsers.add_parser('rewrite',
+        help='Check and time the rewriting of Rotten Tomatoes prose.')
+    parser_rewrite.set_defaults(func=bench_rewrite)
+    parser_rewrite.add_argument('--candidates',
+        help="Candidates stored with 'main.py store'; default is a synthetic corpus.")
+    parser_rewrite.add_argument('--size', type=int, default=2000,
+        help='Number of matches in the synthetic corpus.')
+    parser_rewrite.add_argument('--repeat', type=int, default=3,
+        help='Number of timed runs; the fastest is reported.')
+    parser_rewrite.add_argument('--seed', type=int, default=0,
+        help='Seed for the synthetic corpus.')
+
+    parser_consensus = subparsers.add_parser('consensus',
+        help='Check and time the decision to add the critics consensus.')
+    parser_consensus.set_defaults(func=bench_consensus)
+    parser_consensus.add_argument('--candidates',
+        help="Candidates stored with 'main.py store'; default is a synthetic corpus.")
+    parser_consensus.add_argument('--size', type=int, default=2000,
+        help='Number of matches in the synthetic corpus.')
+    parser_consensus.add_argument('--repeat', type=int, default=3,
+        help='Number of timed runs; the fastest is reported.')
+    parser_consensus.add_argument('--seed', type=int, default=0,
+        help='Seed for the synthetic corpus.')
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -8,26 +8,31 @@ import sys
 import time
 import webbrowser
 
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from dataclasses import dataclass, field
 from itertools import chain
 
-import pywikibot as pwb
 import regex as re
-import wikitextparser as wtp
 
 from colorama import Fore, Style
-from googlesearch import lucky
-from pywikibot import Page, Site, ItemPage
-from pywikibot.xmlreader import XmlDump
 
+import metrics
+import profiling
 import scraper
+import store
 import wdeditor
 
+from lazyimport import lazy_import
 from patterns import *
 
+pwb = lazy_import('pywikibot')
+wtp = lazy_import('wikitextparser')
+
 logger = logging.getLogger(__name__)
 ################################################################################
+CANDIDATE_WORKERS   = 16
+# Pages submitted to the workers ahead of the ones being finished.
+PAGES_IN_FLIGHT     = 64 * CANDIDATE_WORKERS
 
 @dataclass
 class Reference:
@@ -54,78 +59,162 @@ class Candidate:
     An instance of this class should contain all the information necessary
     to make the right edits to Rotten Tomatoes prose (while being as
     concise as possible).
+
+    Once its text is added to the text store with store_text, the text is
+    left out when the Candidate is pickled and is read back from the store
+    the first time it is used.
     """
     title: str           # article title
-    text: str            # wikitext
+    text: str = field(repr=False, compare=False)    # wikitext
     matches: list[RTMatch] = field(default_factory=list)
+    pageid: int = None
+    revid: int = None
+    qid: str = None      # of the item connected to the article
+    sha1: str = None     # of text
+    stored: bool = field(default=False, repr=False, compare=False)
+
+    def store_text(self):
+        self.sha1 = store.get_texts().add(self.text, self.sha1)
+        self.stored = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.stored:
+            state.pop('text', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __getattr__(self, name):
+        # Only reached for the text of an unpickled Candidate.
+        if name != 'text':
+            raise AttributeError(name)
+        try:
+            self.text = store.get_texts().get(self.sha1)
+        except store.MissingTextError as e:
+            raise store.MissingTextError(f'The text of [[{self.title}]] is missing. {e}') from None
+        return self.text
 
-def _init(lock1, lock2, lock3):
+def _init(lock1, lock2):
     """
     To be used with Executor in find_candidates.
     """
-    global WIKIDATA_LOCK
     global GOOGLESEARCH_LOCK
     global WQS_LOCK
-    WIKIDATA_LOCK, GOOGLESEARCH_LOCK, WQS_LOCK = lock1, lock2, lock3
+    GOOGLESEARCH_LOCK, WQS_LOCK = lock1, lock2
+    metrics.reset()
+    profiling.reset()
 
 def find_candidates(xmlfile, get_user_input = False):
     """
     Given an XmlDump, yields all pages (as a Candidate) in the dump
     which match at least one pattern in patterns.
-    """
-    total, count = 0, 0
-    xml_entries = XmlDump(xmlfile).parse()
 
-    WIKIDATA_LOCK = multiprocessing.Lock()
-    GOOGLESEARCH_LOCK = multiprocessing.Lock()
-    WQS_LOCK = multiprocessing.Lock()
-    with ProcessPoolExecutor(max_workers=16,
-            initializer=_init, initargs=(WIKIDATA_LOCK,GOOGLESEARCH_LOCK, WQS_LOCK)) as executor:
-        futures = {executor.submit(candidate_from_entry, e) : e.title for e in xml_entries}
+    Pages are read from the dump as the workers finish them, with at most
+    PAGES_IN_FLIGHT submitted at a time, so candidates are yielded while
+    the dump is still being read.
+    """
+    from pywikibot.xmlreader import XmlDump
 
-        rtid_to_qid = wdeditor.RTID_to_QID()
+    total, count = 0, 0
+    xml_entries = metrics.timed_iter('dump_read', XmlDump(xmlfile).parse())
+    rtid_to_qid = wdeditor.RTID_to_QID()
 
-        for future in as_completed(futures):
+    def finish(future):
+        try:
+            cand, snap, timings = future.result()
+            metrics.merge(snap)
+            profiling.merge(timings)
+            metrics.count('pages')
+            # Now some extra processing, which means finding missing movies
+            # and finding the corresponding QID.
+            # Return only those matches with a Tomatometer score and QID
+            if get_user_input:
+                _ask_for_movies(cand)
+            cand.matches = [x for x in cand.matches if x.movie and x.movie.tomatometer_score]
+
+            # find qid, without user input
+            for rtm in cand.matches:
+                rtm.qid = _find_qid(cand, rtm, rtid_to_qid)
+                # for the future, just in case
+                rtid_to_qid[rtm.movie.short_url] = rtm.qid
+                rtid_to_qid[rtm.initial_rtid]    = rtm.qid
+
+            # find missing qids
+            if get_user_input:
+                _ask_for_qids(cand, rtid_to_qid)
+            cand.matches = [x for x in cand.matches if x.qid]
+        except (SystemExit, KeyboardInterrupt):
+            executor.shutdown(wait=True, cancel_futures=True)
+            logger.exception("SHUTTING DOWN.")
+            print('SHUTTING DOWN due to SystemExit or KeyboardInterrupt.')
+            raise
+        except Exception:
+            executor.shutdown(wait=True, cancel_futures=True)
+            logger.exception("SHUTTING DOWN.")
+            print('SHUTTING DOWN due to an exception.')
+            raise
+        if cand.matches:
+            print(f"Found candidate [[{futures[future]}]].")
+            metrics.count('candidates')
+            # Usually resolved with its batch while the page was submitted.
+            # Otherwise compute_edits resolves it with other candidates.
+            if found := wdeditor.get_sitelinks().peek(cand.title):
+                cand.qid = found[0]
+            cand.store_text()
+            return cand
+
+    def finish_some():
+        nonlocal total, count
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
             total += 1
-            try:
-                cand = future.result()
-                # Now some extra processing, which means finding missing movies
-                # and finding the corresponding QID.
-                # Return only those matches with a Tomatometer score and QID
-                if get_user_input:
-                    _ask_for_movies(cand)
-                cand.matches = [x for x in cand.matches if x.movie and x.movie.tomatometer_score]
-
-                # find qid, without user input
-                for rtm in cand.matches:
-                    rtm.qid = _find_qid(cand, rtm, rtid_to_qid)
-                    # for the future, just in case
-                    rtid_to_qid[rtm.movie.short_url] = rtm.qid
-                    rtid_to_qid[rtm.initial_rtid]    = rtm.qid
-
-                # find missing qids
-                if get_user_input:
-                    _ask_for_qids(cand, rtid_to_qid)
-                cand.matches = [x for x in cand.matches if x.qid]
-            except (SystemExit, KeyboardInterrupt):
-                executor.shutdown(wait=True, cancel_futures=True)
-                logger.exception("SHUTTING DOWN.")
-                print('SHUTTING DOWN due to SystemExit or KeyboardInterrupt.')
-                raise
-            except Exception:
-                executor.shutdown(wait=True, cancel_futures=True)
-                logger.exception("SHUTTING DOWN.")
-                print('SHUTTING DOWN due to an exception.')
-                raise
-            if cand.matches:
-                print(f"Found candidate [[{futures[future]}]].")
+            if cand := finish(future):
                 count += 1
                 yield cand
+            del futures[future]
+
+    GOOGLESEARCH_LOCK = multiprocessing.Lock()
+    WQS_LOCK = multiprocessing.Lock()
+    with ProcessPoolExecutor(max_workers=CANDIDATE_WORKERS,
+            initializer=_init, initargs=(GOOGLESEARCH_LOCK, WQS_LOCK)) as executor:
+        # While submitting pages, resolve the Wikidata items of those
+        # which may be candidates in batches, so that the workers
+        # usually find them in the shared sitelink cache.
+        sitelinks = wdeditor.get_sitelinks()
+        futures, titles = dict(), []
+        for e in xml_entries:
+            futures[executor.submit(_measured_candidate_from_entry, e, profiling.OPTIONS)] = e.title
+            if re.search(prefilter_re, e.text):
+                titles.append(e.title)
+            if len(titles) == wdeditor.PRELOAD_BATCH_SIZE:
+                sitelinks.resolve(titles)
+                titles = []
+            if len(futures) >= PAGES_IN_FLIGHT:
+                yield from finish_some()
+        sitelinks.resolve(titles)
+        while futures:
+            yield from finish_some()
     logger.info(f"Found {count} candidates out of {total} pages")
     print(f"Found {count} candidates out of {total} pages")
 
+def _measured_candidate_from_entry(entry, profile_options=None):
+    """
+    Returns the Candidate for entry, with the metrics and, if profiling,
+    the slowest pages that the worker recorded since its last task.
+    """
+    with profiling.page('candidate_from_entry', entry.title, profile_options) as p:
+        cand = candidate_from_entry(entry)
+        p.size, p.matches = len(entry.text), len(cand.matches)
+    return cand, metrics.drain(), profiling.drain()
+
 def candidate_from_entry(entry):
     title, text = entry.title, entry.text
+    with metrics.timer('prefilter'):
+        prefiltered = re.search(prefilter_re, text)
+    if not prefiltered:
+        return Candidate(title, text)
     # Get allowed refnames.
     # Dictionary maps refname to match object of the citation definition.
     refnames = dict()
@@ -142,12 +231,13 @@ def candidate_from_entry(entry):
     final_re = fr'{template_re}(?:{t_rtprose}|(?:{rt_re+notincurly}|{score_re}){notinref+notincom}((?!</?ref|\n\n|==).)*?(?(rot){score_re}|{rt_re+notincurly})){notincom+notinbadsection}(?:((?!\n\n|==).)*?(?P<refs>{anyrefs_re}{rtref_re}{anyrefs_re2}))?'
     # print(final_re)
 
-    cand = Candidate(title, text)
+    cand = Candidate(title, text, pageid=int(entry.id), revid=int(entry.revisionid))
     previous_end = -9999
     id_set = set()
-    for m in re.finditer(final_re, text, flags=re.S|re.I):
+    for m in metrics.timed_iter('final_re', re.finditer(final_re, text, flags=re.S|re.I)):
         #print(m)
-        span = _find_span(m, title)
+        with metrics.timer('find_span'):
+            span = _find_span(m, title)
         if span[0] < previous_end:
             continue
         previous_end = span[1]
@@ -210,7 +300,7 @@ def _ask_for_movie(cand, rtmatch):
         prompt = 'Enter Rotten Tomatoes ID (or open in [b]rowser, [s]kip, or [q]uit): '
         while not re.fullmatch(r'm/[-a-z0-9_]+', (user_input:=input(prompt)) ):
             if user_input == 'b':
-                webbrowser.open(Page(Site('en','wikipedia'), title).full_url())
+                webbrowser.open(pwb.Page(pwb.Site('en','wikipedia'), title).full_url())
             elif user_input == 's':
                 print(f"Skipping match.")
                 return None
@@ -242,7 +332,7 @@ def _ask_for_qid(cand, rtid):
     prompt = 'Enter QID (or open in [b]rowser, [s]kip, or [q]uit): '
     while not re.fullmatch(r'Q[0-9]+', (user_input:=input(prompt)) ):
         if user_input == 'b':
-            webbrowser.open(Page(Site('en','wikipedia'), cand.title).full_url())
+            webbrowser.open(pwb.Page(pwb.Site('en','wikipedia'), cand.title).full_url())
             webbrowser.open(scraper.rt_url(rtid))
         elif user_input == 's':
             print(f"Skipping match."); return None
@@ -296,16 +386,9 @@ def _find_span(match, title):
     return i, j
 
 def P1258(title):
-    #print(title)
-    with WIKIDATA_LOCK:
-        try:
-            item = ItemPage.fromPage(Page(Site('en','wikipedia'), title))
-        except pwb.exceptions.NoPageError:
-            return None
-        item.get()
-    if rtid_claims := item.claims.get(wdeditor.P_ROTTEN_TOMATOES_ID):
-        if rtid_claims[0].target.startswith('m/'):
-            return rtid_claims[0].target
+    qid, rtids = wdeditor.get_sitelinks().lookup(title)
+    if rtids and rtids[0].startswith('m/'):
+        return rtids[0]
     return None
 
 def _find_citation_and_id(title, m, refnames):
@@ -337,6 +420,7 @@ def _find_citation_and_id(title, m, refnames):
     return ref, movieid.lower()
 
 def googled_id(title):
+    from googlesearch import lucky
     logger.info(f"GOOGLING ID for [[{title}]].")
     with GOOGLESEARCH_LOCK:
         time.sleep(5)      # avoid getting blocked, better safe than sorry
@@ -433,22 +517,22 @@ def _find_qid(cand, rtm, rtid_to_qid):
     if b := rtid_to_qid[rtm.movie.short_url] or rtid_to_qid[rtm.initial_rtid]:
         return b
 
-    try:
-        item = ItemPage.fromPage(Page(Site('en','wikipedia'), cand.title))
-    except pwb.exceptions.NoPageError:
+    qid, rtids = wdeditor.get_sitelinks().lookup(cand.title)
+    if qid is None:
         return None
 
     if rtm.safe_to_guess: # and FilmTypes.has_film_type(item):
-        return item.getID()
+        return qid
 
-    for claim in sorted(item.claims.get(P_ROTTEN_TOMATOES_ID, []),
-            key=lambda c: wdeditor.date_from_claim(c), reverse=True):
+    if rtm.movie.short_url in rtids:
+        return qid
+    for rtid in rtids:
         try:
-            movie = RTmovie(claim.target)
+            movie = scraper.RTmovie(rtid)
         except Exception:
             continue
         if movie.short_url == rtm.movie.short_url:
-            return item.getID()
+            return qid
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,86 @@
+# This module provides an append-only journal of completed work,
+# so that long-running jobs can resume exactly where they stopped.
+################################################################################
+import hashlib
+import json
+import os
+import threading
+import time
+################################################################################
+class Journal:
+    """
+    Append-only journal of JSON records, one per line.
+    Each record is flushed to disk as soon as it is written, so a crash
+    loses at most the record being written; a partial last line left by
+    a crash is discarded when the journal is opened again.
+    The records already in the journal are available as self.records.
+    Safe to use from several threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.records = self._load()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            complete = data.rfind(b'\n') + 1
+            if complete < len(data):
+                f.truncate(complete)
+        return _parse(data[:complete])
+
+    def record(self, **fields):
+        fields.setdefault('time', time.time())
+        line = json.dumps(fields, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _parse(data):
+    return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+def read_records(path):
+    """
+    Returns the complete records of the journal at path without opening
+    it for writing, so that nothing is created or truncated.
+    Returns an empty list if there is no journal.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        data = f.read()
+    return _parse(data[:data.rfind(b'\n') + 1])
+
+def work_key(path, quick=False):
+    """
+    Returns a key for the work file at path, made of its name and a hash
+    of its contents, so that a journal of work on the file is not reused
+    once the file is regenerated.
+    If quick is True, the size and modification time of the file are
+    hashed instead, which suits large files such as dumps.
+    """
+    sha1 = hashlib.sha1()
+    if quick:
+        st = os.stat(path)
+        sha1.update(f'{st.st_size}:{st.st_mtime_ns}'.encode())
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return f'{name}-{sha1.hexdigest()[:12]}'
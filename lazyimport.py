@@ -0,0 +1,34 @@
+# This module lets heavy dependencies be imported only when first used,
+# so that commands which do not need them start quickly.
+################################################################################
+import importlib
+import importlib.util
+import sys
+import types
+################################################################################
+class _LazyModule(types.ModuleType):
+    """
+    Stands in for a module until one of its attributes is first used,
+    and then imports it with importlib.import_module. The import system's
+    per-module locks make that safe from any number of threads, unlike
+    importlib.util.LazyLoader before Python 3.12.3. It also copes with
+    packages such as pywikibot which replace their module in sys.modules.
+    """
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(importlib.import_module(self.__name__), attr, value)
+
+def lazy_import(name):
+    """
+    Returns module name, which is actually imported only when one of
+    its attributes is first accessed.
+    Submodules must be imported normally (inside the functions that use
+    them), since finding a submodule imports its parent package.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    return _LazyModule(name)
@@ -3,25 +3,50 @@ import sys
 import os
 import pickle
 import argparse
+import queue
+import threading
 
 import logging
 import logging.handlers
 logger = logging.getLogger(__name__)
 
-import pywikibot as pwb
-
 import candidates
+import metrics
+import pacing
+import profiling
+import scraper
+import store
+import wdeditor
 import wikieditor
+
+from journal import Journal, read_records, work_key
+from lazyimport import lazy_import
+
+pwb = lazy_import('pywikibot')
 ################################################################################
 def loaddata(file):
+    """
+    Returns the records stored in file: a store.RecordStore, which reads
+    them lazily, or for a file written by an older version, the pickled list.
+    """
+    if store.is_store(file):
+        return store.RecordStore(file)
     with open(file, 'rb') as f:
         data = pickle.load(f)
     return data
 
+def store_records(records, file):
+    """
+    Stores each record in a new store.RecordStore at file as soon as it is
+    produced, so a run which stops partway leaves the records before it.
+    """
+    with store.RecordStore(file, 'w') as records_store:
+        for record in records:
+            records_store.add(record)
+
 def store_candidates(args):
-    data = list(candidates.find_candidates(args.file1, get_user_input=args.interactive))
-    with open(args.file2, 'wb') as f:
-        pickle.dump(data, f)
+    store_records(candidates.find_candidates(args.file1, get_user_input=args.interactive),
+        args.file2)
 
 def store_edits(args):
     if args.file1.endswith('.xml'):
@@ -29,36 +54,377 @@ def store_edits(args):
     else:
         cands = loaddata(args.file1)
 
-    edits = list(wikieditor.compute_edits(cands, get_user_input=args.interactive))
-    with open(args.file2, 'wb') as f:
-        pickle.dump(edits, f)
+    store_records(wikieditor.compute_edits(cands, get_user_input=args.interactive,
+        workers=args.workers, ordered=not args.unordered), args.file2)
+
+# Pages whose texts are fetched with one API request.
+PRELOAD_BATCH = 50
+# Pages prepared ahead of the one being saved.
+SAVE_QUEUE_SIZE = 2
+# Named after the file of edits, or the dump of a run, and a hash of it.
+UPLOAD_JOURNAL_FILE = 'storage/uploads.{work}.jsonl'
+# Outcomes after which a restarted upload leaves a page alone, as long as
+# it is still at the journaled revision. A page whose edits conflicted
+# with its text, or which still has edits waiting on Wikidata ('pending'),
+# is tried again.
+FINISHED_UPLOADS = {'saved', 'unchanged', 'missing'}
+# Candidates and edits buffered between the stages of run.
+RUN_QUEUE_SIZE = 2 * PRELOAD_BATCH
+# FullEdits held back by run until their Wikidata items are written.
+# Beyond this, the oldest are uploaded with their edits still pending.
+RUN_MAX_HELD = 10 * PRELOAD_BATCH
+
+def apply_edits(fulledit, text, written):
+    """
+    Returns text with the uploadable edits of fulledit applied, or None if
+    the text no longer contains a string which an edit replaces. A string
+    which an earlier edit already replaced, such as a list-defined
+    reference shared by several edits, does not count as missing. Nor does
+    an edit which an earlier upload saved while other edits were pending.
+    Edits are uploadable unless they are flagged or wait on a Wikidata
+    item which is not in written.
+    """
+    replaced = set()
+    for edit in sorted(fulledit.edits, key=lambda x: len(x.replacements)):
+        if edit.flags:
+            continue
+        if edit.pending and edit.pending not in written:
+            print(f'Skipping an edit until item {edit.pending} is written.')
+            continue
+        if all(old not in text and new in text for old, new in edit.replacements):
+            replaced.update(old for old, _ in edit.replacements)
+            continue
+
+        for old, new in edit.replacements:
+            if old in replaced:
+                continue
+            if old not in text:
+                return None
+            text = text.replace(old, new)
+            replaced.add(old)
+    return text
+
+def has_pending_edits(fulledit, written):
+    """
+    Returns whether apply_edits skips an edit of fulledit because it waits
+    on a Wikidata item which is not in written.
+    """
+    return any(not edit.flags and edit.pending and edit.pending not in written
+        for edit in fulledit.edits)
+
+class SaveQueue:
+    """
+    Saves pages one at a time in a background thread, paced by a
+    pacing.Pacer, so that the next pages are prepared while one saves.
+    At most SAVE_QUEUE_SIZE pages wait to be saved.
+
+    The outcome of every page is recorded in a journal with the page's
+    title and revision ID: the new revision if it was saved, otherwise
+    the revision the edits were tried against. A page saved while some of
+    its edits were pending is recorded as 'pending' rather than 'saved'.
+    Use finished_uploads to read the journal.
+
+    Use as a context manager. Leaving it normally waits for all queued
+    saves; leaving it with an exception only finishes the current one.
+
+    If dry_run is True, pages are neither saved nor journaled.
+    """
+    def __init__(self, pacer, journal_path, dry_run=False):
+        self.pacer = pacer
+        self.dry_run = dry_run
+        self.journal = None if dry_run else Journal(journal_path)
+        self.queue = queue.Queue(maxsize=SAVE_QUEUE_SIZE)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record(self, page, state):
+        metrics.count(f'upload_{state}')
+        if self.journal is None:
+            return
+        revid = page.latest_revision_id if page.exists() else None
+        self.journal.record(title=page.title(), revid=revid, state=state)
+
+    def submit(self, page, pending=False):
+        """
+        Queues page, whose text has been changed, to be saved.
+        pending tells whether some edits of the page were left out
+        because they are pending.
+        """
+        self.queue.put((page, pending))
+
+    def _run(self):
+        edit_summary = 'Updating Rotten Tomatoes info with Wikidata.'
+        while not self.stop.is_set() and (item := self.queue.get()) is not None:
+            page, pending = item
+            if self.dry_run:
+                print(f'Would save {page.title()}.')
+                continue
+            self.pacer.wait()
+            try:
+                with metrics.timer('save'):
+                    page.save(summary=edit_summary, minor=True, botflag=True,
+                        nocreate=True, quiet=True)
+            except pwb.exceptions.EditConflictError:
+                print(f'{page.title()} was edited while its edits were being uploaded.')
+                self.record(page, 'conflict')
+                continue
+            except Exception as x:
+                self.pacer.failed(x, page.site)
+                logger.exception(f'Failed to save {page.title()}.')
+                print(f'An error occurred while saving {page.title()}')
+                self.record(page, 'failed')
+                continue
+            self.pacer.saved()
+            self.record(page, 'pending' if pending else 'saved')
+
+    def close(self, wait=True):
+        if not wait:
+            self.stop.set()
+            # make room for the sentinel
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+        self.queue.put(None)
+        self.thread.join()
+        if self.journal is not None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(wait=exc_type is None)
+
+def upload_journal_path(file, quick=False):
+    """
+    Returns the default journal path for uploads of the edits in file,
+    or of the edits of a run on the dump file.
+    quick is passed to journal.work_key.
+    """
+    return UPLOAD_JOURNAL_FILE.format(work=work_key(file, quick))
+
+def finished_uploads(journal_path):
+    """
+    Returns a dict mapping each title whose latest outcome in a SaveQueue
+    journal is in FINISHED_UPLOADS to its journaled revision ID.
+    """
+    latest = {r['title']: r for r in read_records(journal_path)}
+    return {title: r['revid'] for title, r in latest.items()
+        if r['state'] in FINISHED_UPLOADS}
+
+def latest_revids(site, titles):
+    """
+    Returns a dict mapping each of up to PRELOAD_BATCH titles to the ID
+    of the latest revision of its page, or None if the page does not
+    exist. Only page info is fetched, not the texts.
+    """
+    request = pwb.data.api.Request(site=site, parameters={
+        'action': 'query', 'prop': 'info', 'titles': titles})
+    pages = request.submit()['query']['pages']
+    if isinstance(pages, dict):
+        pages = pages.values()
+    return {p['title']: p.get('lastrevid') for p in pages}
+
+def page_batches(fulledits, site, finished=None):
+    """
+    Yields dicts mapping up to PRELOAD_BATCH page titles to a pwb.Page and
+    the list of fulledits of that page.
+    Consecutive fulledits of the same page always go in the same batch.
+    Pages which are still at the revision that finished_uploads gave for
+    them in finished are left out, before their texts are fetched.
+    """
+    def unfinished(batch):
+        if titles := [x for x in batch if x in finished]:
+            for title, revid in latest_revids(site, titles).items():
+                if title in batch and finished[title] == revid:
+                    print(f'Skipping {title}, which an earlier upload finished.')
+                    del batch[title]
+        return batch
+
+    finished = finished or {}
+    batch = {}
+    for fulledit in fulledits:
+        page = pwb.Page(site, fulledit.title)
+        title = page.title()
+        if title not in batch and len(batch) == PRELOAD_BATCH:
+            if unfinished(batch):
+                yield batch
+            batch = {}
+        batch.setdefault(title, (page, []))[1].append(fulledit)
+    if unfinished(batch):
+        yield batch
+
+def upload_batch(batch, site, saves, written):
+    """
+    Applies the edits in batch, from page_batches, to the current texts
+    of its pages, and queues the changed pages on saves, a SaveQueue.
+    """
+    # Texts are fetched in batches, and the edits are applied to the
+    # fetched revision, which page.save then reports as the base revision.
+    pages = (page for page, _ in batch.values())
+    for page in site.preloadpages(pages, groupsize=PRELOAD_BATCH):
+        title = page.title()
+        print(f'Editing {title}.')
+        if not page.exists():
+            print(f'Skipping {title}, which no longer exists.')
+            saves.record(page, 'missing')
+            continue
+        fulledits = batch[title][1]
+        text = page.text
+        for fulledit in fulledits:
+            if text is not None:
+                text = apply_edits(fulledit, text, written)
+        if text is None:
+            print(f'Skipping {title}, which has changed since the edits were computed.')
+            saves.record(page, 'conflict')
+            continue
+        pending = any(has_pending_edits(fulledit, written) for fulledit in fulledits)
+        if text == page.text:
+            saves.record(page, 'pending' if pending else 'unchanged')
+            continue
+        page.text = text
+        saves.submit(page, pending)
 
 def upload_edits(args):
+    # The pacer paces saves, in place of pywikibot's fixed put throttle.
+    pwb.config.put_throttle = 0
     site = pwb.Site('en', 'wikipedia')
     site.login(user='RottenBot')
+    pacer = pacing.Pacer(args.max_epm, site)
 
     data = loaddata(args.file)
-    for fulledit in data:
-        print(f'Editing {fulledit.title}.')
-        page = pwb.Page(site, fulledit.title)
-        for edit in sorted(fulledit.edits, key=lambda x: len(x.replacements)):
-            if edit.flags:
-                continue
-
-            for old, new in edit.replacements:
-                page.text = page.text.replace(old, new)
-
-        edit_summary = 'Updating Rotten Tomatoes info with Wikidata.'
+    written = wdeditor.written_items()
+    journal_path = args.journal or upload_journal_path(args.file)
+    finished = finished_uploads(journal_path)
+    if finished:
+        print(f'{len(finished)} pages were finished by earlier uploads of these edits.')
+
+    # Edits are read and uploaded a batch of pages at a time, so memory
+    # stays bounded however many there are.
+    with SaveQueue(pacer, journal_path) as saves:
+        for batch in page_batches(data, site, finished):
+            upload_batch(batch, site, saves, written)
+
+    print(pacer.summary())
+
+def run(args):
+    """
+    Finds candidates in a dump, computes their edits and uploads them,
+    with the three stages running at once and bounded queues between
+    them, so pages are saved while the dump is still being read.
+    A page with edits waiting on Wikidata items is held back until the
+    items are written. Edits are also stored in args.store if it is given.
+    With args.dry_run, neither Wikipedia nor Wikidata is edited.
+    """
+    site = pwb.Site('en', 'wikipedia')
+    if not args.dry_run:
+        # The pacer paces saves, in place of pywikibot's fixed put throttle.
+        pwb.config.put_throttle = 0
+        site.login(user='RottenBot')
+    pacer = pacing.Pacer(args.max_epm, None if args.dry_run else site)
+    # a dump is too large to hash before the first edit
+    journal_path = args.journal or upload_journal_path(args.file, quick=True)
+    finished = finished_uploads(journal_path)
+
+    cands = queue.Queue(maxsize=RUN_QUEUE_SIZE)
+    edits = queue.Queue(maxsize=RUN_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+
+    def queued(q):
+        while (x := wdeditor._get(q, stop)) is not wdeditor._DONE:
+            yield x
+
+    def find_stage():
+        for cand in candidates.find_candidates(args.file):
+            if stop.is_set():
+                return
+            wdeditor._put(cands, cand, stop)
+
+    def edit_stage():
+        records_store = store.RecordStore(args.store, 'w') if args.store else None
         try:
-            page.save(summary=edit_summary, minor=True, botflag=True,
-                nocreate=True, quiet=True)
-            time.sleep(5)
-        except Exception:
-            print(f'An error occurred while saving {fulledit.title}')
-            continue
+            for fulledit in wikieditor.compute_edits(queued(cands),
+                    workers=args.workers, ordered=False, dry_run=args.dry_run):
+                if records_store is not None:
+                    records_store.add(fulledit)
+                if stop.is_set():
+                    return
+                wdeditor._put(edits, fulledit, stop)
+        finally:
+            if records_store is not None:
+                records_store.close()
+
+    def run_stage(stage, downstream):
+        try:
+            stage()
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            wdeditor._put(downstream, wdeditor._DONE, stop)
+
+    threads = [threading.Thread(target=run_stage, args=(find_stage, cands)),
+        threading.Thread(target=run_stage, args=(edit_stage, edits))]
+    for t in threads:
+        t.start()
+
+    # FullEdits with edits waiting on Wikidata items which are not written yet
+    held = []
+    try:
+        with SaveQueue(pacer, journal_path, dry_run=args.dry_run) as saves:
+            while True:
+                # Take whatever has been computed so far, up to one batch,
+                # rather than waiting for a full batch.
+                chunk = [wdeditor._get(edits, stop)]
+                while chunk[-1] is not wdeditor._DONE and len(chunk) < PRELOAD_BATCH:
+                    try:
+                        chunk.append(edits.get_nowait())
+                    except queue.Empty:
+                        break
+                done = chunk[-1] is wdeditor._DONE
+                if done:
+                    chunk.pop()
+                # Wikidata items are written while edits are computed, so
+                # edits waiting on an item are held back until it is. Once
+                # every edit is computed, every write has finished, and
+                # what is still pending is uploaded as such.
+                written = wdeditor.written_items()
+                ready, waiting = [], []
+                for fulledit in held + chunk:
+                    if done or not has_pending_edits(fulledit, written):
+                        ready.append(fulledit)
+                    else:
+                        waiting.append(fulledit)
+                # items which are never written must not hold pages forever
+                if len(waiting) > RUN_MAX_HELD:
+                    ready += waiting[:-RUN_MAX_HELD]
+                    waiting = waiting[-RUN_MAX_HELD:]
+                held = waiting
+                for batch in page_batches(ready, site, finished):
+                    upload_batch(batch, site, saves, written)
+                if done:
+                    break
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    print(pacer.summary())
 
 def print_data(args):
-    print(loaddata(args.file))
+    data = loaddata(args.file)
+    if args.title is not None:
+        data = data.get(args.title) if isinstance(data, store.RecordStore) \
+            else [x for x in data if x.title == args.title]
+    for record in data:
+        print(record)
 
 def listpages(args):
     site = pwb.Site('en','wikipedia')
@@ -74,6 +440,25 @@ See 'https://github.com/winstontsai/RottenBot' for source code and more info."""
         formatter_class=argparse.RawDescriptionHelpFormatter,)
     parser.add_argument('-v', '--verbose', action='count', default=1,
         help='Increase verbosity level.')    
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument('--record-rt', metavar='DIR',
+        help='Save every Rotten Tomatoes response in the archive DIR.')
+    archive.add_argument('--replay-rt', metavar='DIR',
+        help='Serve Rotten Tomatoes responses from the archive DIR instead of the network.')
+    parser.add_argument('--replay-latency', type=float, default=0.0, metavar='SECONDS',
+        help='Mean latency to inject into each replayed response.')
+    parser.add_argument('--replay-error-rate', type=float, default=0.0, metavar='P',
+        help='Probability that a replayed response is an error.')
+    parser.add_argument('--metrics-interval', type=float, default=metrics.EXPORT_INTERVAL,
+        metavar='SECONDS', help=f'Seconds between exports of the metrics to '
+        f'{metrics.METRICS_JSON_FILE} and {metrics.METRICS_PROM_FILE}.')
+    parser.add_argument('--profile', action='store_true',
+        help=f'Time every page and profile a sample of them, and write the slowest '
+        f'pages and the merged profile to {profiling.PROFILE_DIR}.')
+    parser.add_argument('--profile-top', type=int, default=profiling.PROFILE_TOP, metavar='N',
+        help='Number of slowest pages to report when profiling.')
+    parser.add_argument('--profile-sample', type=float, default=profiling.PROFILE_SAMPLE_RATE,
+        metavar='P', help='Probability that a page is profiled with cProfile when profiling.')
 
     subparsers = parser.add_subparsers(title='commands',
         required=True,
@@ -90,18 +475,46 @@ See 'https://github.com/winstontsai/RottenBot' for source code and more info."""
     parser_store.add_argument('file2', help='The file in which to store edits.')
     parser_store.add_argument('-i', '--interactive', action='store_true',
         help='In interactive mode, the user will be asked for their input for certain articles.')
+    parser_store.add_argument('-w', '--workers', type=int, default=wikieditor.EDIT_WORKERS,
+        help='Number of processes computing edits.')
+    parser_store.add_argument('--unordered', action='store_true',
+        help='Store edits in the order they are computed rather than the order of the candidates.')
     
     # parser for uploading
     parser_upload = subparsers.add_parser('upload',
         help='Upload edits from a file to the live wiki.')
     parser_upload.set_defaults(func=upload_edits)
     parser_upload.add_argument('file', help='File from which edits will be uploaded.')
+    parser_upload.add_argument('--journal',
+        help='Journal of finished pages, which a restarted upload skips. '
+        f'Defaults to {UPLOAD_JOURNAL_FILE!r}, named after the file.')
+    parser_upload.add_argument('--max-epm', type=float, default=pacing.MAX_EDITS_PER_MINUTE,
+        help='Maximum number of edits per minute.')
+
+    # parser for running every stage at once
+    parser_run = subparsers.add_parser('run',
+        help='Find candidates, compute edits and upload them in one streaming run.')
+    parser_run.set_defaults(func=run)
+    parser_run.add_argument('file', help="The XML dump of Wikipedia pages to work on.")
+    parser_run.add_argument('-w', '--workers', type=int, default=wikieditor.EDIT_WORKERS,
+        help='Number of processes computing edits.')
+    parser_run.add_argument('--store', metavar='FILE',
+        help='Also store the edits in FILE.')
+    parser_run.add_argument('-n', '--dry-run', action='store_true',
+        help='Prepare the edited pages without saving them.')
+    parser_run.add_argument('--journal',
+        help='Journal of finished pages, which a restarted run skips. '
+        f'Defaults to {UPLOAD_JOURNAL_FILE!r}, named after the dump.')
+    parser_run.add_argument('--max-epm', type=float, default=pacing.MAX_EDITS_PER_MINUTE,
+        help='Maximum number of edits per minute.')
 
     # parser for printing stored data
     parser_print = subparsers.add_parser('print',
-        help='Print the pickled data from a file.')
+        help='Print the stored data from a file.')
     parser_print.set_defaults(func=print_data)
     parser_print.add_argument('file', help = 'File in which the data is stored.')
+    parser_print.add_argument('-t', '--title',
+        help='Print only the records of this article.')
 
     # parser for listing articles in a category
     parser_list = subparsers.add_parser('listpages',
@@ -142,10 +555,20 @@ def main():
     t0 = time.perf_counter()
 
     args = get_args()
+    if args.record_rt:
+        scraper.use_archive('record', args.record_rt)
+    elif args.replay_rt:
+        scraper.use_archive('replay', args.replay_rt,
+            latency=args.replay_latency, error_rate=args.replay_error_rate)
+    if args.profile:
+        profiling.enable(top=args.profile_top, sample_rate=args.profile_sample)
     try:
-        args.func(args)
+        with metrics.Exporter(args.metrics_interval):
+            args.func(args)
     except SystemExit:
         pass
+    finally:
+        profiling.report()
 
     t1 = time.perf_counter()
     logger.info(f"TIME ELAPSED = {t1-t0}")
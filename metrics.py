@@ -0,0 +1,202 @@
+# This module counts what each stage of a run does and how long it takes.
+# Worker processes keep their own metrics, which the parent process merges
+# with merge(drain()) from the workers' results. Pool initializers call
+# reset(), so that forked workers do not send back the parent's metrics.
+# The totals are exported as a JSON summary and as a Prometheus textfile.
+################################################################################
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+################################################################################
+METRICS_JSON_FILE       = 'logs/metrics.json'
+METRICS_PROM_FILE       = 'logs/rottenbot.prom'
+EXPORT_INTERVAL         = 60    # seconds between exports during a run
+PROM_PREFIX             = 'rottenbot_'
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5, 10, 60, math.inf)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}    # name -> [bucket counts, count, sum]
+
+def count(name, n=1):
+    """
+    Adds n to the counter name.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def observe(name, seconds):
+    """
+    Records a latency of seconds in the histogram name.
+    """
+    i = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        h = _histograms.get(name)
+        if h is None:
+            h = _histograms[name] = [[0] * len(BUCKETS), 0, 0.0]
+        h[0][i] += 1
+        h[1] += 1
+        h[2] += seconds
+
+@contextmanager
+def timer(name):
+    """
+    Records the time spent in the with block in the histogram name,
+    whether or not it raises.
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0)
+
+def timed_iter(name, iterable):
+    """
+    Yields the items of iterable, recording the time taken to produce
+    each one in the histogram name.
+    """
+    it = iter(iterable)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            x = next(it)
+        except StopIteration:
+            return
+        observe(name, time.perf_counter() - t0)
+        yield x
+
+def reset():
+    """
+    Forgets the metrics of this process. A forked worker process must call
+    this first, since it inherits the metrics of its parent, and possibly
+    the lock held by another of the parent's threads.
+    """
+    global _lock
+    _lock = threading.Lock()
+    _counters.clear()
+    _histograms.clear()
+
+def snapshot():
+    """
+    Returns a copy of the metrics of this process, as plain data.
+    """
+    with _lock:
+        return {'counters': dict(_counters),
+            'histograms': {name: [list(b), n, s] for name, (b, n, s) in _histograms.items()}}
+
+def drain():
+    """
+    Returns the snapshot of this process and resets its metrics.
+    Workers return this with their results, for the parent to merge.
+    """
+    with _lock:
+        snap = {'counters': dict(_counters), 'histograms': dict(_histograms)}
+        _counters.clear()
+        _histograms.clear()
+    return snap
+
+def merge(snap):
+    """
+    Adds a snapshot from another process to the metrics of this one.
+    """
+    with _lock:
+        for name, n in snap['counters'].items():
+            _counters[name] = _counters.get(name, 0) + n
+        for name, (b, n, s) in snap['histograms'].items():
+            h = _histograms.get(name)
+            if h is None:
+                h = _histograms[name] = [[0] * len(BUCKETS), 0, 0.0]
+            h[0] = [x + y for x, y in zip(h[0], b)]
+            h[1] += n
+            h[2] += s
+
+def summary(snap=None):
+    """
+    Returns a JSON-serializable summary of a snapshot, by default of
+    this process, with the count, total and mean seconds of each histogram.
+    """
+    snap = snap or snapshot()
+    histograms = {}
+    for name, (b, n, s) in sorted(snap['histograms'].items()):
+        histograms[name] = {'count': n, 'seconds': s, 'mean': s / n if n else 0,
+            'buckets': {str(le): c for le, c in zip(BUCKETS, b)}}
+    return {'time': time.time(), 'counters': dict(sorted(snap['counters'].items())),
+        'histograms': histograms}
+
+def prometheus_text(snap=None):
+    """
+    Returns a snapshot, by default of this process, in the Prometheus
+    text exposition format.
+    """
+    snap = snap or snapshot()
+    lines = []
+    for name, n in sorted(snap['counters'].items()):
+        metric = f'{PROM_PREFIX}{name}_total'
+        lines += [f'# TYPE {metric} counter', f'{metric} {n}']
+    for name, (b, n, s) in sorted(snap['histograms'].items()):
+        metric = f'{PROM_PREFIX}{name}_seconds'
+        lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for le, c in zip(BUCKETS, b):
+            cumulative += c
+            le = '+Inf' if le == math.inf else repr(le)
+            lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+        lines += [f'{metric}_sum {s}', f'{metric}_count {n}']
+    return '\n'.join(lines) + '\n'
+
+def _write(path, text):
+    # Written to a temporary file and renamed, so readers such as
+    # node_exporter never see a partial file.
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def export(json_path=METRICS_JSON_FILE, prom_path=METRICS_PROM_FILE):
+    """
+    Writes the metrics of this process to json_path and prom_path.
+    """
+    snap = snapshot()
+    _write(json_path, json.dumps(summary(snap), indent=2) + '\n')
+    _write(prom_path, prometheus_text(snap))
+
+class Exporter:
+    """
+    Exports the metrics every interval seconds in a background thread,
+    and once more when closed. Use as a context manager.
+    """
+    def __init__(self, interval=EXPORT_INTERVAL, json_path=METRICS_JSON_FILE,
+            prom_path=METRICS_PROM_FILE):
+        self.interval = interval
+        self.paths = (json_path, prom_path)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            try:
+                export(*self.paths)
+            except Exception:
+                logger.exception('Could not export metrics.')
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        export(*self.paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
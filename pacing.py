@@ -0,0 +1,133 @@
+# This module paces edits to a wiki, as fast as policy allows while the
+# servers are healthy, and backing off when they are not.
+################################################################################
+import logging
+import time
+
+from lazyimport import lazy_import
+
+pwb = lazy_import('pywikibot')
+
+logger = logging.getLogger(__name__)
+################################################################################
+MAX_EDITS_PER_MINUTE    = 12    # the bot's approved rate
+MIN_EDITS_PER_MINUTE    = 1
+RATE_INCREASE           = 1     # edits per minute added after a healthy save
+RATE_DECREASE           = 0.5   # factor applied on a sign of load
+# Replication lag, in seconds, above which saves slow down.
+# Requests themselves set pywikibot's config.maxlag.
+LAG_THRESHOLD           = 3
+LAG_CHECK_INTERVAL      = 60    # seconds between lag checks
+# A save taking longer than this, in seconds, is a sign of load.
+# pywikibot waits out maxlag errors inside page.save, so they show up here.
+SLOW_SAVE               = 10
+
+def replication_lag(site):
+    """
+    Returns the replication lag in seconds which a site reports.
+    """
+    request = pwb.data.api.Request(site=site, parameters={
+        'action': 'query', 'meta': 'siteinfo', 'siprop': 'dbrepllag'})
+    return float(request.submit()['query']['dbrepllag'][0]['lag'])
+
+def retry_after(error, site=None):
+    """
+    Returns the delay in seconds which a failed request asked for with a
+    Retry-After header, or None.
+    The header is read from the response carried by error, or by an
+    exception it was raised from, as requests' exceptions carry theirs.
+    pywikibot's own exceptions carry none, so only then is the header
+    which pywikibot stores in site.throttle.retry_after used; that is the
+    header of the latest response from site, not necessarily error's.
+    """
+    while error is not None:
+        if (response := getattr(error, 'response', None)) is not None:
+            delay = response.headers.get('Retry-After', '')
+            return (int(delay) or None) if delay.isdigit() else None
+        error = error.__cause__ or error.__context__
+    delay = getattr(getattr(site, 'throttle', None), 'retry_after', 0)
+    return delay or None
+
+class Pacer:
+    """
+    Paces saves with additive increase and multiplicative decrease.
+    The rate starts at max_epm edits per minute and goes up by
+    RATE_INCREASE after each healthy save, up to max_epm. It is cut by
+    RATE_DECREASE after a slow save, a failed save that hit maxlag or
+    asked to retry later, or when the site reports replication lag above
+    LAG_THRESHOLD, which is checked every LAG_CHECK_INTERVAL seconds if
+    a site is given.
+
+    Call wait() before each save, then saved() or failed().
+    """
+    def __init__(self, max_epm=MAX_EDITS_PER_MINUTE, site=None):
+        self.max_epm = max_epm
+        self.epm = max_epm
+        self.site = site
+        self.start = time.monotonic()
+        self.last_save = None
+        self.last_lag_check = None
+        self.not_before = 0     # set by Retry-After
+        self.saves = 0
+        self.failures = 0
+        self.backoffs = 0
+
+    def backoff(self, reason):
+        self.epm = max(self.epm * RATE_DECREASE, MIN_EDITS_PER_MINUTE)
+        self.backoffs += 1
+        logger.info(f'Slowing down to {self.epm:.1f} edits per minute: {reason}.')
+
+    def _check_lag(self):
+        now = time.monotonic()
+        if self.last_lag_check is not None and now - self.last_lag_check < LAG_CHECK_INTERVAL:
+            return
+        self.last_lag_check = now
+        try:
+            lag = replication_lag(self.site)
+        except Exception:
+            logger.exception('Could not check replication lag.')
+            return
+        if lag > LAG_THRESHOLD:
+            self.backoff(f'{lag:.0f} seconds of replication lag')
+
+    def wait(self):
+        """
+        Sleeps until the next save is due.
+        """
+        if self.site is not None:
+            self._check_lag()
+        due = self.not_before
+        if self.last_save is not None:
+            due = max(due, self.last_save + 60 / self.epm)
+        if (delay := due - time.monotonic()) > 0:
+            time.sleep(delay)
+        self.last_save = time.monotonic()
+
+    def saved(self):
+        """
+        Records a successful save, which started at the last wait().
+        """
+        self.saves += 1
+        latency = time.monotonic() - self.last_save
+        if latency > SLOW_SAVE:
+            self.backoff(f'a save took {latency:.0f} seconds')
+        else:
+            self.epm = min(self.epm + RATE_INCREASE, self.max_epm)
+
+    def failed(self, error, site=None):
+        """
+        Records a save to site (by default self.site) which failed with error.
+        """
+        self.failures += 1
+        if (delay := retry_after(error, site or self.site)) is not None:
+            self.not_before = time.monotonic() + delay
+            self.backoff(f'asked to retry after {delay} seconds')
+        elif isinstance(error, pwb.exceptions.MaxlagTimeoutError):
+            self.backoff('the servers stayed lagged')
+
+    def summary(self):
+        minutes = (time.monotonic() - self.start) / 60
+        rate = self.saves / minutes if minutes else 0
+        return (f'Saved {self.saves} pages in {minutes:.1f} minutes '
+            f'({rate:.1f} edits per minute), '
+            f'{self.failures} failed saves, {self.backoffs} slowdowns.')
@@ -100,14 +100,18 @@ def parse_template(template):
             counter += 1
     return (pieces[0], d)
 
+def _is_positional(k):
+    # same as re.fullmatch(r"[1-9][0-9]*", k), which is slow in a hot loop
+    return k.isascii() and k.isdigit() and k[0] != '0'
+
 def construct_template(name, d):
     positional = ''
     named = ''
     for k, v in sorted(d.items()):
-        if re.fullmatch(r"[1-9][0-9]*", k):
+        if _is_positional(k):
             positional += f"|{v}"
     for k, v in d.items():
-        if not re.fullmatch(r"[1-9][0-9]*", k):
+        if not _is_positional(k):
             named += f"|{k}={v}"
     return '{{' + name + positional + named + '}}'
 
@@ -178,6 +182,10 @@ def section(name):
     return r'(?<=\n)={2,} *' + fr'(?i:{name})' + r' *={2,}'
 notinbadsection = fr"(?<!{section('(?:references(?: and notes)?|notes(?: and references)?|external links|see also|further reading)')}((?!\n==).)*)"
 
+# Every page matched by candidates.final_re also matches this much cheaper pattern.
+# Case is ignored throughout, as final_re is used with re.I.
+prefilter_re = r'(?i:rotten ?tomato|\{\{\s*rt\b)'
+
 template_re = r'(?(DEFINE)(?P<template>\{(?:[^}{]|(?&template))*\}))'
 notincurly = r'(?!((?!\n\n)[^}{]|(?&template))*\})' # i.e. not in template
 notincom = r'(?!((?!<!--|\n\n).)*-->)'
@@ -0,0 +1,151 @@
+# This module provides opt-in profiling of the per-page work of a run.
+# It records the wall and CPU time of each page, keeps the slowest ones,
+# and profiles a sample of pages with cProfile in every process.
+# Worker processes return their slowest pages with drain() for the parent
+# to merge. Their cProfile stats go to files, which report() merges.
+# Pool initializers call reset(), so that forked workers start afresh.
+################################################################################
+import cProfile
+import glob
+import heapq
+import io
+import logging
+import multiprocessing.util
+import os
+import pstats
+import random
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+################################################################################
+PROFILE_DIR         = 'logs/profile'
+PROFILE_TOP         = 50
+PROFILE_SAMPLE_RATE = 0.01  # fraction of pages profiled with cProfile
+PROFILE_STATS_LINES = 40    # functions listed in the merged cProfile report
+PROFILE_DUMP_EVERY  = 20    # profiled pages between writes of a process's stats
+
+ProfileOptions = namedtuple('ProfileOptions', 'top sample_rate directory')
+PageTiming = namedtuple('PageTiming', 'wall cpu stage title size matches')
+
+# Set by enable() in the parent process. Workers get it as an argument
+# of each task, since they may not share the parent's globals.
+OPTIONS = None
+
+_slowest = []       # heap of the slowest PageTimings in this process
+_profiler = None
+_unsaved = 0        # pages profiled since the stats were last written
+_directory = None   # where the stats of this process are written
+
+class _Page:
+    size = matches = None
+
+def enable(top=PROFILE_TOP, sample_rate=PROFILE_SAMPLE_RATE, directory=PROFILE_DIR):
+    global OPTIONS
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, 'worker-*.prof')):
+        os.remove(path)
+    OPTIONS = ProfileOptions(top, sample_rate, directory)
+
+def reset():
+    """
+    Forgets the slowest pages and the profile of this process, and makes
+    sure its stats are written when it exits. A forked worker process must
+    call this first, since it inherits the state of its parent.
+    """
+    global _profiler, _unsaved, _directory
+    _slowest.clear()
+    _profiler, _unsaved, _directory = None, 0, None
+    multiprocessing.util.Finalize(None, _dump, exitpriority=0)
+
+def _dump():
+    global _unsaved
+    if _profiler is not None and _unsaved:
+        _profiler.dump_stats(os.path.join(_directory, f'worker-{os.getpid()}.prof'))
+        _unsaved = 0
+
+def _keep(timing, top):
+    if len(_slowest) < top:
+        heapq.heappush(_slowest, timing)
+    else:
+        heapq.heappushpop(_slowest, timing)
+
+@contextmanager
+def page(stage, title, options=None):
+    """
+    Times the with block, which works on the page title in stage, if
+    options (by default OPTIONS) is set. The block should set the size
+    and matches of the page on the object it gets.
+    A sample of pages is also profiled with cProfile, and the stats of
+    each process are written to a file in options.directory every
+    PROFILE_DUMP_EVERY profiled pages, and when the process exits.
+    """
+    global _profiler, _unsaved, _directory
+    options = options or OPTIONS
+    p = _Page()
+    if options is None:
+        yield p
+        return
+    profiler = None
+    if random.random() < options.sample_rate:
+        if _profiler is None:
+            _profiler = cProfile.Profile()
+        profiler = _profiler
+        profiler.enable()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield p
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if profiler is not None:
+            profiler.disable()
+            _unsaved, _directory = _unsaved + 1, options.directory
+            if _unsaved >= PROFILE_DUMP_EVERY:
+                _dump()
+        _keep(PageTiming(wall, cpu, stage, title, p.size, p.matches), options.top)
+
+def drain():
+    """
+    Returns the slowest pages of this process and forgets them.
+    Workers return this with their results, for the parent to merge.
+    """
+    slowest = _slowest[:]
+    _slowest.clear()
+    return slowest
+
+def merge(timings):
+    if OPTIONS is None:
+        return
+    for timing in timings:
+        _keep(PageTiming(*timing), OPTIONS.top)
+
+def report():
+    """
+    Writes the slowest pages to slow_pages.txt and the merged cProfile
+    stats of all processes to profile.prof and profile.txt in the
+    profile directory.
+    """
+    if OPTIONS is None:
+        return
+    directory = OPTIONS.directory
+    _dump()
+    with open(os.path.join(directory, 'slow_pages.txt'), 'w', encoding='utf-8') as f:
+        print(f"{'wall':>9} {'cpu':>9} {'size':>8} {'matches':>7}  stage  title", file=f)
+        for t in sorted(_slowest, reverse=True):
+            print(f'{t.wall:9.3f} {t.cpu:9.3f} {t.size or 0:8} {t.matches or 0:7}  '
+                f'{t.stage}  {t.title}', file=f)
+    logger.info(f'Wrote the {len(_slowest)} slowest pages to {directory}/slow_pages.txt.')
+
+    paths = glob.glob(os.path.join(directory, 'worker-*.prof'))
+    if not paths:
+        return
+    stats = pstats.Stats(*paths)
+    stats.dump_stats(os.path.join(directory, 'profile.prof'))
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+    with open(os.path.join(directory, 'profile.txt'), 'w', encoding='utf-8') as f:
+        f.write(out.getvalue())
+    logger.info(f'Merged the cProfile stats of {len(paths)} processes into {directory}/profile.prof.')
@@ -0,0 +1,123 @@
+# This module decides which Wikidata film items to refresh first.
+# Items are ranked by how much their Rotten Tomatoes data is expected to have
+# changed since it was last recorded, so that a fixed daily budget of scrapes
+# and edits goes where the values actually move.
+################################################################################
+import argparse
+import json
+import logging
+import re
+
+from dataclasses import dataclass
+from datetime import date
+
+import wdeditor
+
+logger = logging.getLogger(__name__)
+################################################################################
+WORK_QUEUE_FILE         = 'storage/film_items_to_update.json'
+
+# Prior for the review count growth of a film without enough history,
+# in reviews per day. It decays with the film's age in days.
+PRIOR_REVIEWS_PER_DAY   = 2.0
+PRIOR_DECAY_DAYS        = 60
+# Floor so that even the oldest films are refreshed eventually.
+MIN_REVIEWS_PER_DAY     = 0.002
+# How many new reviews one point of expected score movement is worth.
+SCORE_POINT_WEIGHT      = 5.0
+# Priority of items without any Tomatometer data on Wikidata.
+NO_DATA_PRIORITY        = float('inf')
+
+@dataclass
+class ScorePoint:
+    date: date
+    score: int
+    count: int
+
+def score_history(film):
+    """
+    Returns the dated Tomatometer scores of a wdeditor.FilmScores,
+    oldest first.
+    """
+    points = []
+    for st in film.statements.values():
+        if st['method'] != wdeditor.Q_TOMATOMETER or not st['count']:
+            continue
+        # unknown dates come back as blank node IRIs, which are skipped
+        if not (day := wdeditor._wqs_date(st['date']) or wdeditor._wqs_date(st['retrieved'])):
+            continue
+        if not (m := re.fullmatch(r'(\d+)(?:%| percent)', st['value'])):
+            continue
+        points.append(ScorePoint(day, int(m[1]),
+            int(float(st['count']))))
+    return sorted(points, key=lambda p: p.date)
+
+def expected_change(film, today=None):
+    """
+    Returns the expected amount of change in the Rotten Tomatoes data of
+    a film since it was last recorded on Wikidata, measured in reviews.
+
+    The review rate is the growth of the review count between the recorded
+    scores, or a prior based on the release date when there is not enough
+    history. The score rate is the average movement of the score per day
+    between recorded scores. Both are multiplied by the days since the
+    latest recorded score.
+    """
+    today = today or date.today()
+    history = score_history(film)
+    if not history:
+        return NO_DATA_PRIORITY
+    latest = history[-1]
+    stale_days = max((today - latest.date).days, 0)
+
+    age_days = (today - film.released).days if film.released else 365 * 50
+    review_rate = PRIOR_REVIEWS_PER_DAY / (1 + max(age_days, 0) / PRIOR_DECAY_DAYS)
+    score_rate = 0.0
+    spans = [(a, b) for a, b in zip(history, history[1:]) if b.date > a.date]
+    if spans:
+        first = history[0]
+        if (days := (latest.date - first.date).days) > 0:
+            observed = max(latest.count - first.count, 0) / days
+            # trust observed growth more the longer it was observed
+            weight = min(days / 90, 1.0)
+            review_rate = weight * observed + (1 - weight) * review_rate
+        score_rate = sum(abs(b.score - a.score) / (b.date - a.date).days
+            for a, b in spans) / len(spans)
+
+    review_rate = max(review_rate, MIN_REVIEWS_PER_DAY)
+    return stale_days * (review_rate + SCORE_POINT_WEIGHT * score_rate)
+
+def rank_items(films=None, budget=None, today=None):
+    """
+    Returns a list of (qid, rtid, priority) triples, highest priority first,
+    for the films in a dict as returned by wdeditor.scores_on_wikidata.
+    If budget is given, only that many items are returned.
+    """
+    if films is None:
+        films = wdeditor.scores_on_wikidata()
+    ranked = sorted(((qid, min(film.rtids), expected_change(film, today))
+        for qid, film in films.items()), key=lambda x: x[2], reverse=True)
+    return ranked[:budget] if budget is not None else ranked
+
+def write_work_queue(ranked, file=WORK_QUEUE_FILE):
+    """
+    Writes ranked items as the list of [qid, rtid] pairs which
+    wdeditor.update_film_items consumes, in priority order.
+    """
+    with open(file, 'w') as f:
+        json.dump([[qid, rtid] for qid, rtid, _ in ranked], f)
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Rank film items by expected Rotten Tomatoes data change.')
+    parser.add_argument('-b', '--budget', type=int,
+        help='Number of items to put in the work queue.')
+    parser.add_argument('-o', '--output', default=WORK_QUEUE_FILE,
+        help='File in which to write the work queue.')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    ranked = rank_items(budget=args.budget)
+    write_work_queue(ranked, args.output)
+    print(f'Wrote {len(ranked)} items to {args.output}.')
@@ -1,16 +1,24 @@
 # This module is for scraping rottentomatoes.com.
 ################################################################################
+import gzip
+import hashlib
 import json
 import logging
+import os
+import random
 import re
 import sys
+import time
 
 from dataclasses import dataclass, field
 from datetime import date
 
-import requests
+import metrics
 
-from bs4 import BeautifulSoup
+from lazyimport import lazy_import
+
+bs4 = lazy_import('bs4')
+requests = lazy_import('requests')
 
 logger = logging.getLogger(__name__)
 ################################################################################
@@ -32,12 +40,87 @@ RT_HEADERS = {
     # 'Sec-GPC': '1',
 }
 
+# Record/replay of Rotten Tomatoes responses, so that the scraping path
+# can be benchmarked offline. Configure with use_archive() before any worker
+# processes are started; forked workers inherit the settings.
+ARCHIVE_MODE        = None  # None, 'record' or 'replay'
+ARCHIVE_DIR         = None
+REPLAY_LATENCY      = 0.0   # mean injected latency in seconds
+REPLAY_ERROR_RATE   = 0.0   # probability of an injected error response
+REPLAY_ERROR_STATUS = 504
+_replay_random = random.Random()
+
 def rt_url(movieid):
     return "https://www.rottentomatoes.com/" + movieid
 
+def use_archive(mode, directory, latency=0.0, error_rate=0.0, seed=None):
+    """
+    Record every response from rottentomatoes.com into directory
+    (mode 'record'), or serve responses from directory instead of the
+    network (mode 'replay'). In replay mode, latency is the mean of an
+    exponentially distributed delay added to each response, and error_rate
+    is the probability that a response is replaced by a 504 error.
+    """
+    global ARCHIVE_MODE, ARCHIVE_DIR, REPLAY_LATENCY, REPLAY_ERROR_RATE
+    if mode not in ('record', 'replay'):
+        raise ValueError(f"Unknown archive mode {mode!r}.")
+    if mode == 'record':
+        os.makedirs(directory, exist_ok=True)
+    elif not os.path.isdir(directory):
+        raise FileNotFoundError(f"No archive at {directory}.")
+    ARCHIVE_MODE, ARCHIVE_DIR = mode, directory
+    REPLAY_LATENCY, REPLAY_ERROR_RATE = latency, error_rate
+    _replay_random.seed(seed)
+
+def _archive_path(url):
+    name = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(ARCHIVE_DIR, name + '.json.gz')
+
+def _record_response(url, r):
+    path = _archive_path(url)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+        json.dump({'url': url, 'status': r.status_code, 'text': r.text}, f)
+    os.replace(tmp, path)   # atomic, so concurrent workers are safe
+
+def _replayed_response(url):
+    if REPLAY_LATENCY:
+        time.sleep(_replay_random.expovariate(1 / REPLAY_LATENCY))
+    r = requests.Response()
+    r.url = url
+    if REPLAY_ERROR_RATE and _replay_random.random() < REPLAY_ERROR_RATE:
+        r.status_code = REPLAY_ERROR_STATUS
+        return r
+    try:
+        with gzip.open(_archive_path(url), 'rt', encoding='utf-8') as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        logger.warning("%s is not in the archive", url)
+        r.status_code = 404
+        return r
+    r.status_code = record['status']
+    r.encoding = 'utf-8'
+    r._content = record['text'].encode('utf-8')
+    return r
+
+def archived_urls(directory):
+    """
+    Yields the URL of every response recorded in directory.
+    """
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json.gz'):
+            with gzip.open(os.path.join(directory, name), 'rt', encoding='utf-8') as f:
+                yield json.load(f)['url']
+
 def url_contents(url):
     logger.debug("Scraping %s", url)
-    r = requests.get(url, headers=RT_HEADERS)
+    with metrics.timer('rt_scrape'):
+        if ARCHIVE_MODE == 'replay':
+            r = _replayed_response(url)
+        else:
+            r = requests.get(url, headers=RT_HEADERS)
+    if ARCHIVE_MODE == 'record':
+        _record_response(url, r)
     if r.status_code != 200:
         r.raise_for_status()
     return r.text
@@ -115,7 +198,7 @@ class RTmovie:
             logger.exception("Too many redirects for %s", self.short_url)
             raise
 
-        soup = BeautifulSoup(html, "html.parser")
+        soup = bs4.BeautifulSoup(html, "html.parser")
         self.url = str(soup.find('link', rel='canonical')['href'])
         self.short_url = self.url.split('rottentomatoes.com/')[-1]
         self.access_date = date.today().strftime("%B %d, %Y")
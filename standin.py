@@ -0,0 +1,895 @@
+# This module provides local stand-ins for the remote services RottenBot
+# talks to, so that its network code can be exercised and benchmarked offline.
+################################################################################
+import copy
+import csv
+import hashlib
+import html
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+################################################################################
+class StandinServer:
+    """
+    Base class for a local HTTP server running in a background thread.
+    Subclasses implement handle(request), where request is the
+    BaseHTTPRequestHandler of the current request.
+    Use as a context manager; the endpoint attribute is the server's URL.
+    """
+    path = '/'
+
+    def __init__(self, latency=0.0, seed=None):
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                standin._handle(self)
+
+            def do_POST(self):
+                standin._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        host, port = self.server.server_address
+        self.endpoint = f'http://{host}:{port}{self.path}'
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, request):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            with self.lock:
+                delay = self.random.expovariate(1 / self.latency)
+            time.sleep(delay)
+        self.handle(request)
+
+    def chance(self, p):
+        with self.lock:
+            return self.random.random() < p
+
+    @staticmethod
+    def params(request):
+        """
+        Returns the query string and form parameters of request as a dict.
+        """
+        params = parse_qs(urlparse(request.path).query)
+        if request.command == 'POST':
+            length = int(request.headers.get('Content-Length', 0))
+            params.update(parse_qs(request.rfile.read(length).decode()))
+        return {k: v[-1] for k, v in params.items()}
+
+    @staticmethod
+    def respond(request, status, body, content_type, headers=()):
+        data = body.encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(data)))
+        for k, v in headers:
+            request.send_header(k, v)
+        request.end_headers()
+        request.wfile.write(data)
+
+class SparqlStandin(StandinServer):
+    """
+    Imitates the Wikidata Query Service for the paged queries made by
+    wdeditor.iter_results. It serves a fixed list of rows (dicts mapping
+    variable names to values) and only understands the keyset FILTER,
+    ORDER BY and LIMIT of those queries, and the COUNT of the rows of one
+    key value; the rest of the query is ignored.
+
+    error_rate is the probability that a request fails with a 503 (with
+    a Retry-After header of 0). cut_rate is the probability that a
+    response is cut off, as happens when the real service times out
+    mid-stream: a third of the cuts are at a random byte, a third at the
+    end of a row and a third at the end of the header, which leave a
+    response that looks complete.
+    """
+    path = '/sparql'
+
+    def __init__(self, rows, error_rate=0.0, cut_rate=0.0, latency=0.0, seed=None):
+        super().__init__(latency=latency, seed=seed)
+        self.rows = rows
+        self.variables = list(dict.fromkeys(k for row in rows for k in row))
+        self.error_rate = error_rate
+        self.cut_rate = cut_rate
+
+    def handle(self, request):
+        query = self.params(request).get('query', '')
+        if self.chance(self.error_rate):
+            self.respond(request, 503, 'Service Unavailable', 'text/plain',
+                headers=[('Retry-After', '0')])
+            return
+
+        key, op, value = re.search(r'FILTER\(STR\(\?(\w+)\) ([>=]) "([^"]*)"\)', query).groups()
+        if op == '=':
+            count = sum(str(row[key]) == value for row in self.rows)
+            variables, page = ['count'], [{'count': count}]
+        else:
+            limit = int(re.search(r'LIMIT (\d+)', query)[1])
+            variables = self.variables
+            page = sorted((row for row in self.rows if str(row[key]) > value),
+                key=lambda row: str(row[key]))[:limit]
+
+        f = io.StringIO(newline='')
+        writer = csv.writer(f)
+        writer.writerow(variables)
+        ends = [len(f.getvalue().encode('utf-8'))]
+        for row in page:
+            writer.writerow(row.get(v, '') for v in variables)
+            ends.append(len(f.getvalue().encode('utf-8')))
+        body = f.getvalue().encode('utf-8')
+
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/csv; charset=utf-8')
+        if self.chance(self.cut_rate):
+            # No Content-Length, so the client only sees the connection close.
+            request.send_header('Connection', 'close')
+            request.end_headers()
+            with self.lock:
+                cut = self.random.choice([self.random.randrange(len(body)),
+                    self.random.choice(ends[1:-1] or ends), ends[0]])
+            request.wfile.write(body[:cut])
+            request.close_connection = True
+            return
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+def _flags(*names):
+    # API format version 1 marks true flags with an empty string.
+    return dict.fromkeys(names, '')
+
+def _param(name, type='string', multi=False, limit=False, **extra):
+    param = dict(name=name, type=type, **extra)
+    if multi:
+        param.update(_flags('multi'), limit=50, lowlimit=50, highlimit=500)
+    if limit:
+        param.update(type='limit', default=10, min=1, max=500, highmax=5000)
+    return param
+
+def _submodules(param, parent=None):
+    param['submodules'] = {x: f'{parent}+{x}' if parent else x for x in param['type']}
+    return param
+
+class WikiStandin(StandinServer):
+    """
+    Imitates the action API of a MediaWiki wiki, and of a Wikibase
+    repository if entities is given, well enough for the calls pywikibot
+    makes for RottenBot: siteinfo, userinfo, tokens, paraminfo and login,
+    page revisions, edit and parse, and wbgetentities, wbeditentity and
+    wbcreateclaim. Pages and entities live in memory.
+
+    pages maps titles to wikitext. entities maps ids to entity JSON, as
+    wbgetentities returns it; property entities need a datatype.
+    repo is the WikiStandin of the connected Wikibase repository, if any.
+    The bot is always logged in as user.
+
+    lag_rate is the probability that a request sees lag seconds of
+    replication lag. Such requests fail with a maxlag error if they set
+    maxlag lower than that, and it is also reported by siteinfo dbrepllag.
+
+    Use write_family_file to point pywikibot at a running stand-in.
+    """
+    path = '/w/api.php'
+    generator = 'MediaWiki 1.37.0'
+    epoch = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+    token_types = ['createaccount', 'csrf', 'login', 'patrol', 'rollback',
+        'userrights', 'watch']
+    siteinfo_props = ['general', 'namespaces', 'namespacealiases', 'extensions',
+        'dbrepllag', 'restrictions', 'magicwords', 'interwikimap',
+        'specialpagealiases', 'fileextensions']
+    query_props = {'info': 'in', 'revisions': 'rv', 'pageprops': 'pp',
+        'categoryinfo': 'ci', 'templates': 'tl'}
+    query_meta = {'siteinfo': 'si', 'userinfo': 'ui', 'tokens': '', 'wikibase': 'wb'}
+
+    def __init__(self, pages=None, entities=None, repo=None, dbname='enwiki',
+            sitename='Wikipedia', user='RottenBot', lag=5.0, lag_rate=0.0,
+            latency=0.0, seed=None):
+        super().__init__(latency=latency, seed=seed)
+        self.store_lock = threading.RLock()
+        self.dbname = dbname
+        self.sitename = sitename
+        self.user = user
+        self.repo = repo
+        self.lag = lag
+        self.lag_rate = lag_rate
+        self.revid = 0
+        self.pageid = 0
+        self.edits = 0
+        self.maxlagged = 0
+        self.calls = {}
+        self.pages = {}
+        self.entities = None if entities is None else {}
+        for title, text in (pages or {}).items():
+            self.add_page(title, text)
+        for entity in (entities or {}).values():
+            self.add_entity(entity)
+        self.modules = self._modules()
+
+    @property
+    def base(self):
+        return self.endpoint[:-len(self.path)]
+
+    ## Content ##
+
+    def _timestamp(self, revid):
+        # One second per revision, so timestamps order revisions exactly.
+        return (self.epoch + timedelta(seconds=revid)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    @staticmethod
+    def normalize_title(title):
+        title = ' '.join(title.replace('_', ' ').split())
+        return title[:1].upper() + title[1:]
+
+    def add_page(self, title, text, summary='', user=None):
+        """
+        Creates or edits a page, returning the new revision.
+        """
+        title = self.normalize_title(title)
+        with self.store_lock:
+            self.revid += 1
+            if title not in self.pages:
+                self.pageid += 1
+                self.pages[title] = dict(pageid=self.pageid, title=title, revisions=[])
+            page = self.pages[title]
+            parent = page['revisions'][-1]['revid'] if page['revisions'] else 0
+            revision = dict(revid=self.revid, parentid=parent,
+                user=user or 'Standin', timestamp=self._timestamp(self.revid),
+                comment=summary, text=text,
+                sha1=hashlib.sha1(text.encode('utf-8')).hexdigest())
+            page['revisions'].append(revision)
+            return revision
+
+    def page_text(self, title):
+        with self.store_lock:
+            return self.pages[self.normalize_title(title)]['revisions'][-1]['text']
+
+    def add_entity(self, entity):
+        """
+        Creates or replaces an entity from its JSON, returning the stored copy.
+        """
+        entity = copy.deepcopy(entity)
+        is_property = entity['id'].startswith('P')
+        entity.setdefault('type', 'property' if is_property else 'item')
+        for key in ('labels', 'descriptions', 'aliases', 'claims'):
+            entity.setdefault(key, {})
+        if not is_property:
+            entity.setdefault('sitelinks', {})
+        with self.store_lock:
+            for pid, claims in entity['claims'].items():
+                entity['claims'][pid] = [self._normalize_statement(entity['id'], c)
+                    for c in claims]
+            self._bump(entity)
+            self.entities[entity['id']] = entity
+            return copy.deepcopy(entity)
+
+    def _bump(self, entity):
+        self.revid += 1
+        if 'pageid' not in entity:
+            self.pageid += 1
+            entity['pageid'] = self.pageid
+        entity.update(ns=120 if entity['type'] == 'property' else 0,
+            title=entity['id'] if entity['type'] == 'item' else f"Property:{entity['id']}",
+            lastrevid=self.revid, modified=self._timestamp(self.revid))
+
+    def _normalize_snak(self, snak):
+        prop = self.entities.get(snak['property'])
+        if prop and 'datatype' in prop:
+            snak['datatype'] = prop['datatype']
+        content = {k: snak.get(k) for k in ('property', 'snaktype', 'datavalue')}
+        snak['hash'] = hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+        return snak
+
+    def _normalize_snaks(self, snaks):
+        for pid, values in snaks.items():
+            for snak in values:
+                self._normalize_snak(snak)
+        return list(snaks)
+
+    def _normalize_statement(self, entity_id, claim):
+        claim = copy.deepcopy(claim)
+        claim.setdefault('id', f'{entity_id}${str(uuid.uuid4()).upper()}')
+        claim.setdefault('type', 'statement')
+        claim.setdefault('rank', 'normal')
+        self._normalize_snak(claim['mainsnak'])
+        if claim.get('qualifiers'):
+            claim['qualifiers-order'] = self._normalize_snaks(claim['qualifiers'])
+        for ref in claim.get('references', []):
+            ref['snaks-order'] = self._normalize_snaks(ref['snaks'])
+            ref['hash'] = hashlib.sha1(json.dumps(ref['snaks'],
+                sort_keys=True).encode()).hexdigest()
+        return claim
+
+    ## Requests ##
+
+    def handle(self, request):
+        params = self.params(request)
+        action = params.get('action', 'help')
+        with self.lock:
+            key = action if action != 'query' else 'query:' + '|'.join(filter(None,
+                (params.get(x) for x in ('prop', 'list', 'meta'))))
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+        headers = []
+        lag = self.lag if self.chance(self.lag_rate) else 0.0
+        if 'maxlag' in params and lag > float(params['maxlag']):
+            with self.lock:
+                self.maxlagged += 1
+            result = self._error('maxlag', f'Waiting for db1: {lag} seconds lagged.',
+                host='db1', lag=lag, type='db')
+            headers = [('Retry-After', str(max(int(lag), 5))),
+                ('X-Database-Lag', str(int(lag)))]
+        else:
+            handler = getattr(self, 'api_' + action, None)
+            if handler is None:
+                result = self._error('badvalue',
+                    f'Unrecognized value for parameter "action": {action}.')
+            else:
+                try:
+                    result = handler(params, lag)
+                except APIStandinError as e:
+                    result = self._error(*e.args)
+        self.respond(request, 200, json.dumps(result),
+            'application/json; charset=utf-8', headers)
+
+    @staticmethod
+    def _error(code, info, **extra):
+        return {'error': dict(code=code, info=info, **extra)}
+
+    @staticmethod
+    def _list(params, name):
+        value = params.get(name, '')
+        return value.split('|') if value else []
+
+    def _check_token(self, params):
+        if params.get('token') != self.token:
+            raise APIStandinError('badtoken', 'Invalid CSRF token.')
+
+    token = 'standin0123456789abcdef+\\'
+
+    def api_login(self, params, lag):
+        if 'lgtoken' not in params:
+            return {'login': {'result': 'NeedToken', 'token': self.token}}
+        return {'login': {'result': 'Success', 'lguserid': 1,
+            'lgusername': params.get('lgname', self.user)}}
+
+    def api_paraminfo(self, params, lag):
+        names = self._list(params, 'modules') + ['query+' + x
+            for x in self._list(params, 'querymodules')]
+        found = [self.modules[x] if x in self.modules
+            else {'name': x.rpartition('+')[2], 'path': x, 'missing': ''} for x in names]
+        return {'paraminfo': {'modules': found}}
+
+    def api_query(self, params, lag):
+        result = {'batchcomplete': ''}
+        query = {}
+        for meta in self._list(params, 'meta'):
+            handler = getattr(self, 'meta_' + meta, None)
+            if handler is None:
+                result.setdefault('warnings', {})['query'] = {'*':
+                    f'Unrecognized value for parameter "meta": {meta}'}
+                continue
+            query.update(handler(params, lag))
+            if meta == 'siteinfo':
+                unknown = [x for x in self._list(params, 'siprop')
+                    if x not in self.siteinfo_props]
+                if unknown:
+                    result.setdefault('warnings', {})['siteinfo'] = {'*':
+                        f'Unrecognized values for parameter "siprop": {", ".join(unknown)}'}
+        titles = self._list(params, 'titles')
+        if params.get('generator') == 'templates':
+            titles = self._templates(titles)
+        if titles:
+            query.update(self._pages(titles, set(self._list(params, 'prop'))))
+        if query:
+            result['query'] = query
+        if 'warnings' in result and not query:
+            del result['batchcomplete']
+        return result
+
+    def _templates(self, titles):
+        """
+        Returns the titles of the templates which the latest revisions of
+        the pages with titles transclude.
+        """
+        found = []
+        with self.store_lock:
+            for title in titles:
+                page = self.pages.get(self.normalize_title(title))
+                if page is None:
+                    continue
+                for name in _template_re.findall(page['revisions'][-1]['text']):
+                    name = 'Template:' + self.normalize_title(name)
+                    if name not in found:
+                        found.append(name)
+        return found
+
+    def _pages(self, titles, props):
+        normalized, pages = [], {}
+        missing = 0
+        with self.store_lock:
+            for title in titles:
+                norm = self.normalize_title(title)
+                if norm != title:
+                    normalized.append({'from': title, 'to': norm})
+                page = self.pages.get(norm)
+                if page is None:
+                    missing -= 1
+                    ns = 10 if norm.startswith('Template:') else 0
+                    pages[str(missing)] = {'ns': ns, 'title': norm, 'missing': ''}
+                    continue
+                latest = page['revisions'][-1]
+                data = {'pageid': page['pageid'], 'ns': 0, 'title': norm}
+                if 'info' in props:
+                    data.update(contentmodel='wikitext', pagelanguage='en',
+                        pagelanguagehtmlcode='en', pagelanguagedir='ltr',
+                        touched=latest['timestamp'], lastrevid=latest['revid'],
+                        length=len(latest['text'].encode('utf-8')), protection=[],
+                        restrictiontypes=['edit', 'move'])
+                if 'revisions' in props:
+                    data['revisions'] = [{
+                        'revid': latest['revid'], 'parentid': latest['parentid'],
+                        'user': latest['user'], 'timestamp': latest['timestamp'],
+                        'comment': latest['comment'], 'sha1': latest['sha1'],
+                        'contentformat': 'text/x-wiki', 'contentmodel': 'wikitext',
+                        '*': latest['text'],
+                        'slots': {'main': {'contentmodel': 'wikitext',
+                            'contentformat': 'text/x-wiki', '*': latest['text']}},
+                    }]
+                pages[str(page['pageid'])] = data
+        query = {'pageids': list(pages), 'pages': pages}
+        if normalized:
+            query['normalized'] = normalized
+        return query
+
+    def meta_tokens(self, params, lag):
+        types = self._list(params, 'type') or ['csrf']
+        return {'tokens': {t + 'token': self.token for t in types}}
+
+    def meta_userinfo(self, params, lag):
+        rights = ['read', 'edit', 'createpage', 'writeapi', 'bot', 'apihighlimits',
+            'noratelimit', 'autoconfirmed', 'skipcaptcha']
+        return {'userinfo': {'id': 1, 'name': self.user, 'editcount': self.edits,
+            'groups': ['*', 'user', 'autoconfirmed', 'bot'], 'rights': rights}}
+
+    def meta_wikibase(self, params, lag):
+        repo = self.repo or self
+        return {'wikibase': {'repo': {'url': {'base': repo.base, 'scriptpath': '/w',
+            'articlepath': '/wiki/$1'}}, 'siteid': self.dbname}}
+
+    def meta_siteinfo(self, params, lag):
+        info = {}
+        for prop in self._list(params, 'siprop') or ['general']:
+            if prop == 'general':
+                info['general'] = self._general()
+            elif prop == 'namespaces':
+                info['namespaces'] = self._namespaces()
+            elif prop == 'extensions':
+                info['extensions'] = [{'type': 'other', 'name': 'WikibaseRepository'}] \
+                    if self.entities is not None else \
+                    [{'type': 'other', 'name': 'WikibaseClient'}]
+            elif prop == 'dbrepllag':
+                info['dbrepllag'] = [{'host': 'db1', 'lag': lag}]
+            elif prop == 'restrictions':
+                info['restrictions'] = {'types': ['create', 'edit', 'move', 'upload'],
+                    'levels': ['', 'autoconfirmed', 'sysop'],
+                    'cascadinglevels': ['sysop'], 'semiprotectedlevels': ['autoconfirmed']}
+            elif prop == 'fileextensions':
+                info['fileextensions'] = [{'ext': x} for x in ('png', 'gif', 'jpg', 'jpeg')]
+            elif prop in self.siteinfo_props:
+                info[prop] = []
+        return info
+
+    def _general(self):
+        general = dict(mainpage='Main Page', base=self.base + '/wiki/Main_Page',
+            sitename=self.sitename, generator=self.generator, phpversion='7.4.0',
+            phpsapi='standin', dbtype='mysql', dbversion='10.4', lang='en',
+            fallback=[], fallback8bitEncoding='windows-1252', writeapi='',
+            maxarticlesize=2097152, timezone='UTC', timeoffset=0,
+            articlepath='/wiki/$1', scriptpath='/w', script='/w/index.php',
+            server=self.base, servername='127.0.0.1', wikiid=self.dbname,
+            time=self._timestamp(self.revid), case='first-letter',
+            legaltitlechars=" %!\"$&'()*,\\-.\\/0-9:;=?@A-Z\\\\^_`a-z~\\x80-\\xFF+",
+            linkprefixcharset='', linktrail='/^([a-z]+)(.*)$/sD',
+            invalidusernamechars='@:', maxuploadsize=4294967296,
+            minuploadchunksize=1024, categorycollation='uppercase',
+            magiclinks={'ISBN': '', 'PMID': '', 'RFC': ''})
+        if self.entities is not None:
+            general['wikibase-conceptbaseuri'] = 'http://www.wikidata.org/entity/'
+        return general
+
+    def _namespaces(self):
+        names = {-2: 'Media', -1: 'Special', 0: '', 1: 'Talk', 2: 'User',
+            3: 'User talk', 4: 'Project', 5: 'Project talk', 6: 'File',
+            7: 'File talk', 8: 'MediaWiki', 9: 'MediaWiki talk', 10: 'Template',
+            11: 'Template talk', 12: 'Help', 13: 'Help talk', 14: 'Category',
+            15: 'Category talk'}
+        if self.entities is not None:
+            names.update({120: 'Property', 121: 'Property talk'})
+        namespaces = {}
+        for i, name in names.items():
+            ns = {'id': i, 'case': 'first-letter', '*': name}
+            if i:
+                ns['canonical'] = name
+            if i == 0:
+                ns.update(_flags('content'))
+                if self.entities is not None:
+                    ns['defaultcontentmodel'] = 'wikibase-item'
+            if i == 120:
+                ns['defaultcontentmodel'] = 'wikibase-property'
+            namespaces[str(i)] = ns
+        return namespaces
+
+    def api_edit(self, params, lag):
+        self._check_token(params)
+        title = self.normalize_title(params.get('title', ''))
+        with self.store_lock:
+            return self._edit(title, params)
+
+    def _edit(self, title, params):
+        page = self.pages.get(title)
+        latest = page['revisions'][-1] if page else None
+        if page is None and 'nocreate' in params:
+            raise APIStandinError('missingtitle', "The page you specified doesn't exist.")
+        if page is not None and 'createonly' in params:
+            raise APIStandinError('articleexists', 'The article you tried to create has been created already.')
+        base = params.get('basetimestamp')
+        if latest and base and base < latest['timestamp']:
+            raise APIStandinError('editconflict', 'Edit conflict.')
+        if 'text' in params:
+            text = params['text']
+        else:
+            old = latest['text'] if latest else ''
+            text = params.get('prependtext', '') + old + params.get('appendtext', '')
+        if latest and text == latest['text']:
+            return {'edit': {'result': 'Success', 'pageid': page['pageid'],
+                'title': title, 'contentmodel': 'wikitext', 'nochange': ''}}
+        revision = self.add_page(title, text, params.get('summary', ''), self.user)
+        with self.lock:
+            self.edits += 1
+        return {'edit': {'result': 'Success', 'pageid': self.pages[title]['pageid'],
+            'title': title, 'contentmodel': 'wikitext',
+            'oldrevid': revision['parentid'], 'newrevid': revision['revid'],
+            'newtimestamp': revision['timestamp']}}
+
+    def api_parse(self, params, lag):
+        if 'page' in params:
+            title = self.normalize_title(params['page'])
+            with self.store_lock:
+                if title not in self.pages:
+                    raise APIStandinError('missingtitle', "The page you specified doesn't exist.")
+                page = self.pages[title]
+                text = page['revisions'][-1]['text']
+                ids = {'pageid': page['pageid'], 'revid': page['revisions'][-1]['revid']}
+        else:
+            title, text, ids = params.get('title', 'API'), params.get('text', ''), {}
+        rendered = ''.join(f'<p>{html.escape(p)}\n</p>' for p in text.split('\n\n') if p)
+        return {'parse': dict(title=title, **ids,
+            text={'*': f'<div class="mw-parser-output">{rendered}</div>'},
+            wikitext={'*': text})}
+
+    ## Wikibase ##
+
+    def _require_repo(self):
+        if self.entities is None:
+            raise APIStandinError('badvalue', 'Wikibase is not enabled on this wiki.')
+
+    def _entity_json(self, entity, props, languages, sitefilter):
+        out = {'type': entity['type'], 'id': entity['id']}
+        if 'info' in props:
+            out.update({k: entity[k] for k in ('pageid', 'ns', 'title',
+                'lastrevid', 'modified')})
+        if 'datatype' in props and 'datatype' in entity:
+            out['datatype'] = entity['datatype']
+        for key in ('labels', 'descriptions', 'aliases'):
+            if key in props:
+                out[key] = {k: v for k, v in entity[key].items()
+                    if not languages or k in languages}
+        if 'claims' in props:
+            out['claims'] = entity['claims']
+        if 'sitelinks' in props and 'sitelinks' in entity:
+            out['sitelinks'] = {k: v for k, v in entity['sitelinks'].items()
+                if not sitefilter or k in sitefilter}
+        return copy.deepcopy(out)
+
+    def api_wbgetentities(self, params, lag):
+        self._require_repo()
+        props = set(self._list(params, 'props') or ['info', 'sitelinks', 'aliases',
+            'labels', 'descriptions', 'claims', 'datatype'])
+        languages = set(self._list(params, 'languages'))
+        sitefilter = set(self._list(params, 'sitefilter'))
+        entities, normalized = {}, {}
+        missing = 0
+        with self.store_lock:
+            if 'ids' in params:
+                for id in self._list(params, 'ids'):
+                    id = id.upper()
+                    if id in self.entities:
+                        entities[id] = self._entity_json(self.entities[id], props,
+                            languages, sitefilter)
+                    else:
+                        entities[id] = {'id': id, 'missing': ''}
+            else:
+                sites, titles = self._list(params, 'sites'), self._list(params, 'titles')
+                if 'normalize' in params and len(titles) == 1:
+                    norm = self.normalize_title(titles[0])
+                    if norm != titles[0]:
+                        normalized = {'n': {'from': titles[0], 'to': norm}}
+                    titles = [norm]
+                links = {(link['site'], link['title']): entity
+                    for entity in self.entities.values()
+                    for link in entity.get('sitelinks', {}).values()}
+                for site in sites:
+                    for title in titles:
+                        entity = links.get((site, title))
+                        if entity is None:
+                            missing -= 1
+                            entities[str(missing)] = {'site': site, 'title': title,
+                                'missing': ''}
+                        else:
+                            entities[entity['id']] = self._entity_json(entity,
+                                props, languages, sitefilter)
+        result = {'entities': entities, 'success': 1}
+        if normalized:
+            result['normalized'] = normalized
+        return result
+
+    def _check_base(self, entity, params):
+        base = params.get('baserevid')
+        if base and int(base) != entity['lastrevid']:
+            raise APIStandinError('editconflict', 'Edit conflict: the entity '
+                'was changed after the given base revision.')
+
+    @staticmethod
+    def _merge_terms(current, updates, multi=False):
+        for lang, value in updates.items():
+            if multi:
+                values = value if isinstance(value, list) else [value]
+                keep = current.get(lang, [])
+                if not any('add' in v or 'remove' in v for v in values):
+                    keep = []
+                removed = {v['value'] for v in values if 'remove' in v}
+                keep = [v for v in keep if v['value'] not in removed]
+                keep += [{'language': lang, 'value': v['value']}
+                    for v in values if 'remove' not in v]
+                if keep:
+                    current[lang] = keep
+                else:
+                    current.pop(lang, None)
+            elif 'remove' in value or not value.get('value'):
+                current.pop(lang, None)
+            else:
+                current[lang] = {'language': lang, 'value': value['value']}
+
+    def api_wbeditentity(self, params, lag):
+        self._require_repo()
+        self._check_token(params)
+        data = json.loads(params.get('data', '{}'))
+        with self.store_lock:
+            if 'new' in params:
+                id = 'Q' + str(1 + max((int(x[1:]) for x in self.entities
+                    if x.startswith('Q')), default=0))
+                entity = {'type': 'item', 'id': id, 'labels': {}, 'descriptions': {},
+                    'aliases': {}, 'claims': {}, 'sitelinks': {}}
+            else:
+                id = params.get('id', '').upper()
+                if id not in self.entities:
+                    raise APIStandinError('no-such-entity', f'Could not find an entity with the ID "{id}".')
+                entity = copy.deepcopy(self.entities[id])
+                self._check_base(entity, params)
+            if 'clear' in params:
+                for key in ('labels', 'descriptions', 'aliases', 'claims', 'sitelinks'):
+                    entity[key] = {}
+            self._merge_terms(entity['labels'], data.get('labels', {}))
+            self._merge_terms(entity['descriptions'], data.get('descriptions', {}))
+            self._merge_terms(entity['aliases'], data.get('aliases', {}), multi=True)
+            for site, link in data.get('sitelinks', {}).items():
+                if 'remove' in link:
+                    entity['sitelinks'].pop(site, None)
+                else:
+                    entity['sitelinks'][site] = {'site': site, 'title': link['title'],
+                        'badges': link.get('badges', [])}
+            claims = data.get('claims', {})
+            if isinstance(claims, dict):
+                claims = [c for values in claims.values() for c in values]
+            for claim in claims:
+                self._set_claim(entity, claim)
+            self._bump(entity)
+            self.entities[id] = entity
+            with self.lock:
+                self.edits += 1
+            return {'entity': copy.deepcopy(entity), 'success': 1}
+
+    def _set_claim(self, entity, claim):
+        if 'remove' in claim:
+            for pid, values in entity['claims'].items():
+                values[:] = [c for c in values if c['id'] != claim['id']]
+            entity['claims'] = {k: v for k, v in entity['claims'].items() if v}
+            return None
+        claim = self._normalize_statement(entity['id'], claim)
+        values = entity['claims'].setdefault(claim['mainsnak']['property'], [])
+        for i, c in enumerate(values):
+            if c['id'] == claim['id']:
+                values[i] = claim
+                break
+        else:
+            values.append(claim)
+        return claim
+
+    def api_wbcreateclaim(self, params, lag):
+        self._require_repo()
+        self._check_token(params)
+        id = params.get('entity', '').upper()
+        with self.store_lock:
+            if id not in self.entities:
+                raise APIStandinError('no-such-entity', f'Could not find an entity with the ID "{id}".')
+            entity = copy.deepcopy(self.entities[id])
+            self._check_base(entity, params)
+            snak = {'snaktype': params.get('snaktype', 'value'),
+                'property': params.get('property', '').upper()}
+            if snak['snaktype'] == 'value':
+                prop = self.entities.get(snak['property'], {})
+                snak['datavalue'] = {'value': json.loads(params.get('value', 'null')),
+                    'type': _VALUE_TYPES.get(prop.get('datatype'), 'string')}
+            claim = self._set_claim(entity, {'mainsnak': snak})
+            self._bump(entity)
+            self.entities[id] = entity
+            with self.lock:
+                self.edits += 1
+            return {'pageinfo': {'lastrevid': entity['lastrevid']}, 'success': 1,
+                'claim': copy.deepcopy(claim)}
+
+    ## Parameter information ##
+
+    def _modules(self):
+        actions = ['query', 'paraminfo', 'login', 'edit', 'parse']
+        if self.entities is not None:
+            actions += ['wbgetentities', 'wbeditentity', 'wbcreateclaim']
+        query_modules = list(self.query_props) + list(self.query_meta)
+        post = _flags('mustbeposted')
+
+        def module(path, prefix, parameters, **extra):
+            name = path.rpartition('+')[2]
+            return dict(name=name, path=path, prefix=prefix, source='MediaWiki',
+                classname='Api' + name.capitalize(), helpurls=[],
+                parameters=parameters, **extra)
+
+        modules = [
+            module('main', '', [_submodules(_param('action', actions)),
+                _param('format', ['json']), _param('maxlag', 'integer'),
+                _param('assert', ['anon', 'bot', 'user']), _param('assertuser', 'user')]),
+            module('paraminfo', '', [_param('modules', multi=True),
+                _param('querymodules', query_modules, multi=True, **_flags('deprecated'))]),
+            module('query', '', [
+                _submodules(_param('prop', list(self.query_props), multi=True), 'query'),
+                _submodules(_param('list', [], multi=True), 'query'),
+                _submodules(_param('meta', list(self.query_meta), multi=True), 'query'),
+                _param('generator', ['templates']), _param('titles', multi=True),
+                _param('pageids', 'integer', multi=True), _param('revids', 'integer', multi=True),
+                _param('redirects', 'boolean'), _param('indexpageids', 'boolean'),
+                _param('continue'), _param('rawcontinue', 'boolean')]),
+            module('query+info', 'in', [_param('prop', ['protection', 'talkid',
+                'watched', 'url', 'displaytitle'], multi=True)], group='prop'),
+            module('query+revisions', 'rv', [_param('prop', ['ids', 'flags',
+                'timestamp', 'user', 'comment', 'content', 'contentmodel', 'sha1',
+                'size'], multi=True), _param('slots', ['main'], multi=True),
+                _param('limit', limit=True)], group='prop'),
+            module('query+pageprops', 'pp', [_param('prop', multi=True)], group='prop'),
+            module('query+categoryinfo', 'ci', [_param('continue')], group='prop'),
+            module('query+templates', 'tl', [_param('namespace', 'namespace', multi=True),
+                _param('limit', limit=True), _param('continue')], group='prop',
+                **_flags('generator')),
+            module('query+siteinfo', 'si', [_param('prop', self.siteinfo_props,
+                multi=True)], group='meta'),
+            module('query+userinfo', 'ui', [_param('prop', ['blockinfo', 'hasmsg',
+                'groups', 'rights', 'editcount'], multi=True)], group='meta'),
+            module('query+tokens', '', [_param('type', self.token_types, multi=True)],
+                group='meta'),
+            module('query+wikibase', 'wb', [_param('prop', ['url', 'siteid'],
+                multi=True)], group='meta'),
+            module('login', 'lg', [_param('name'), _param('password', 'password'),
+                _param('token')], **post),
+            module('edit', '', [_param('title'), _param('text', 'text'),
+                _param('summary'), _param('minor', 'boolean'), _param('bot', 'boolean'),
+                _param('basetimestamp', 'timestamp'), _param('nocreate', 'boolean'),
+                _param('createonly', 'boolean'), _param('token')], **post),
+            module('parse', '', [_param('page'), _param('text', 'text'),
+                _param('prop', ['text', 'wikitext'], multi=True)]),
+            module('wbgetentities', '', [_param('ids', multi=True),
+                _param('sites', multi=True), _param('titles', multi=True),
+                _param('props', ['info', 'sitelinks', 'aliases', 'labels',
+                    'descriptions', 'claims', 'datatype'], multi=True),
+                _param('languages', multi=True), _param('sitefilter', multi=True),
+                _param('normalize', 'boolean')]),
+            module('wbeditentity', '', [_param('id'), _param('new'),
+                _param('data', 'text'), _param('baserevid', 'integer'),
+                _param('summary'), _param('clear', 'boolean'), _param('bot', 'boolean'),
+                _param('token')], **post),
+            module('wbcreateclaim', '', [_param('entity'), _param('property'),
+                _param('snaktype', ['value', 'novalue', 'somevalue']), _param('value', 'text'),
+                _param('baserevid', 'integer'), _param('summary'), _param('bot', 'boolean'),
+                _param('token')], **post),
+        ]
+        return {m['path']: m for m in modules}
+
+class APIStandinError(Exception):
+    """
+    Raised by WikiStandin handlers to answer with an API error (code, info).
+    """
+
+# the names of the templates a wikitext transcludes
+_template_re = re.compile(r'{{\s*([^{}|#:<>\[\]]+?)\s*(?:\||}})')
+
+# datavalue types of the property datatypes RottenBot uses
+_VALUE_TYPES = {
+    'wikibase-item': 'wikibase-entityid',
+    'quantity': 'quantity',
+    'time': 'time',
+    'string': 'string',
+    'external-id': 'string',
+    'url': 'string',
+    'monolingualtext': 'monolingualtext',
+}
+
+_FAMILY_FILE = """\
+# Generated by standin.write_family_file for a local stand-in wiki.
+from pywikibot import family
+
+
+class Family(family.Family):
+    name = {name!r}
+    langs = {{{code!r}: {host!r}}}
+
+    def scriptpath(self, code):
+        return '/w'
+
+    def protocol(self, code):
+        return 'http'
+
+    def interface(self, code):
+        return {interface!r}
+
+    def calendarmodel(self, code):
+        return 'http://www.wikidata.org/entity/Q1985727'
+"""
+
+def write_family_file(directory, name, code, standin):
+    """
+    Writes a pywikibot family file named name, with the single code,
+    for a running WikiStandin, and returns its path. Registering it under
+    an existing name, e.g.
+        pywikibot.config.family_files['wikipedia'] = path
+    makes pywikibot.Site(code, name) talk to the stand-in instead.
+    """
+    path = os.path.join(directory, f'{name}_family.py')
+    host = standin.base.partition('://')[2]
+    interface = 'DataSite' if standin.entities is not None else 'APISite'
+    with open(path, 'w') as f:
+        f.write(_FAMILY_FILE.format(name=name, code=code, host=host,
+            interface=interface))
+    return path
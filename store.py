@@ -0,0 +1,164 @@
+# This module provides a store for Candidates and FullEdits.
+# Records are written to an SQLite file one at a time, as soon as they are
+# produced, and read back one at a time or by title.
+# Article texts are kept apart from them, compressed, once per content hash,
+# in a text store whose path each record store remembers.
+################################################################################
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import zlib
+################################################################################
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+TEXT_STORE_FILE = 'storage/texts.sqlite'
+TEXT_COMPRESSION_LEVEL = 6
+
+_texts = None
+_texts_path = TEXT_STORE_FILE
+_texts_lock = threading.Lock()
+
+class MissingTextError(LookupError):
+    """
+    Raised when a text is not in the text store.
+    """
+
+class RecordStore:
+    """
+    An SQLite file of pickled records, each with a title, kept in the
+    order they were added. Every record is committed when it is added,
+    so a run which stops partway leaves the records it produced.
+    Iterating over a store reads its records lazily, so memory stays
+    bounded however many there are.
+
+    mode 'r' opens an existing store, 'a' appends to a store (creating it
+    if needed), and 'w' creates an empty store, replacing any file at path.
+    A store which is written records the absolute path of the text store
+    in use, and opening it for reading switches to that text store, so
+    its Candidates find their texts from any working directory.
+    """
+    def __init__(self, path, mode='r'):
+        if mode == 'r' and not os.path.exists(path):
+            raise FileNotFoundError(path)
+        if mode == 'w':
+            # A write-ahead log left beside an old file would be applied
+            # to the new one.
+            for name in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(name):
+                    os.remove(name)
+        if mode != 'r':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        if mode != 'r':
+            self.db.execute('CREATE TABLE IF NOT EXISTS records '
+                '(seq INTEGER PRIMARY KEY, title TEXT NOT NULL, data BLOB NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS records_title ON records (title)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('text_store', ?)",
+                (os.path.abspath(_texts_path),))
+        elif (text_store := self._meta('text_store')) is not None:
+            use_texts(text_store)
+
+    def _meta(self, key):
+        try:
+            row = self.db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None     # written before the meta table existed
+        return row[0] if row else None
+
+    def add(self, record):
+        self.db.execute('INSERT INTO records (title, data) VALUES (?, ?)',
+            (record.title, pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def get(self, title):
+        """
+        Returns the list of records with title, in the order they were added.
+        """
+        rows = self.db.execute('SELECT data FROM records WHERE title=? ORDER BY seq', (title,))
+        return [pickle.loads(data) for data, in rows]
+
+    def __iter__(self):
+        for data, in self.db.execute('SELECT data FROM records ORDER BY seq'):
+            yield pickle.loads(data)
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def is_store(path):
+    """
+    Returns whether the file at path is a RecordStore rather than a pickle.
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+def text_sha1(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+class TextStore:
+    """
+    Article texts, compressed with zlib and keyed by their SHA-1, in an
+    SQLite database which all processes share. A text is stored once
+    however many times it is added.
+    Use get_texts() to get the instance for the current process.
+    """
+    def __init__(self, path=TEXT_STORE_FILE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = os.path.abspath(path)
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=60,
+            check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS texts '
+            '(sha1 TEXT PRIMARY KEY, data BLOB NOT NULL)')
+
+    def add(self, text, sha1=None):
+        """
+        Stores text and returns its SHA-1.
+        """
+        sha1 = sha1 or text_sha1(text)
+        if not self.db.execute('SELECT 1 FROM texts WHERE sha1=?', (sha1,)).fetchone():
+            self.db.execute('INSERT OR IGNORE INTO texts VALUES (?, ?)',
+                (sha1, zlib.compress(text.encode(), TEXT_COMPRESSION_LEVEL)))
+        return sha1
+
+    def get(self, sha1):
+        row = self.db.execute('SELECT data FROM texts WHERE sha1=?', (sha1,)).fetchone()
+        if row is None:
+            raise MissingTextError(f'No text with SHA-1 {sha1} in the text store at {self.path}.')
+        return zlib.decompress(row[0]).decode()
+
+def use_texts(path):
+    """
+    Makes get_texts() return the TextStore at path from now on.
+    Worker processes forked afterwards inherit the choice.
+    """
+    global _texts, _texts_path
+    with _texts_lock:
+        if os.path.abspath(path) != os.path.abspath(_texts_path):
+            _texts_path, _texts = path, None
+
+def get_texts():
+    """
+    Returns the TextStore for this process.
+    Worker processes get their own database connection.
+    """
+    global _texts
+    with _texts_lock:
+        if _texts is None or _texts.pid != os.getpid():
+            _texts = TextStore(_texts_path)
+    return _texts
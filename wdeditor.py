@@ -1,26 +1,33 @@
 # This module is for editing Rotten Tomatoes scores on Wikidata.
 ###############################################################################
+import argparse
+import csv
 import json
 import logging
+import os
+import queue
+import sqlite3
 import sys
+import threading
 import time
 
-from concurrent.futures import as_completed, ThreadPoolExecutor
-from datetime import date
+from concurrent.futures import as_completed, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
 
-
-import pywikibot as pwb
-import pywikibot.data.sparql as sparql
 import regex as re
 
-from pywikibot import Claim, ItemPage, Site
+import metrics
 
+from journal import Journal, read_records, work_key
+from lazyimport import lazy_import
 from scraper import RTmovie, USER_AGENT
 
+pwb = lazy_import('pywikibot')
+requests = lazy_import('requests')
+
 logger = logging.getLogger(__name__)
 ################################################################################
-SITE = Site('wikidata', 'wikidata')
-SITE.login(user='RottenBot')
 
 Q_ROTTEN_TOMATOES           = 'Q105584'
 Q_TOMATOMETER               = 'Q108403393'
@@ -42,44 +49,374 @@ P_LANGUAGE                  = 'P407'
 P_STATED_IN                 = 'P248'
 P_NAMED_AS                  = 'P1810'
 
+PRELOAD_BATCH_SIZE          = 50    # maximum number of ids per wbgetentities
+SCRAPE_WORKERS              = 8     # default width of the scrape stage
+PIPELINE_QUEUE_SIZE         = 2 * PRELOAD_BATCH_SIZE
+
+SPARQL_ENDPOINT             = 'https://query.wikidata.org/sparql'
+SPARQL_PAGE_SIZE            = 50000 # rows per query in iter_results
+SPARQL_TIMEOUT              = (10, 120)
+SPARQL_MAX_RETRIES          = 5
+SPARQL_BACKOFF              = 5     # seconds before the first retry
+
+RTID_INDEX_FILE             = 'storage/rtid_to_qid.sqlite'
+# How far back incremental refreshes look, to cover query service lag.
+RTID_INDEX_OVERLAP          = timedelta(days=1)
+# Time between full rebuilds, which drop the mappings of items that lost
+# their P1258 or were merged, redirected or deleted.
+RTID_INDEX_MAX_AGE          = timedelta(days=7)
+
+SITELINK_CACHE_FILE         = 'storage/sitelinks.sqlite'
+SITELINK_CACHE_MAX_AGE      = timedelta(days=7)
+
+REFRESH_WORK_FILE           = 'storage/film_items_to_update.json'
+REFRESH_JOURNAL_FILE        = 'storage/refresh_journal.{work}.{shard}-of-{shards}.jsonl'
+WRITE_JOURNAL_FILE          = 'storage/wikidata_writes.jsonl'
+
+_site = None
+_site_lock = threading.Lock()
+
+def get_site():
+    """
+    Returns the Wikidata site, logging in on first use.
+    """
+    global _site
+    with _site_lock:
+        if _site is None:
+            site = pwb.Site('wikidata', 'wikidata')
+            site.login(user='RottenBot')
+            _site = site
+    return _site
+
 class RTID_to_QID:
-    def __init__(self):
-        query = "SELECT ?item ?itemLabel ?rtid WHERE{?item wdt:P1258 ?rtid.FILTER REGEX(?rtid, '^m/')}"
-        data = dict()
-        for z in get_results(query):
-            qid = z['item']['value'].rpartition('/')[2]
-            rtid = z['rtid']['value'].lower()
-            data[rtid] = qid
-        self.data = data
+    """
+    Maps Rotten Tomatoes movie IDs to QIDs.
+    The mapping is stored in an SQLite database at path, so loading it is
+    instant. A full refresh rebuilds it from every P1258 value; the
+    refreshes in between only query the items modified since the previous
+    one and replace all of their mappings. Items which no longer have a
+    P1258 value drop out of the query altogether, so their mappings only
+    go at the next full refresh, at most RTID_INDEX_MAX_AGE later.
+    Mappings assigned with rtid_to_qid[rtid] = qid are written back, until
+    the next full refresh.
+    """
+    def __init__(self, path=RTID_INDEX_FILE, refresh=True):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA mmap_size=268435456')
+        self.db.execute('CREATE TABLE IF NOT EXISTS mapping '
+            '(rtid TEXT PRIMARY KEY, qid TEXT NOT NULL) WITHOUT ROWID')
+        self.db.execute('CREATE INDEX IF NOT EXISTS mapping_qid ON mapping (qid)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        if refresh:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Brings the mapping up-to-date with the Wikidata Query Service.
+        """
+        started = datetime.now(timezone.utc)
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        full = 'last_full_refresh' not in meta or \
+            started - datetime.fromisoformat(meta['last_full_refresh']) > RTID_INDEX_MAX_AGE
+        where = "?item wdt:P1258 ?rtid. FILTER(STRSTARTS(?rtid, 'm/'))"
+        if not full:
+            since = datetime.fromisoformat(meta['last_refresh']) - RTID_INDEX_OVERLAP
+            where += (f" ?item schema:dateModified ?modified."
+                f" FILTER(?modified >= '{since:%Y-%m-%dT%H:%M:%SZ}'^^xsd:dateTime)")
+
+        rtids = dict()
+        with metrics.timer('rtid_index_refresh'):
+            for z in iter_results('?item ?rtid', where):
+                qid = z['item']['value'].rpartition('/')[2]
+                rtids.setdefault(qid, []).append(z['rtid']['value'].lower())
+        # Nothing is deleted unless the whole query succeeded.
+        with self.db:
+            self.db.execute('BEGIN')
+            if full:
+                self.db.execute('DELETE FROM mapping')
+            else:
+                self.db.executemany('DELETE FROM mapping WHERE qid=?', ((q,) for q in rtids))
+            self.db.executemany('INSERT OR REPLACE INTO mapping VALUES (?, ?)',
+                ((rtid, qid) for qid, values in rtids.items() for rtid in values))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('last_refresh', ?)",
+                (started.isoformat(),))
+            if full:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('last_full_refresh', ?)",
+                    (started.isoformat(),))
+        logger.info("RTID index refreshed in %.1fs",
+            (datetime.now(timezone.utc) - started).total_seconds())
 
     def __getitem__(self, rtid):
-        return self.data.get(rtid, None)
+        row = self.db.execute('SELECT qid FROM mapping WHERE rtid=?', (rtid,)).fetchone()
+        return row[0] if row else None
 
     def __setitem__(self, rtid, value):
         if type(rtid) != str or type(value) != str:
             return
         if not re.fullmatch('m/[-a-z0-9_]+', rtid) or not re.fullmatch('Q[0-9]+', value):
             return
-        self.data[rtid] = value
+        self.db.execute('INSERT OR REPLACE INTO mapping VALUES (?, ?)', (rtid, value))
 
 
 def make_claim(pid, target):
     """
     Return pwb.Claim object for entity with pid and specified target.
     """
-    c = Claim(SITE, pid)
+    c = pwb.Claim(get_site(), pid)
     c.setTarget(target)
     return c
 
 def make_item(qid):
-    return ItemPage(SITE, qid)
+    return pwb.ItemPage(get_site(), qid)
+
+class SitelinkCache:
+    """
+    Resolves English Wikipedia titles to the QID of the connected item and
+    that item's Rotten Tomatoes IDs, with one wbgetentities request per
+    PRELOAD_BATCH_SIZE titles. Results (including titles without an item)
+    are cached in an SQLite database which all processes share.
+    Use get_sitelinks() to get the instance for the current process.
+    """
+    def __init__(self, path=SITELINK_CACHE_FILE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=60,
+            check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sitelinks '
+            '(title TEXT PRIMARY KEY, qid TEXT, rtids TEXT NOT NULL, fetched TEXT NOT NULL)')
+
+    def _cached(self, titles):
+        oldest = (datetime.now(timezone.utc) - SITELINK_CACHE_MAX_AGE).isoformat()
+        found = dict()
+        for title in set(titles):
+            row = self.db.execute('SELECT qid, rtids FROM sitelinks '
+                'WHERE title=? AND fetched>=?', (title, oldest)).fetchone()
+            if row:
+                found[title] = (row[0], json.loads(row[1]))
+        return found
+
+    def _fetch(self, titles, normalize=False):
+        """
+        Returns dict mapping each title that the API resolved to (qid, rtids).
+        """
+        params = dict(action='wbgetentities', sites='enwiki', titles=titles,
+            props='claims|sitelinks', sitefilter='enwiki')
+        if normalize:
+            params['normalize'] = True
+        request = pwb.data.api.Request(site=get_site(), parameters=params)
+        with metrics.timer('wikidata_read'):
+            entities = request.submit()['entities']
+        found = dict()
+        for qid, entity in entities.items():
+            if 'missing' in entity:
+                found[entity['title']] = (None, [])
+                continue
+            rtids = [c['mainsnak']['datavalue']['value']
+                for c in entity.get('claims', {}).get(P_ROTTEN_TOMATOES_ID, [])
+                if c['mainsnak']['snaktype'] == 'value']
+            title = titles[0] if normalize else entity['sitelinks']['enwiki']['title']
+            found[title] = (qid, rtids)
+        return found
+
+    def resolve(self, titles):
+        """
+        Returns a dict mapping each title to (qid, rtids), where qid is None
+        if the page has no Wikidata item.
+        """
+        found = self._cached(titles)
+        missing = [x for x in dict.fromkeys(titles) if x not in found]
+        fetched = dict()
+        for i in range(0, len(missing), PRELOAD_BATCH_SIZE):
+            fetched.update(self._fetch(missing[i : i+PRELOAD_BATCH_SIZE]))
+        # Titles that need normalizing or are redirects can only be
+        # resolved one at a time.
+        for title in missing:
+            if title not in fetched:
+                fetched[title] = self._fetch([title], normalize=True).get(title, (None, []))
+
+        now = datetime.now(timezone.utc).isoformat()
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO sitelinks VALUES (?, ?, ?, ?)',
+                ((t, qid, json.dumps(rtids), now) for t, (qid, rtids) in fetched.items()))
+        found.update(fetched)
+        return {x: found[x] for x in titles}
+
+    def lookup(self, title):
+        return self.resolve([title])[title]
+
+    def peek(self, title):
+        """
+        Returns (qid, rtids) for title if it is cached, otherwise None,
+        without making any request.
+        """
+        return self._cached([title]).get(title)
+
+_sitelinks = None
+
+def get_sitelinks():
+    """
+    Returns the SitelinkCache for this process.
+    Worker processes get their own database connection.
+    """
+    global _sitelinks
+    with _site_lock:
+        if _sitelinks is None or _sitelinks.pid != os.getpid():
+            _sitelinks = SitelinkCache()
+    return _sitelinks
+
+def preload_items(qids):
+    """
+    Returns a dict mapping each qid to its loaded ItemPage.
+    Items are fetched PRELOAD_BATCH_SIZE at a time, so each batch costs
+    a single wbgetentities request.
+    """
+    items = [make_item(qid) for qid in qids]
+    preloaded = get_site().preload_entities(items, groupsize=PRELOAD_BATCH_SIZE)
+    with metrics.timer('wikidata_read'):
+        return {item.id: item for item in preloaded}
 
 def get_results(query):
+    from pywikibot.data import sparql
     headers = dict(sparql.DEFAULT_HEADERS)
     headers['User-Agent'] = USER_AGENT
     data = sparql.SparqlQuery().query(query, headers)
     return data['results']['bindings']
 
+class IncompleteResults(Exception):
+    """
+    Raised when a query service response ends in the middle of a row.
+    A response cut at a row boundary looks complete; see iter_results.
+    """
+
+def _complete_lines(r):
+    """
+    Yields the lines of the streamed response r, each ending with '\n'.
+    """
+    buffer = ''
+    for chunk in r.iter_content(chunk_size=65536, decode_unicode=True):
+        buffer += chunk
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            yield line + '\n'
+    if buffer:
+        raise IncompleteResults('Response ended in the middle of a row.')
+
+def _stream_results(query, endpoint):
+    """
+    Yields the bindings of query as they are downloaded, in the same
+    format as get_results. Only the 'value' of each binding is available.
+    """
+    # timed to the start of the response, as the rows are read on demand
+    with metrics.timer('wqs_query'):
+        r = requests.get(endpoint, params={'query': query}, stream=True,
+            headers={'Accept': 'text/csv', 'User-Agent': USER_AGENT},
+            timeout=SPARQL_TIMEOUT)
+    with r:
+        if r.status_code != 200:
+            r.raise_for_status()
+        r.encoding = 'utf-8'
+        # strict, so that a response cut inside a quoted field which
+        # contains newlines raises instead of yielding a partial row
+        reader = csv.reader(_complete_lines(r), strict=True)
+        # requests raises if a response with a length or chunked encoding
+        # is cut, but any other one just ends when the connection closes,
+        # so if it is cut right after the header, it looks like an empty
+        # result. Such a response is only trusted if it has rows.
+        delimited = 'Content-Length' in r.headers \
+            or 'chunked' in r.headers.get('Transfer-Encoding', '').lower()
+        try:
+            if (header := next(reader, None)) is None:
+                raise IncompleteResults('Response has no header.')
+            rows = 0
+            for row in reader:
+                rows += 1
+                yield {k: {'value': v} for k, v in zip(header, row) if v}
+            if not rows and not delimited:
+                raise IncompleteResults('Response without a length ended after the header.')
+        except csv.Error as e:
+            raise IncompleteResults(f'Response ended in a quoted field ({e}).') from e
+
+def _should_retry(error):
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response.status_code in (429, 500, 502, 503, 504)
+    return True
+
+def _retry_delay(error, failures):
+    if isinstance(error, requests.exceptions.HTTPError):
+        retry_after = error.response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return int(retry_after)
+    return SPARQL_BACKOFF * 2**(failures - 1)
+
+def _count_results(where, key, value, endpoint):
+    query = f'SELECT (COUNT(*) AS ?count) WHERE {{ {where} FILTER(STR(?{key}) = "{value}") }}'
+    rows = list(_stream_results(query, endpoint))
+    if not rows:
+        raise IncompleteResults('Count query returned no rows.')
+    return int(rows[0]['count']['value'])
+
+def iter_results(select, where, key='item', page_size=SPARQL_PAGE_SIZE, endpoint=None):
+    """
+    Yields the bindings of the query 'SELECT {select} WHERE {{where}}'
+    while they are being downloaded, in the same format as get_results.
+
+    The query is split into pages of page_size rows with keyset pagination
+    on the variable key, which where must bind. The rows of one key value
+    are yielded together and never split across pages, so a key value
+    cannot have more than page_size rows. A page that fails is retried
+    with exponential backoff, resuming after the last key yielded.
+
+    The service can cut a response off at a row boundary, which leaves a
+    page that looks complete but short. So no page is trusted to be the
+    last one: the final group of each page is fetched again with the next
+    page, a page holding a single group is checked against a count of its
+    rows, and the results only end with an empty page.
+    """
+    endpoint = endpoint or SPARQL_ENDPOINT
+    last, failures = '', 0
+    while True:
+        page_start = last
+        query = (f'SELECT {select} WHERE {{ {where} FILTER(STR(?{key}) > "{last}") }} '
+            f'ORDER BY STR(?{key}) LIMIT {page_size}')
+        rows, group, group_key = 0, [], None
+        try:
+            for binding in _stream_results(query, endpoint):
+                rows += 1
+                k = binding[key]['value']
+                if k != group_key:
+                    if group:
+                        yield from group
+                        last, failures = group_key, 0
+                    group, group_key = [], k
+                group.append(binding)
+            if group and last == page_start:
+                if rows == page_size:
+                    raise ValueError(f'More than {page_size} rows for ?{key} = {group_key}.')
+                if _count_results(where, key, group_key, endpoint) != rows:
+                    raise IncompleteResults(f'Response ended after {rows} rows.')
+        except (requests.exceptions.RequestException, IncompleteResults) as e:
+            failures += 1
+            if failures > SPARQL_MAX_RETRIES or not _should_retry(e):
+                raise
+            delay = _retry_delay(e, failures)
+            logger.warning("Query page failed (%s). Retrying in %ss.", e, delay)
+            time.sleep(delay)
+            continue
+
+        if not group:
+            return
+        if last == page_start:
+            # The page holds a single group, which is complete.
+            yield from group
+            last, failures = group_key, 0
+        # Otherwise the final group may continue on the next page, or the
+        # response may have been cut short, so it is fetched again.
+
 def date_from_claim(c):
     """
     Returns "point in time" date, otherwise "retrieved" date, otherwise
@@ -164,11 +501,11 @@ def score_claims_from_movie(movie):
     # set up qualifiers
     RTitem = make_item(Q_ROTTEN_TOMATOES)
     d, m, y = map(int, date.today().strftime('%d %m %Y').split())
-    wbtimetoday = pwb.WbTime(y, m, d, site = SITE)
+    wbtimetoday = pwb.WbTime(y, m, d, site = get_site())
     review_score_by = make_claim(P_REVIEW_SCORE_BY, RTitem)
     review_quantity = pwb.WbQuantity(amount=count,
         unit="http://www.wikidata.org/entity/Q80698083", # unit = critic review
-        site=SITE
+        site=get_site()
     )
     number_of_reviews = make_claim(P_REVIEW_COUNT, review_quantity)
     point_in_time = make_claim(P_POINT_IN_TIME, wbtimetoday)
@@ -203,13 +540,21 @@ def score_claims_from_movie(movie):
 def should_add_RT_claims(movie, item):
     if not movie.tomatometer_score:
         return False
-    new_score, new_count, new_average = movie.tomatometer_score
+    return scores_differ(movie.tomatometer_score, most_recent_score_data(item))
+
+def scores_differ(new_data, old_data):
+    """
+    new_data is a tomatometer_score from scraper.RTmovie.
+    old_data is a triple as returned by most_recent_score_data.
+    Returns True if the two differ or if old_data cannot be parsed.
+    """
+    new_score, new_count, new_average = new_data
     new_score = int(new_score)
     new_count = int(new_count)
     if new_average:
         new_average = float(new_average)
 
-    old_score, old_count, old_average = most_recent_score_data(item)
+    old_score, old_count, old_average = old_data
 
     if m := re.fullmatch(r'([0-9]|[1-9][0-9]|100)(%| percent)', old_score):
         old_score = int(m[1])
@@ -228,38 +573,50 @@ def should_add_RT_claims(movie, item):
             return True
     return (old_score, old_count, old_average)!=(new_score, new_count, new_average)
 
-def add_RT_claims_to_item(movie, item):
-    percent_claim, average_claim = score_claims_from_movie(movie)
-    item.addClaim(percent_claim, summary='Add Rotten Tomatoes score.')
-    item.addClaim(average_claim, summary='Add Rotten Tomatoes average rating.')
+def needs_update(movie, rtid, film):
+    """
+    film is the FilmScores for the item, from scores_on_wikidata.
+    Returns False only if film proves that stage_RTmovie_data would not
+    change the item, so that the item does not need to be loaded at all.
+    """
+    if film is None or film.rtids != {rtid} or movie.short_url != rtid:
+        return True
+    if film.label is None or film.label.lower() != movie.title.lower():
+        return True
+    if not movie.tomatometer_score:
+        return False
+    return scores_differ(movie.tomatometer_score, film.scores)
 
-def update_RTmovie_data(movie, item):
+def attach_claim(item, claim):
     """
-    Adds/updates the Rotten Tomatoes data in a Wikidata item.
-    Currently this means the Rotten Tomatoes ID and the two score claims.
+    Adds claim to item locally. Nothing is saved until save_item_changes.
     """
-    print(f"Checking item {item.id} aka {item.labels.get('en')}...",
-        end='', flush=True)
+    item.claims.setdefault(claim.getID(), []).append(claim)
+
+def add_RT_claims_to_item(movie, item):
+    for claim in score_claims_from_movie(movie):
+        attach_claim(item, claim)
 
-    changed = False
+def stage_RTmovie_data(movie, item):
+    """
+    Makes the Rotten Tomatoes changes to item locally, without saving.
+    Returns a list of edit summary pieces, one per change.
+    An empty list means that the item is already up-to-date.
+    """
+    changes = []
     title = movie.title
 
     if 'en' not in item.labels:
-        try:
-            item.editLabels({'en': title},
-                summary=f'Add English label "{title}".')
-            changed = True
-        except pwb.exceptions.OtherPageSaveError:
-            pass
-    en_label = item.labels.get('en', title)
+        item.labels['en'] = title
+        changes.append(f'add English label "{title}"')
+    en_label = item.labels['en']
 
     titlediff = title.lower() != en_label.lower()
     if titlediff:
         en_aliases = item.aliases.get('en', [])
         if title.lower() not in (x.lower() for x in en_aliases):
-            item.editAliases({'en': en_aliases + [title]},
-                summary=f'Add English alias "{title}".')
-            changed = True
+            item.aliases['en'] = en_aliases + [title]
+            changes.append(f'add English alias "{title}"')
 
     # Ensure Rotten Tomatoes ID statement is up-to-date.
     # Also add P_NAMED_AS qualifier if needed.
@@ -267,46 +624,318 @@ def update_RTmovie_data(movie, item):
     if rtid_claims:
         x = rtid_claims[0]
         if x.target != movie.short_url:
-            x.changeTarget(movie.short_url)
-            changed = True
+            x.setTarget(movie.short_url)
+            changes.append('update Rotten Tomatoes ID')
         if titlediff:
-            if P_NAMED_AS in x.qualifiers:
-                if x.qualifiers[P_NAMED_AS][0].target != title:
-                    x.removeQualifiers(x.qualifiers[P_NAMED_AS])
-            if P_NAMED_AS not in x.qualifiers:
-                x.addQualifier(make_claim(P_NAMED_AS, title))
-                changed = True
+            named_as = x.qualifiers.get(P_NAMED_AS)
+            if not named_as or named_as[0].target != title:
+                qualifier = make_claim(P_NAMED_AS, title)
+                qualifier.isQualifier = True
+                x.qualifiers[P_NAMED_AS] = [qualifier]
+                changes.append('update Rotten Tomatoes ID "named as" qualifier')
     else:
         new_claim = make_claim(P_ROTTEN_TOMATOES_ID, movie.short_url)
         if titlediff:
             new_claim.addQualifier(make_claim(P_NAMED_AS, title))
-        item.addClaim(new_claim)
-        changed = True
+        attach_claim(item, new_claim)
+        changes.append('add Rotten Tomatoes ID')
 
     if should_add_RT_claims(movie, item):
         add_RT_claims_to_item(movie, item)
-        changed = True
+        changes.append('add Rotten Tomatoes score and average rating')
+
+    return changes
+
+def staged_data(item):
+    """
+    Returns the wbeditentity data for the changes staged on item.
+    pywikibot's diff against the loaded item leaves out new statements
+    of a property which the item already has, since they have no ID yet,
+    so those are added here.
+    """
+    data = item.toJSON(diffto=getattr(item, '_content', None))
+    claims = data.setdefault('claims', {})
+    for pid, values in item.claims.items():
+        for claim in values:
+            if claim.snak is None and (json := claim.toJSON()) not in claims.get(pid, []):
+                claims.setdefault(pid, []).append(json)
+    if not claims:
+        del data['claims']
+    return data
+
+def save_item_changes(item, changes):
+    """
+    Saves the changes staged on item (see stage_RTmovie_data)
+    with a single wbeditentity call.
+    """
+    summary = '; '.join(changes)
+    try:
+        with metrics.timer('wikidata_write'):
+            item.editEntity(staged_data(item),
+                summary=summary[0].upper() + summary[1:] + '.')
+    except pwb.exceptions.OtherPageSaveError:
+        # Usually another item already has the same label and description.
+        # In that case save everything except the label.
+        label_changes = [x for x in changes if x.startswith('add English label')]
+        if not label_changes:
+            raise
+        del item.labels['en']
+        changes = [x for x in changes if x not in label_changes]
+        if changes:
+            save_item_changes(item, changes)
+
+def update_RTmovie_data(movie, item):
+    """
+    Adds/updates the Rotten Tomatoes data in a Wikidata item.
+    Currently this means the Rotten Tomatoes ID and the two score claims.
+    All changes are saved in a single edit.
+    """
+    # WriteQueue passes items which are not loaded yet.
+    with metrics.timer('wikidata_read'):
+        item.get()
+    print(f"Checking item {item.id} aka {item.labels.get('en')}...",
+        end='', flush=True)
 
-    if changed:
+    changes = stage_RTmovie_data(movie, item)
+    if changes:
+        save_item_changes(item, changes)
         print(f" UPDATED.", flush=True)
     else:
         print()
-    return changed
+    return bool(changes)
+
+# Marks the end of a stream in the update_film_items pipeline and WriteQueue.
+_DONE = object()
+
+class WriteQueue:
+    """
+    Runs update_RTmovie_data for queued (movie, qid) pairs one at a time in
+    a background thread, so that callers do not wait on edit throttling.
+
+    Each write is recorded in a journal when it is queued and again when
+    it is done, so writes which were still queued (or failed) when the
+    process stopped are redone, after scraping the movie again, by the next
+    WriteQueue on the same journal. Use written_items to read the journal.
+    Use as a context manager. Leaving it normally waits for all queued
+    writes; leaving it with an exception only finishes the current one.
+
+    If dry_run is True, items are neither written nor journaled, and
+    stay pending.
+    """
+    def __init__(self, journal_path=WRITE_JOURNAL_FILE, dry_run=False):
+        self.dry_run = dry_run
+        self.journal = None if dry_run else Journal(journal_path)
+        self.queue = queue.Queue()
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = set()
+        latest = {r['qid']: r for r in self.journal.records} if self.journal else {}
+        for qid, r in latest.items():
+            if r['state'] != 'written':
+                self.pending.add(qid)
+                self.queue.put((qid, r['rtid'], None))
+        if self.pending:
+            print(f'Resuming {len(self.pending)} unfinished Wikidata writes.')
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, movie, qid):
+        with self.lock:
+            if qid in self.pending:
+                return
+            self.pending.add(qid)
+        if self.dry_run:
+            print(f'Would update item {qid} from {movie.short_url}.')
+            return
+        self.journal.record(qid=qid, rtid=movie.short_url, state='queued')
+        self.queue.put((qid, movie.short_url, movie))
+
+    def is_pending(self, qid):
+        """
+        Returns whether qid has a write which is queued or in progress.
+        """
+        with self.lock:
+            return qid in self.pending
+
+    def _run(self):
+        while not self.stop.is_set() and (x := self.queue.get()) is not _DONE:
+            qid, rtid, movie = x
+            try:
+                update_RTmovie_data(movie or RTmovie(rtid), make_item(qid))
+                state = 'written'
+            except Exception:
+                logger.exception(f'Failed to update item {qid} from {rtid}.')
+                print(f'Failed to update item {qid} from {rtid}.')
+                state = 'failed'
+            self.journal.record(qid=qid, rtid=rtid, state=state)
+            if state == 'written':
+                with self.lock:
+                    self.pending.discard(qid)
+
+    def close(self, wait=True):
+        if not wait:
+            self.stop.set()
+        self.queue.put(_DONE)
+        self.thread.join()
+        if self.journal is not None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(wait=exc_type is None)
+
+def written_items(journal_path=WRITE_JOURNAL_FILE):
+    """
+    Returns the set of QIDs whose latest write in a WriteQueue journal
+    succeeded.
+    """
+    latest = {r['qid']: r['state'] for r in read_records(journal_path)}
+    return {qid for qid, state in latest.items() if state == 'written'}
 
 
-def update_film_items(id_pairs):
+def _put(q, x, stop):
+    """
+    Blocking put that gives up once stop is set.
+    """
+    while not stop.is_set():
+        try:
+            q.put(x, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+def _get(q, stop):
+    """
+    Blocking get that returns _DONE once stop is set.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+def update_film_items(id_pairs, scrape_workers=SCRAPE_WORKERS, precheck=False,
+        on_done=None):
     """
     id_pairs should be list of (qid, rtid) pairs, which can be obtained
     from the Wikidata Query Service.
+    Returns the number of items updated.
+
+    If precheck is True, the current scores of all films are first fetched
+    in bulk with scores_on_wikidata, and items whose data has not changed
+    are skipped without being loaded.
+
+    If on_done is given, it is called as on_done(qid, rtid, outcome) once
+    each pair has been dealt with, where outcome is one of 'updated',
+    'unchanged' or 'scrape failed'. It can be called from any thread.
+    Pairs still in the pipeline when an error stops it are not reported.
+
+    This runs as a pipeline with bounded queues between the stages:
+    a pool of scrape_workers threads scrapes Rotten Tomatoes, a reader
+    thread preloads the scraped items in batches and stages their changes,
+    and the calling thread is the single writer which saves them.
+    Since all edits go through the one writer, pywikibot's maxlag
+    handling and put throttle pace them as usual.
     """
-    j = 0
-    for qid, rtid in id_pairs:
+    pairs = iter(id_pairs)
+    pairs_lock = threading.Lock()
+    scraped = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    staged = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+    films = scores_on_wikidata() if precheck else None
+    skipped = 0
+
+    def done(qid, rtid, outcome):
+        if on_done is not None:
+            on_done(qid, rtid, outcome)
+
+    def scrape():
+        nonlocal skipped
+        while not stop.is_set():
+            with pairs_lock:
+                qid, rtid = next(pairs, (None, None))
+            if qid is None:
+                return
+            try:
+                movie = RTmovie(rtid)
+            except Exception:
+                print(f'Failed to load {rtid} from item {qid}.')
+                done(qid, rtid, 'scrape failed')
+                continue
+            if films is not None and not needs_update(movie, rtid, films.get(qid)):
+                with pairs_lock:
+                    skipped += 1
+                done(qid, rtid, 'unchanged')
+                continue
+            _put(scraped, (qid, rtid, movie), stop)
+
+    def scrape_stage():
+        with ThreadPoolExecutor(max_workers=scrape_workers) as executor:
+            futures = [executor.submit(scrape) for _ in range(scrape_workers)]
+            wait(futures)
+        for future in futures:
+            future.result()
+
+    def read_stage():
+        while True:
+            # Take whatever has been scraped so far, up to one batch,
+            # rather than waiting for a full batch.
+            batch = [_get(scraped, stop)]
+            while batch[-1] is not _DONE and len(batch) < PRELOAD_BATCH_SIZE:
+                try:
+                    batch.append(scraped.get_nowait())
+                except queue.Empty:
+                    break
+            finished = batch[-1] is _DONE
+            if finished:
+                batch.pop()
+            items = preload_items([qid for qid, _, _ in batch]) if batch else {}
+            for qid, rtid, movie in batch:
+                # items can be missing from the preload, e.g. after a merge
+                item = items.get(qid) or make_item(qid)
+                if changes := stage_RTmovie_data(movie, item):
+                    _put(staged, (qid, rtid, item, changes), stop)
+                else:
+                    done(qid, rtid, 'unchanged')
+            if finished:
+                return
+
+    def run(stage, downstream):
         try:
-            movie = RTmovie(rtid)
-        except Exception:
-            print(f'Failed to load {rtid} from item {qid}.')
-            continue
-        j += update_RTmovie_data(movie, make_item(qid))
+            stage()
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(downstream, _DONE, stop)
+
+    threads = [threading.Thread(target=run, args=(scrape_stage, scraped)),
+        threading.Thread(target=run, args=(read_stage, staged))]
+    for t in threads:
+        t.start()
+
+    j = 0
+    try:
+        while (x := _get(staged, stop)) is not _DONE:
+            qid, rtid, item, changes = x
+            save_item_changes(item, changes)
+            print(f"Updated item {item.id} aka {item.labels.get('en')}.", flush=True)
+            done(qid, rtid, 'updated')
+            j += 1
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    if precheck:
+        print(f'Skipped {skipped} unchanged items without loading them.')
     return j
 
 def find_items_to_update():
@@ -316,9 +945,7 @@ def find_items_to_update():
     Q108403540 (Rotten Tomatoes average rating).
     For use with update_film_items.
     """
-    q = """SELECT ?item ?rtid
-WHERE 
-{
+    where = """
   ?item wdt:P1258 ?rtid.
   FILTER(regex(?rtid, '^m/'))
   FILTER NOT EXISTS {
@@ -327,24 +954,188 @@ WHERE
     ?reviewstatement pq:P585 ?date.
     FILTER ((12*YEAR(NOW())+MONTH(NOW())) - (12*YEAR(?date)+MONTH(?date)) < 4)
   }
-}"""
+"""
     p = []
-    for r in get_results(q):
+    for r in iter_results('?item ?rtid', where):
         qid = r['item']['value'].rpartition('/')[2]
         rtid = r['rtid']['value']
-        p.append(qid, rtid)
+        p.append((qid, rtid))
     return p
 
+@dataclass
+class FilmScores:
+    """
+    Rotten Tomatoes data of a film item, as seen by the query service.
+    """
+    rtids: set[str] = field(default_factory=set)
+    label: str = None
+    scores: tuple[str, str, str] = ('', '', '')  # as in most_recent_score_data
+    statements: dict = field(default_factory=dict)
+    released: date = None   # earliest publication date (P577)
+
+def _wqs_date(value):
+    """
+    Returns the date of a query service date value, or None if value is
+    missing or not a date, such as the blank node IRI of an unknown value.
+    """
+    if not value or not re.match(r'\+?\d{4}-\d\d-\d\d', value):
+        return None
+    y, m, d = map(int, value[:10].lstrip('+').split('-'))
+    return date(y or 1, m or 1, d or 1)
+
+def _latest_scores(statements):
+    """
+    Same as most_recent_score_data, but for statement dicts built
+    by scores_on_wikidata.
+    """
+    def statement_date(st):
+        if day := _wqs_date(st['date']) or _wqs_date(st['retrieved']):
+            return day
+        return date(1, 1, 3) if st['rank'].endswith('PreferredRank') else date(1, 1, 2)
+
+    score, count, average = '', '', ''
+    newest_date = date(1,1,1)
+    for st in statements:
+        if st['method'] != Q_TOMATOMETER or st['count'] is None:
+            continue
+        if (review_date := statement_date(st)) >= newest_date:
+            newest_date = review_date
+            score, count = st['value'], st['count'].lstrip('+')
+    if score:
+        for st in statements:
+            if st['method'] == Q_ROTTEN_TOMATOES_AVERAGE and statement_date(st) == newest_date:
+                average = st['value']
+                break
+    return score, count, average
+
+def scores_on_wikidata():
+    """
+    Returns a dict mapping QIDs to FilmScores, for every item with
+    a Rotten Tomatoes movie ID. Uses a few paged queries to the
+    Wikidata Query Service instead of loading any items.
+    Release dates are queried separately, since films often have one per
+    country, which would multiply the rows of their score statements.
+    """
+    select = '?item ?rtid ?label ?statement ?method ?value ?count ?date ?retrieved ?rank'
+    where = """
+  ?item wdt:P1258 ?rtid.
+  FILTER(STRSTARTS(?rtid, 'm/'))
+  OPTIONAL { ?item rdfs:label ?label. FILTER(LANG(?label) = 'en') }
+  OPTIONAL {
+    ?item p:P444 ?statement.
+    ?statement ps:P444 ?value; pq:P459 ?method; wikibase:rank ?rank.
+    FILTER(?method IN (wd:Q108403393, wd:Q108403540))
+    FILTER(?rank != wikibase:DeprecatedRank)
+    OPTIONAL { ?statement pq:P7887 ?count }
+    OPTIONAL { ?statement pq:P585 ?date }
+    OPTIONAL { ?statement prov:wasDerivedFrom/pr:P813 ?retrieved }
+  }
+"""
+    def value(r, key):
+        return r[key]['value'] if key in r else None
+
+    films = dict()
+    for r in iter_results(select, where):
+        qid = r['item']['value'].rpartition('/')[2]
+        film = films.setdefault(qid, FilmScores())
+        film.rtids.add(r['rtid']['value'])
+        film.label = value(r, 'label')
+        if 'statement' in r:
+            film.statements.setdefault(r['statement']['value'], {
+                'method': r['method']['value'].rpartition('/')[2],
+                'value': r['value']['value'],
+                'count': value(r, 'count'),
+                'date': value(r, 'date'),
+                'retrieved': value(r, 'retrieved'),
+                'rank': r['rank']['value'],
+            })
+
+    where = """
+  ?item wdt:P577 ?released.
+  FILTER(isLiteral(?released))
+  FILTER EXISTS { ?item wdt:P1258 ?rtid. FILTER(STRSTARTS(?rtid, 'm/')) }
+"""
+    for r in iter_results('?item ?released', where):
+        film = films.get(r['item']['value'].rpartition('/')[2])
+        if film is not None and (released := _wqs_date(r['released']['value'])):
+            film.released = min(film.released or released, released)
+    logger.info("Loaded scores of %d films", len(films))
+
+    for film in films.values():
+        film.scores = _latest_scores(film.statements.values())
+    return films
+
+def shard_of(qid, shards):
+    """
+    Returns the shard (0 to shards-1) to which the item qid belongs.
+    """
+    return int(qid[1:]) % shards
+
+def refresh_items(file=REFRESH_WORK_FILE, journal_path=None, shard=0, shards=1,
+        retry_failed=False, **kwargs):
+    """
+    Runs update_film_items on the (qid, rtid) pairs in the JSON file
+    which belong to the given shard, recording the outcome of each pair in
+    a journal. Pairs already in the journal are skipped, so running this
+    again after an interruption resumes where it stopped. Pairs which failed
+    to scrape are only tried again if retry_failed is True.
+    The default journal is named after the file and a hash of its contents,
+    so a regenerated work file starts afresh.
+    Several processes with different shards (and the same number of shards)
+    can run at once without handling any item twice.
+    Other keyword arguments are passed to update_film_items.
+    """
+    if journal_path is None:
+        journal_path = REFRESH_JOURNAL_FILE.format(work=work_key(file),
+            shard=shard, shards=shards)
+    with open(file) as f:
+        pairs = [tuple(x) for x in json.load(f)]
+    with Journal(journal_path) as journal:
+        done = {(r['qid'], r['rtid']) for r in journal.records
+            if not (retry_failed and r['outcome'] == 'scrape failed')}
+        todo = [(qid, rtid) for qid, rtid in pairs
+            if shard_of(qid, shards) == shard and (qid, rtid) not in done]
+        print(f'{len(todo)} items to refresh in shard {shard} of {shards} '
+            f'({len(done)} already done).')
+        record = lambda qid, rtid, outcome: journal.record(qid=qid, rtid=rtid,
+            outcome=outcome)
+        return update_film_items(todo, on_done=record, **kwargs)
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Refresh Rotten Tomatoes data on Wikidata film items.')
+    parser.add_argument('file', nargs='?', default=REFRESH_WORK_FILE,
+        help='JSON file with a list of [qid, rtid] pairs.')
+    parser.add_argument('--journal',
+        help='Journal file in which to record progress. '
+        f'Defaults to {REFRESH_JOURNAL_FILE!r}.')
+    parser.add_argument('--shard', type=int, default=0,
+        help='Which shard of the items to refresh, from 0 to SHARDS-1.')
+    parser.add_argument('--shards', type=int, default=1,
+        help='Number of shards the items are split into.')
+    parser.add_argument('--retry-failed', action='store_true',
+        help='Try again the items which failed to scrape in an earlier run.')
+    parser.add_argument('--scrape-workers', type=int, default=SCRAPE_WORKERS,
+        help='Number of concurrent scraping threads.')
+    parser.add_argument('--precheck', action='store_true',
+        help='Skip items whose data has not changed without loading them.')
+    parser.add_argument('--metrics-interval', type=float, default=metrics.EXPORT_INTERVAL,
+        metavar='SECONDS', help=f'Seconds between exports of the metrics to '
+        f'{metrics.METRICS_JSON_FILE} and {metrics.METRICS_PROM_FILE}.')
+    args = parser.parse_args()
+    if not 0 <= args.shard < args.shards:
+        parser.error('--shard must be between 0 and SHARDS-1.')
+    return args
+
 if __name__ == "__main__":
     t0 = time.perf_counter()
+    args = get_args()
 
-    data = json.load(open('storage/film_items_to_update.json'))
-    print(len(data))
-    start = 0
-    print(start)
-
-    print(f'UPDATED {update_film_items(data[start : ])} ITEMS.')
+    with metrics.Exporter(args.metrics_interval):
+        n = refresh_items(args.file, args.journal, args.shard, args.shards,
+            retry_failed=args.retry_failed, scrape_workers=args.scrape_workers,
+            precheck=args.precheck)
+    print(f'UPDATED {n} ITEMS.')
 
     t1 = time.perf_counter()
     print("TIME ELAPSED =", t1-t0, file = sys.stderr)
-
@@ -2,43 +2,62 @@
 ################################################################################
 import logging
 import json
+import os
 import sys
 import webbrowser
 
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 
-import editor
 import regex as re
-import wikitextparser as wtp
 
 from colorama import Fore, Style
-from pywikibot import Page, Site, ItemPage
-from rapidfuzz.fuzz import partial_ratio
 
 import candidates
+import metrics
+import profiling
 
+from lazyimport import lazy_import
 from patterns import *
 from wdeditor import *
 
+editor = lazy_import('editor')
+pwb = lazy_import('pywikibot')
+wtp = lazy_import('wikitextparser')
+
 logger = logging.getLogger(__name__)
 ################################################################################
+EDIT_WORKERS        = os.cpu_count() or 1
+# maximum number of candidates being worked on per edit worker
+EDIT_QUEUE_FACTOR   = 4
 
 @dataclass
 class Edit:
     replacements: list[tuple[str, str]]
     flags: set[str]
     reviewed: bool = False
+    pending: str = None     # QID whose Wikidata write had not finished
 
 @dataclass
 class FullEdit:
     title: str
     edits: list[Edit]
 
-def compute_edits(candidates, get_user_input = False):
+def compute_edits(candidates, get_user_input = False, workers = EDIT_WORKERS,
+        ordered = True, dry_run = False):
     """
     candidates is an iterable of candidate objects.
+
+    Edits are computed by a pool of worker processes and yielded
+    in the order of the candidates if ordered is True, otherwise as soon
+    as they are ready. Meanwhile, Wikidata items which have no scores yet
+    are updated by a wdeditor.WriteQueue; edits whose item had not been
+    written when they were yielded are marked pending.
+    If dry_run is True, the items are not updated and their edits stay
+    pending.
     """
 
     # SELECT ?item
@@ -62,30 +81,105 @@ def compute_edits(candidates, get_user_input = False):
     data = json.load(open('storage/items_with_scores.json'))
     items_with_scores = set(r['item'].rpartition('/')[2] for r in data)
 
-    for cand in candidates:
-        fe = fulledit_from_candidate(cand, items_with_scores)
-        if not fe.edits:
-            continue
-        if get_user_input:
-            _process_manual_reviews(cand, fe)
-        yield fe
+    running = deque()
+
+    def take():
+        # the oldest candidate, or if not ordered, the first one finished
+        if not ordered:
+            wait([f for _, f in running], return_when=FIRST_COMPLETED)
+            running.rotate(-next(i for i, (_, f) in enumerate(running) if f.done()))
+        cand, future = running.popleft()
+        fe, snap, timings = future.result()
+        metrics.merge(snap)
+        profiling.merge(timings)
+        _mark_pending(fe, cand, writes)
+        if fe.edits:
+            if get_user_input:
+                _process_manual_reviews(cand, fe)
+            yield fe
+
+    with WriteQueue(dry_run=dry_run) as writes, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init) as executor:
+        for cand in _with_qids(candidates):
+            for movie, qid in _wikidata_updates(cand, items_with_scores):
+                writes.submit(movie, qid)
+            running.append((cand, executor.submit(_measured_edits_from_candidate, cand, profiling.OPTIONS)))
+            while len(running) >= EDIT_QUEUE_FACTOR * workers:
+                yield from take()
+        while running:
+            yield from take()
+
+def _init():
+    """
+    To be used with Executor in compute_edits.
+    """
+    metrics.reset()
+    profiling.reset()
 
-def fulledit_from_candidate(cand, items_with_scores):
-    title, text, matches = cand.title, cand.text, cand.matches
+def _with_qids(candidates):
+    """
+    Yields candidates in order, setting the qid of those which have none,
+    such as candidates stored by older versions, from their titles
+    resolved in batches.
+    """
+    batch = []
+
+    def flush():
+        titles = [cand.title for cand in batch if cand.qid is None]
+        found = get_sitelinks().resolve(titles) if titles else {}
+        for cand in batch:
+            if cand.qid is None:
+                cand.qid = found[cand.title][0]
+        yield from batch
+        batch.clear()
 
-    cand.qid = None
-    # find qid of item connected to cand's article
-    site = Site('en','wikipedia')
-    try:
-        cand.qid = ItemPage.fromPage(Page(site, title)).id
-    except pwb.exceptions.NoPageError:
-        pass
+    for cand in candidates:
+        if cand.qid is not None and not batch:
+            yield cand
+            continue
+        batch.append(cand)
+        if len(batch) == PRELOAD_BATCH_SIZE:
+            yield from flush()
+    yield from flush()
 
-    # update Wikidata items
-    for movie, qid in ((m.movie, m.qid) for m in matches):
+def _wikidata_updates(cand, items_with_scores):
+    """
+    Returns the (movie, qid) pairs of cand's matches whose items still
+    need Rotten Tomatoes data.
+    """
+    updates = []
+    for movie, qid in ((m.movie, m.qid) for m in cand.matches):
         if qid not in items_with_scores:
-            update_RTmovie_data(movie, make_item(qid))
+            updates.append((movie, qid))
             items_with_scores.add(qid)
+    return updates
+
+def _mark_pending(fe, cand, writes):
+    # edits_from_candidate makes one Edit per match
+    for edit, match in zip(fe.edits, cand.matches):
+        if writes.is_pending(match.qid):
+            edit.pending = match.qid
+
+def _measured_edits_from_candidate(cand, profile_options=None):
+    """
+    Returns the FullEdit for cand, with the metrics and, if profiling,
+    the slowest candidates that the worker recorded since its last task.
+    """
+    return _profiled_edits_from_candidate(cand, profile_options), \
+        metrics.drain(), profiling.drain()
+
+def _profiled_edits_from_candidate(cand, profile_options=None):
+    with profiling.page('edits_from_candidate', cand.title, profile_options) as p:
+        fe = edits_from_candidate(cand)
+        p.size, p.matches = len(cand.text), len(cand.matches)
+    return fe
+
+def edits_from_candidate(cand):
+    """
+    Returns the FullEdit for cand, whose qid must already be set.
+    This only computes text, so it can run in a worker process.
+    """
+    title, text, matches = cand.title, cand.text, cand.matches
 
     # Fix duplicated citations, if any. This is a hacky solution.
     # c = Counter(x.movie.url for x in matches)
@@ -198,11 +292,24 @@ def fulledit_from_candidate(cand, items_with_scores):
 #################################################################################
 # Functions for creating replacement text.
 #################################################################################
+# Any other '<' may start a tag which _compute_flags must report.
+_other_tag_re = r'<(?!/?(?:ref|nowiki)[\s/>])'
+# Characters that can begin or end a wikilink, template or tag.
+_markup_re = r'[\[\]{}|<>\n]'
+_other_scores_re = r'(?i)Metacritic|IMDb|PostTrak|CinemaScore'
+_other_scores = {x.lower(): x for x in ['Metacritic', 'IMDb', 'PostTrak', 'CinemaScore']}
+_someref_start_re = fr'<ref|{template_pattern("[rR]")}'
+_quote_table = str.maketrans('“”‘’','""\'\'')
+
 def _compute_flags(rtmatch, cand):
     """
     Compute initial set of flags for a match.
     Flags indicate that an edit needs review.
     An edit should never be uploaded if its flags attribute is nonempty.
+
+    The text is parsed once, with references removed; the parses with
+    references kept and with quotations removed are only needed in the
+    rare cases where they could find something different.
     """
     span = rtmatch.span
     text = cand.text[span[0]:span[1]]
@@ -212,7 +319,7 @@ def _compute_flags(rtmatch, cand):
     # Remove comments from text
     text = re.sub(r'<!--.*?-->', '', text, flags=re.S)
     # Fix quote style
-    text = text.translate(str.maketrans('“”‘’','""\'\''))
+    text = text.translate(_quote_table)
 
     # Flags related to the film's title
     if re.search(score_re, cand.title+movie.title):
@@ -221,17 +328,16 @@ def _compute_flags(rtmatch, cand):
         flags.add('average pattern in title')
 
     # Reference other than Rotten Tomatoes?
-    if pattern_count(fr'<ref|{template_pattern("[rR]")}', text) - bool(rtmatch.ref):
+    if pattern_count(_someref_start_re, text) - bool(rtmatch.ref):
         flags.add(f"non-RT reference")
 
     # Shortened footnotes?
     if re.search(r'{{\s*(?:shortened|sfn|harv)', text, flags=re.I):
         flags.add('sfn or harv')
 
-    wikitext = wtp.parse(text)
     # Tags other than ref and nowiki?
-    for tag in wikitext.get_tags():
-        if tag.name not in ['ref', 'nowiki']:
+    if re.search(_other_tag_re, text):
+        if any(tag.name not in ['ref', 'nowiki'] for tag in wtp.parse(text).get_tags()):
             flags.add(f'suspicious tag')
 
     # delete refs (comments already deleted)
@@ -242,14 +348,8 @@ def _compute_flags(rtmatch, cand):
         flags.add(f'unbalanced {x}')
 
     # Check for other scores which might interfere: Metacritic, IMDb, PostTrak, CinemaScore
-    if re.search(r'Metacritic', text_no_refs, flags=re.I):
-        flags.add('Metacritic')
-    if re.search(r'IMDb', text_no_refs, flags=re.I):
-        flags.add('IMDb')
-    if re.search(r'PostTrak', text_no_refs, flags=re.I):
-        flags.add('PostTrak')
-    if re.search(r'CinemaScore', text_no_refs, flags=re.I):
-        flags.add('CinemaScore')
+    for m in re.finditer(_other_scores_re, text_no_refs):
+        flags.add(_other_scores[m[0].lower()])
 
     # Commented out because seems useless, pretty much just false positives.
     # if text_no_refs[-1] not in '."':
@@ -264,50 +364,129 @@ def _compute_flags(rtmatch, cand):
         flags.add('parser function')
     if wikitext_no_refs.external_links:
         flags.add('external link')
-    for x in wikitext_no_refs.wikilinks:
-        if x.text:
-            x.target = 'a' * len(x.target)
 
     uses_rtprose = 1 if re.search(t_rtprose, text_no_refs) else 0
-    k = pattern_count(score_re, str(wikitext_no_refs)) + uses_rtprose
+    k = pattern_count(score_re, _hide_link_targets(wikitext_no_refs)) + uses_rtprose
     if k == 0:
         flags.add('missing score')
     if k > 1:
         flags.add('multiple scores')
 
-    k = pattern_count(average_re, str(text_no_refs)) + uses_rtprose
+    k = pattern_count(average_re, text_no_refs) + uses_rtprose
     # if k == 0:
     #     flags.add('missing average')
     if k > 1:
         flags.add('multiple averages')
 
-    k = pattern_count(count_re, str(text_no_refs)) + uses_rtprose
+    k = pattern_count(count_re, text_no_refs) + uses_rtprose
     # if k == 0:
     #     flags.add('missing count')
     if k > 1:
         flags.add('multiple counts')
 
     # hide quotes (comments and refs already deleted)
-    text_no_quotes = re.sub(r'".+?"', '', text_no_refs, flags=re.S)
+    quotes = [m.span() for m in re.finditer(r'".+?"', text_no_refs, flags=re.S)]
+    text_no_quotes = _remove_spans(text_no_refs, quotes)
     # audience score?
-    if pattern_count(r'\b(audience|user|viewer)', text_no_quotes, re.IGNORECASE):
+    if re.search(r'\b(audience|user|viewer)', text_no_quotes, flags=re.I):
         flags.add('audience/user/viewer')
 
-    wikitext_no_quotes = wtp.parse(text_no_quotes)
+    if x := _unquoted_links_and_templates(wikitext_no_refs, quotes):
+        wikilinks, templates = x
+    else:
+        wikitext_no_quotes = wtp.parse(text_no_quotes)
+        wikilinks, templates = wikitext_no_quotes.wikilinks, wikitext_no_quotes.templates
 
-    for x in wikitext_no_quotes.wikilinks:
+    for x in wikilinks:
         z = x.title.strip()
         z = f'WL:{z[:1].upper()+z[1:]}'
         flags.add(z)
 
-    for x in wikitext_no_quotes.templates:
+    for x in templates:
         z = f'T:{x.normal_name(capitalize=True)}'
         flags.add(z)
 
     return flags
 
+def _remove_spans(text, spans):
+    """
+    Returns text without the given sorted, disjoint spans.
+    """
+    pieces, pos = [], 0
+    for i, j in spans:
+        pieces.append(text[pos:i])
+        pos = j
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+def _hide_link_targets(wikitext):
+    """
+    Returns the string of a parsed wikitext with the target of every
+    wikilink which has text replaced by as many a's, so that targets
+    are not mistaken for prose. Does not modify wikitext.
+    """
+    text = wikitext.string
+    targets = []
+    for x in wikitext.wikilinks:
+        if x.text:
+            i = x.span[0] + 2
+            if text[i:i+len(x.target)] != x.target:
+                targets = None
+                break
+            targets.append((i, i + len(x.target)))
+    if targets is not None:
+        targets.sort()
+        if any(j > i for (_, j), (i, _) in zip(targets, targets[1:])):
+            targets = None
+    if targets is None:
+        # Nested or unusual links; let the parser do it on a copy.
+        wikitext = wtp.parse(text)
+        for x in wikitext.wikilinks:
+            if x.text:
+                x.target = 'a' * len(x.target)
+        return str(wikitext)
+    pieces, pos = [], 0
+    for i, j in targets:
+        pieces.append(text[pos:i])
+        pieces.append('a' * (j - i))
+        pos = j
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+def _unquoted_links_and_templates(wikitext, quotes):
+    """
+    Returns the wikilinks and templates that parsing the text of wikitext
+    without the quotation spans would find, taken from wikitext itself,
+    or None if removing the quotations might change how the rest parses:
+    that is, if a quotation overlaps a construct without containing it,
+    if its text outside the constructs it contains has any markup
+    characters, or if it borders on one.
+    """
+    text = wikitext.string
+    wikilinks, templates = wikitext.wikilinks, wikitext.templates
+    spans = [x.span for x in wikilinks + templates
+        + wikitext.parser_functions + wikitext.parameters]
+    for a, b in quotes:
+        if re.search(_markup_re, text[a-1:a] + text[b:b+1]):
+            return None
+        pos = a
+        for s, e in sorted(spans):
+            if e <= a or s >= b:
+                continue
+            if s < a or e > b:
+                return None
+            if s >= pos:
+                if re.search(_markup_re, text[pos:s]):
+                    return None
+            pos = max(pos, e)
+        if re.search(_markup_re, text[pos:b]):
+            return None
+    keep = lambda x: not any(a <= x.span[0] and x.span[1] <= b for a, b in quotes)
+    return [x for x in wikilinks if keep(x)], [x for x in templates if keep(x)]
+
 def _suggested_edit(cand, rtmatch):
-    flags = _compute_flags(rtmatch, cand)
+    with metrics.timer('flags'):
+        flags = _compute_flags(rtmatch, cand)
     reduced_flags = set(x for x in flags if not re.match(r'(T|WL):', x))
     reduced_flags -= {'PostTrak', 'CinemaScore'}
     # reduced_flags -= {'Metacritic', 'IMDb'}
@@ -316,7 +495,6 @@ def _suggested_edit(cand, rtmatch):
     span = rtmatch.span
     ref = rtmatch.ref
     movie = rtmatch.movie
-    score, count, average = movie.tomatometer_score
 
     old_text = cand.text[span[0]:span[1]]
     new_prose = old_text
@@ -398,7 +576,7 @@ def _suggested_edit(cand, rtmatch):
                         temp_dict['postscript'] = x.value.strip()
                     refwikitext = wtp.parse(f'<ref>{construct_template(t.normal_name(), temp_dict)}</ref>')
 
-                # for duplicate ref handling. See fulledit_from_candidate.
+                # for duplicate ref handling. See edits_from_candidate.
                 if ref.name:
                     refwikitext.get_tags()[0].set_attr('name', ref.name)
 
@@ -432,43 +610,79 @@ def _suggested_edit(cand, rtmatch):
     ###########################################################################
     # Reference and critical consensus have been handled above. Now we continue.
 
+    new_prose = _rewrite_prose(new_prose, rtmatch, flags)
+
+    replacements = [(old_text, new_prose)] + replacements
+
+    # remove qid= parameter if superfluous
+    if cand.qid == rtmatch.qid:
+        replacements = [(z[0], z[1].replace(f'|qid={rtmatch.qid}', '')) for z in replacements]
+
+    return Edit(replacements, reduced_flags)
+
+# Compiled once, since _rewrite_prose runs them for every match.
+_comment_re         = re.compile(r'<!--.*?-->', flags=re.S)
+_rtprose_re         = re.compile(t_rtprose)
+_on_list_re         = re.compile(r'\[\[\s*(?:List of )?films with a (100|0)% rating on Rotten Tomatoes\s*\|([^]]+)\]\]', flags=re.I)
+_on_list_target_re  = re.compile(r'\[\[\s*(?:List of )?films with a (100|0)% rating on Rotten Tomatoes', flags=re.I)
+_score_re           = re.compile(score_re, flags=re.S)
+_count_re           = re.compile(count_re, flags=re.S)
+_average_re         = re.compile(average_re, flags=re.S)
+_list_score_re      = re.compile(r'ilms with a \{\{RT data\|score.*?\}\} rating on Rotten')
+_asof_re            = re.compile(t_asof, flags=re.S)
+_asof_date_re       = re.compile(r"[Aa]s of (?=Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|[1-9]|early|mid|late).{,14}(?<![0-9])[0-9]{4}(?![0-9])" + notinref, flags=re.S)
+_asof_other_re      = re.compile(r"\b[Aa]s of\b|(January|February|March|April|May|June|July|August|September|October|November|December) 20\d\d\b" + notinref, flags=re.S)
+_weighted_link_re   = re.compile(r'weighted (average|(arithmetic )?mean)|average (rating|score)|rating average')
+_weighted_re        = re.compile(' weighted ')
+_a_average_re       = re.compile(' a average')
+_rare_re            = re.compile(r'rare (0%|100%|\[\[List|approval rating)')
+_a_or_an_re         = re.compile(fr' an? ({template_pattern("RT data")})')
+_someref_re         = re.compile(someref_re, flags=re.S)
+_cn_re              = re.compile(cn_re, flags=re.S)
+
+def _rewrite_prose(new_prose, rtmatch, flags):
+    """
+    Rewrites Rotten Tomatoes prose, which already has its new citation,
+    to use {{RT data}}. Adds to flags anything that needs review.
+    """
+    score, count, average = rtmatch.movie.tomatometer_score
+
     # Remove comments
-    new_prose = re.sub(r'<!--.*?-->', '', new_prose, flags=re.S)
+    new_prose = _comment_re.sub('', new_prose)
     # Fix quote style
-    new_prose = new_prose.translate(str.maketrans('“”‘’','""\'\''))
+    new_prose = new_prose.translate(_quote_table)
 
     # Replace Template:Rotten Tomatoes prose with {{RT data|prose}}
-    if m := re.search(t_rtprose, new_prose):
+    if m := _rtprose_re.search(new_prose):
         new_prose = new_prose.replace(m[0], rtdata_template('prose', qid=rtmatch.qid))
 
     # Handle cases where linked to [[List of films with a 100% rating on Rotten Tomatoes]]
-    on_list = re.search(r'\[\[\s*(?:List of )?films with a (100|0)% rating on Rotten Tomatoes\s*\|([^]]+)\]\]', new_prose, flags=re.I)
+    on_list = _on_list_re.search(new_prose)
     if on_list:
         if on_list[1] != score:
             new_prose = new_prose.replace(on_list[0], on_list[2].strip())
             flags.add('no longer 0% or 100%')
-    elif m := re.search(r'\[\[\s*(?:List of )?films with a (100|0)% rating on Rotten Tomatoes', new_prose, flags=re.I):
+    elif m := _on_list_target_re.search(new_prose):
         if m[1] != score:
             flags.add('no longer 0% or 100%')
 
     # Replace score, count, and and average
-    new_prose = re.sub(score_re + notinref,
-        rtdata_template('score', qid=rtmatch.qid), new_prose, flags=re.S)
+    rules = [(_score_re, rtdata_template('score', qid=rtmatch.qid))]
     if not {'Metacritic'} & flags:
-        new_prose = re.sub(count_re + notinref,
-            rtdata_template('count', qid=rtmatch.qid)+r' \g<count_term>', new_prose, flags=re.S)
-        # MOS:NUMERAL
-        if int(count) <= 9:
-            new_prose = new_prose.replace('{{RT data|count', '{{RT data|count|spell=y')
+        rules.append((_count_re, rtdata_template('count', qid=rtmatch.qid)+r' \g<count_term>'))
     if not {'IMDb'} & flags:
-        new_prose = re.sub(average_re + notinref,
-            rtdata_template('average', qid=rtmatch.qid), new_prose, flags=re.S)
+        rules.append((_average_re, rtdata_template('average', qid=rtmatch.qid)))
+    new_prose = _sub_outside_refs(rules, new_prose)
+    # MOS:NUMERAL
+    # (done after the average, which cannot match near {{RT data|count)
+    if not {'Metacritic'} & flags and int(count) <= 9:
+        new_prose = new_prose.replace('{{RT data|count', '{{RT data|count|spell=y')
 
     # Fix Wikilink target so that it doesn't use {{RT data}}
-    new_prose = re.sub(r'ilms with a \{\{RT data\|score.*?\}\} rating on Rotten', fr'ilms with a {score}% rating on Rotten', new_prose)
+    new_prose = _list_score_re.sub(fr'ilms with a {score}% rating on Rotten', new_prose)
 
     # Update "As of" date
-    if m:=re.search(t_asof, new_prose, flags=re.S):
+    if m := _asof_re.search(new_prose):
         d = parse_template(m[0])[1]
         if '3' in d:
             d['4'] = 'd'
@@ -479,7 +693,7 @@ def _suggested_edit(cand, rtmatch):
             if re.search(r'[a-z]', d['1']): # if has letter, assume month is incorrectly put here
                 d['3'] = 'm'
         new_prose = new_prose.replace(m[0], rtdata_template('as of', **d, qid=rtmatch.qid))
-    elif m:=re.search(r"[Aa]s of (?=Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|[1-9]|early|mid|late).{,14}(?<![0-9])[0-9]{4}(?![0-9])" + notinref, new_prose, flags=re.S):
+    elif m := _asof_date_re.search(new_prose):
         d = {'1':'as of', '2':'y', '3':'m'}
         if pattern_count('[0-9]', m[0]) > 4: # if includes day
             d['4'] = 'd'
@@ -489,41 +703,81 @@ def _suggested_edit(cand, rtmatch):
             d['lc'] = 'y'
         d['qid'] = rtmatch.qid
         new_prose = new_prose.replace(m[0], rtdata_template(**d))
-    elif re.search(r"\b[Aa]s of\b|(January|February|March|April|May|June|July|August|September|October|November|December) 20\d\d\b" + notinref, new_prose, flags=re.S):
+    elif _asof_other_re.search(new_prose):
         flags.add('As of')
 
     # Not a weighted average??? At the very least unsourced info.
     if not {'Metacritic','IMDb'} & flags:
-        for wl in wtp.parse(new_prose).wikilinks:
-            z = wl.title.strip().lower()
-            if re.match(r'weighted (average|(arithmetic )?mean)|average (rating|score)|rating average', z):
-                repl = wl.text.strip() if wl.text else wl.title.strip()
-                new_prose = new_prose.replace(str(wl), repl)
-        new_prose = re.sub(' weighted ' + notinref, ' ', new_prose, flags=re.S)
-        new_prose = re.sub(' a average' + notinref, ' an average', new_prose, flags=re.S)
+        # every title _weighted_link_re matches has 'average' or 'mean'
+        lower = new_prose.lower()
+        if 'average' in lower or 'mean' in lower:
+            for wl in wtp.parse(new_prose).wikilinks:
+                z = wl.title.strip().lower()
+                if _weighted_link_re.match(z):
+                    repl = wl.text.strip() if wl.text else wl.title.strip()
+                    new_prose = new_prose.replace(str(wl), repl)
+        new_prose = _sub_outside_refs([(_weighted_re, ' '), (_a_average_re, ' an average')], new_prose)
 
     # remove "rare" adjective since it is subjective
-    new_prose = re.sub(r'rare (0%|100%|\[\[List|approval rating)', r'\1', new_prose)
+    new_prose = _rare_re.sub(r'\1', new_prose)
 
     # An xx% rating vs a xx% rating...
-    new_prose = re.sub(fr' an? ({template_pattern("RT data")})', r' {{a or an|\1}}', new_prose)
+    new_prose = _a_or_an_re.sub(r' {{a or an|\1}}', new_prose)
 
     # Minor (usually correct) fixes
     new_prose = new_prose.replace('"..', '".')
     new_prose = new_prose.replace('.".', '."')
     new_prose = new_prose.replace('".', '."')
-    new_prose = re.sub(someref_re, lambda h: h[0].lstrip(), new_prose, flags=re.S)
+    new_prose = _someref_re.sub(lambda h: h[0].lstrip(), new_prose)
 
     # remove citation needed template
-    new_prose = re.sub(cn_re, '', new_prose, flags=re.S)
-
-    replacements = [(old_text, new_prose)] + replacements
+    new_prose = _cn_re.sub('', new_prose)
 
-    # remove qid= parameter if superfluous
-    if cand.qid == rtmatch.qid:
-        replacements = [(z[0], z[1].replace(f'|qid={rtmatch.qid}', '')) for z in replacements]
+    return new_prose
 
-    return Edit(replacements, reduced_flags)
+def _spans_outside_refs(text):
+    """
+    Returns the spans of text whose positions satisfy notinref,
+    i.e. are not inside a reference, as a list of (start, end).
+    Each span but the last ends with the first character of the
+    '<ref' or paragraph break that closes it.
+    """
+    inside = []
+    blocker = -1    # start of the last '<ref' or paragraph break
+    for m in re.finditer(r'(?=(<ref|\n\n|</ref))', text):
+        if m[1] != '</ref':
+            blocker = m.start()
+        elif inside and inside[-1][0] == blocker + 1:
+            inside[-1] = (blocker + 1, m.start() + 1)
+        else:
+            inside.append((blocker + 1, m.start() + 1))
+    spans, pos = [], 0
+    for start, end in inside:
+        if start > pos:
+            spans.append((pos, start))
+        pos = end
+    spans.append((pos, len(text)))
+    return spans
+
+def _sub_outside_refs(rules, text):
+    """
+    Does re.sub(pattern.pattern + notinref, repl, text, flags=re.S) for
+    each compiled pattern and repl in rules, in order, but only scans the
+    text outside references, splitting it once for all the rules.
+    Gives the same result as long as no pattern can match '<' or a
+    newline or look behind further than a word boundary, and no repl
+    contains them: then no match can leave the span it starts in, and
+    no replacement can move the references.
+    """
+    pieces, pos = [], 0
+    for start, end in _spans_outside_refs(text):
+        segment = text[start:end]
+        for pattern, repl in rules:
+            segment = pattern.sub(repl, segment)
+        pieces += [text[pos:start], segment]
+        pos = end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
 
 def citation_replacement(rtmatch):
     ref, movie = rtmatch.ref, rtmatch.movie
@@ -570,8 +824,17 @@ def safe_to_add_consensus1(rtmatch, cand, new_text = ''):
         return False
     return True
 
+# Markup and non-word characters, which safe_to_add_consensus2 ignores.
+_not_prose_re = re.compile(someref_re + r"|''.*?''|\{.*?\}|\[[^]]*\||<!--.*?-->|\W", flags=re.S)
+
+@lru_cache(maxsize=1024)
+def _stripped_consensus(consensus):
+    # the same movie's consensus is checked for every page about it
+    return _not_prose_re.sub('', consensus)
+
 # computationally expensive
 def safe_to_add_consensus2(rtmatch, cand, new_text = ''):
+    from rapidfuzz.fuzz import partial_ratio
     consensus, span, text = rtmatch.movie.consensus, rtmatch.span, cand.text
     if rtmatch.qid != cand.qid:
         return False
@@ -580,23 +843,23 @@ def safe_to_add_consensus2(rtmatch, cand, new_text = ''):
     if len(cand.matches) > 1 and rtmatch.span[0] < text.index('\n=='):
         return False
     p_start, p_end = paragraph_span(rtmatch.span, text)
-    pattern = someref_re + r"|''.*?''|\{.*?\}|\[[^]]*\||<!--.*?-->|\W"
-    after     = re.sub(pattern, '', text[span[1]: p_end], flags=re.S)
-    new_text  = re.sub(pattern, '', new_text, flags=re.S)
-    before    = re.sub(pattern, '', text[p_start:span[0]], flags=re.S)
-    consensus = re.sub(pattern, '', consensus, flags=re.S)
+    consensus = _stripped_consensus(consensus)
     if not consensus: # edge cases such as The Emoji Movie or Tour De Pharmacy
         return False
 
     def consensus_likely_in_text(t):
-        return partial_ratio(consensus,t,score_cutoff=60)
-    return not any(map(consensus_likely_in_text, [after, new_text, before]))
+        # stripped only when compared, since any() stops at the first match
+        t = _not_prose_re.sub('', t)
+        return t and partial_ratio(consensus,t,score_cutoff=60)
+    return not any(map(consensus_likely_in_text,
+        [text[span[1]: p_end], new_text, text[p_start:span[0]]]))
 
 def unbalanced_brackets(text):
     rbrackets = {']':'[', '}':'{', ')':'(', '>':'<'}
     lbrackets = rbrackets.values()
     stack= []
-    for c in text:
+    for m in re.finditer(r'[][{}()<>"]', text):
+        c = m[0]
         if c == '"':
             if stack and stack[-1] == '"':
                 stack.pop()